@@ -17,12 +17,20 @@ Example usage as module:
 >>> unnormalized, unnormalized_colnames = cache.load(imKeys)
 >>> normalized, normalized_colnames = cache.load(imKeys, normalization=RobustLinearNormalization)
 
+Converting a cache with one feature file per image to the contiguous
+per-plate layout (one memory-mapped feature file per plate):
+
+$ python -m cpa.profiling.cache --convert /imaging/analysis/2008_12_04_Imaging_CDRP_for_MLPCN/CDP2/cache
+
 '''
 
 import sys
 import os
 import logging
 import json
+import threading
+import Queue
+from collections import OrderedDict
 from optparse import OptionParser
 import progressbar
 import numpy as np
@@ -31,6 +39,7 @@ import cpa
 import cpa.dbconnect
 import cpa.util
 from .normalization import DummyNormalization, normalizations
+from .parallel import ParallelProcessor, Uniprocessing, run_digest
 
 logger = logging.getLogger(__name__)
 
@@ -41,11 +50,53 @@ def np_load(filename):
         f.close()
     return x
 
-def make_progress_bar(text=None):
+def make_progress_bar(text=None, maxval=None):
     widgets = (['%s: ' % text] if text else []) + [progressbar.Percentage(), ' ', 
                                                    progressbar.Bar(), ' ', 
                                                    progressbar.ETA()]
-    return progressbar.ProgressBar(widgets=widgets)
+    return progressbar.ProgressBar(widgets=widgets, maxval=maxval)
+
+def _readahead(iterable, n):
+    """
+    Iterate over ITERABLE on a background thread, keeping up to N
+    items ready.  Exceptions raised by the iterable are re-raised in
+    the consuming thread.
+    """
+    queue = Queue.Queue(n)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((True, done))
+        except:
+            put((False, sys.exc_info()))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            ok, item = queue.get()
+            if not ok:
+                raise item[0], item[1], item[2]
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
 
 def invert_dict(d):
     inverted = {}
@@ -54,10 +105,535 @@ def invert_dict(d):
     return inverted
 
 
+# The process that imported this module.  A worker process forked
+# from it inherits its database connections, which must not be shared.
+_db_pid = os.getpid()
+
+def _connect_worker(properties_file):
+    """
+    Prepare a worker process for querying the database: load the
+    properties file if the worker does not have them yet, and make
+    sure that the worker opens a database connection of its own
+    instead of using (or closing) one inherited from its parent.
+    """
+    global _db_pid
+    if properties_file and not cpa.properties.is_initialized():
+        cpa.properties.LoadFile(properties_file)
+    if _db_pid != os.getpid():
+        cpa.db.connections = {}
+        cpa.db.cursors = {}
+        cpa.db.connectionInfo = {}
+        _db_pid = os.getpid()
+
+def _split_by_image(rows, nkeycolumns, ncolumns, image_keys):
+    """
+    Split the result of an ordered query, whose rows are the image key
+    columns, the object id, and the features, into per-image feature
+    and object id arrays in the order of IMAGE_KEYS.  Images without
+    objects get empty arrays.
+    """
+    a = np.array(rows, dtype=float).reshape((len(rows), ncolumns))
+    ranges = {}
+    if len(a) > 0:
+        keys = a[:, :nkeycolumns].astype('i8')
+        starts = np.hstack(([0], np.nonzero(np.any(keys[1:] != keys[:-1], axis=1))[0] + 1))
+        stops = np.hstack((starts[1:], [len(a)]))
+        ranges = dict((tuple(keys[start]), (start, stop))
+                      for start, stop in zip(starts, stops))
+    features = []
+    cellids = []
+    for image_key in image_keys:
+        start, stop = ranges.get(tuple(map(int, image_key)), (0, 0))
+        features.append(a[start:stop, nkeycolumns + 1:])
+        cellids.append(a[start:stop, nkeycolumns].astype(int))
+    return features, cellids
+
+def _create_cache_plate((properties_file, cache_dir, plate, image_keys, resume)):
+    import cpa
+    from cpa.profiling.cache import Cache, _connect_worker
+    _connect_worker(properties_file)
+    Cache(cache_dir)._create_cache_plate(plate, image_keys, resume)
+    return plate
+
+def _update_cache_plate((properties_file, cache_dir, plate, image_keys, 
+                         changed_image_keys)):
+    import cpa
+    from cpa.profiling.cache import Cache, _connect_worker
+    _connect_worker(properties_file)
+    Cache(cache_dir)._update_cache_plate(plate, image_keys, changed_image_keys)
+    return plate
+
+
+class SummaryStatistics(object):
+    """
+    Count, mean, centered second moment (sum of squared deviations
+    from the mean), minimum and maximum per feature of a set of cells.
+    Statistics of disjoint sets of cells can be merged (with the
+    pairwise update of Chan et al., as ScatterMatrix), and the
+    statistics of affinely transformed data can be derived from those
+    of the original data.  Keeping the moment centered preserves the
+    precision of the variance of features with a large mean and a
+    small spread.
+    """
+
+    def __init__(self, count, means, m2, min, max):
+        self.count = count
+        self.means = means
+        self.m2 = m2
+        self.min = min
+        self.max = max
+
+    @classmethod
+    def from_data(cls, data):
+        """Return the statistics of the rows of DATA without NaNs."""
+        data = np.asarray(data, dtype=float)
+        data = data[~np.any(np.isnan(data), axis=1)]
+        if len(data) == 0:
+            ncols = data.shape[1]
+            return cls(0, np.zeros(ncols), np.zeros(ncols), 
+                       np.ones(ncols) * np.inf, np.ones(ncols) * -np.inf)
+        means = data.mean(axis=0)
+        deviations = data - means
+        return cls(len(data), means, (deviations * deviations).sum(axis=0),
+                   data.min(axis=0), data.max(axis=0))
+
+    @classmethod
+    def from_arrays(cls, count, means, m2, min, max):
+        """Return the merged statistics of the sets of cells whose
+        statistics are in the rows of the arrays (COUNT is a
+        vector)."""
+        count = np.asarray(count)
+        n = int(count.sum())
+        if n == 0:
+            ncols = means.shape[1]
+            return cls(0, np.zeros(ncols), np.zeros(ncols), 
+                       np.ones(ncols) * np.inf, np.ones(ncols) * -np.inf)
+        weights = count[:, np.newaxis] / float(n)
+        total_means = (weights * means).sum(axis=0)
+        deviations = means - total_means
+        return cls(n, total_means, 
+                   m2.sum(axis=0) + (count[:, np.newaxis] * deviations * deviations).sum(axis=0),
+                   min.min(axis=0), max.max(axis=0))
+
+    def merge(self, other):
+        count = self.count + other.count
+        if count == 0:
+            return self
+        delta = other.means - self.means
+        return SummaryStatistics(count, 
+                                 self.means + delta * other.count / float(count),
+                                 self.m2 + other.m2 + 
+                                 delta * delta * self.count * other.count / float(count),
+                                 np.minimum(self.min, other.min),
+                                 np.maximum(self.max, other.max))
+
+    @classmethod
+    def merge_all(cls, statistics):
+        return reduce(lambda a, b: a.merge(b), statistics)
+
+    def select(self, colmask):
+        return SummaryStatistics(self.count, self.means[colmask], 
+                                 self.m2[colmask], self.min[colmask],
+                                 self.max[colmask])
+
+    def affine(self, shift, scale):
+        """Return the statistics of (data - shift) / scale, for a
+        positive scale."""
+        return SummaryStatistics(self.count, (self.means - shift) / scale,
+                                 self.m2 / (scale * scale),
+                                 (self.min - shift) / scale,
+                                 (self.max - shift) / scale)
+
+    def mean(self):
+        if self.count == 0:
+            return self.means * np.nan
+        return self.means
+
+    def std(self):
+        if self.count == 0:
+            return self.m2 * np.nan
+        return np.sqrt(self.m2 / self.count)
+
+
+class QuantileSketch(object):
+    """
+    Mergeable summary of the distribution of each feature in a set of
+    cells: a set of weighted points per feature.  The sketch of n
+    cells consists of the n values themselves if n <= size, and
+    otherwise of the quantiles at the midpoints of size equal-mass
+    bins, each standing for n / size cells.  The rank of any value
+    among the points is therefore within n / size of its rank among
+    the cells.
+
+    Merged sketches are compacted in the same way once they have more
+    than 2 * size used points, so a sketch never grows beyond that.  Each
+    compaction can add another n / size to the rank error; merge_all
+    merges in a balanced tree, so that the error of a sketch of m
+    merged sketches is at most about (1 + log2(m)) n / size.
+
+    Unused points are NaN and have no weight.  Positive affine
+    transformations preserve the order, so the sketch of normalized
+    data follows from the sketch of the raw data.
+    """
+
+    def __init__(self, values, weights, size=None):
+        self.values = values
+        self.weights = weights
+        self.size = len(values) if size is None else size
+
+    @classmethod
+    def from_data(cls, data, size):
+        """Return the sketch of the rows of DATA without NaNs."""
+        data = data[~np.any(np.isnan(data), axis=1)]
+        n, ncols = data.shape
+        values = np.ones((size, ncols)) * np.nan
+        weights = np.zeros(size)
+        if n <= size:
+            values[:n] = np.sort(data, axis=0)
+            weights[:n] = 1
+        elif n > 0:
+            values[:] = np.percentile(data, 100. * (np.arange(size) + 0.5) / size, 
+                                      axis=0)
+            weights[:] = float(n) / size
+        return cls(values, weights)
+
+    @property
+    def count(self):
+        return self.weights.sum()
+
+    def merge(self, other):
+        merged = QuantileSketch(np.vstack((self.values, other.values)),
+                                np.hstack((self.weights, other.weights)),
+                                max(self.size, other.size))
+        used = merged.weights > 0
+        if used.sum() > 2 * merged.size:
+            merged = merged.compact()
+        elif len(used) > 2 * merged.size:
+            # Drop the unused points.
+            if used.sum() <= merged.size:
+                merged = merged.compact()
+            else:
+                merged = QuantileSketch(merged.values[used], merged.weights[used],
+                                        merged.size)
+        return merged
+
+    @classmethod
+    def merge_all(cls, sketches):
+        """Merge an iterable of sketches in a balanced binary tree,
+        keeping only one partial sketch per level in memory."""
+        levels = []
+        for sketch in sketches:
+            level = 0
+            while len(levels) > 0 and levels[-1][0] == level:
+                sketch = levels.pop()[1].merge(sketch)
+                level += 1
+            levels.append((level, sketch))
+        merged = None
+        for level, sketch in reversed(levels):
+            merged = sketch if merged is None else sketch.merge(merged)
+        return merged
+
+    def compact(self):
+        """Return a sketch of SIZE points: the used points if there
+        are at most SIZE, and otherwise the quantiles at the midpoints
+        of SIZE equal-mass bins of the points."""
+        used = self.weights > 0
+        if used.sum() <= self.size:
+            values = np.ones((self.size, self.values.shape[1])) * np.nan
+            weights = np.zeros(self.size)
+            values[:used.sum()] = self.values[used]
+            weights[:used.sum()] = self.weights[used]
+            return QuantileSketch(values, weights, self.size)
+        count = self.count
+        return QuantileSketch(self.quantiles((np.arange(self.size) + 0.5) / self.size),
+                              np.ones(self.size) * count / self.size, self.size)
+
+    def select(self, colmask):
+        return QuantileSketch(self.values[:, colmask], self.weights, self.size)
+
+    def affine(self, shift, scale):
+        """Return the sketch of (data - shift) / scale, for a positive
+        scale."""
+        return QuantileSketch((self.values - shift) / scale, self.weights, self.size)
+
+    def quantiles(self, qs):
+        """Return an array with one row per quantile in QS (fractions
+        between 0 and 1) and one column per feature."""
+        cols = np.arange(self.values.shape[1])
+        order = np.argsort(self.values, axis=0)
+        values = self.values[order, cols]
+        weights = np.where(np.isnan(self.values), 0, 
+                           self.weights[:, np.newaxis])[order, cols]
+        cumulative = np.cumsum(weights, axis=0)
+        total = cumulative[-1]
+        return np.array([values[np.minimum((cumulative < q * total).sum(axis=0),
+                                           len(values) - 1), cols]
+                         for q in qs])
+
+    def median(self):
+        return self.quantiles([0.5])[0]
+
+    def mad(self, center):
+        """Return the median absolute deviation from CENTER."""
+        return QuantileSketch(np.fabs(self.values - center), self.weights, 
+                              self.size).median()
+
+
+class CompressedFeatures(object):
+    """
+    Read-only feature array of a compressed plate store
+    (features.npz), stored as independently compressed chunks of
+    CHUNK_ROWS rows.  Indexing with a slice or an array of row
+    numbers decompresses only the chunks that hold those rows; the
+    most recently used chunks are kept in memory.  Stores written
+    before the chunked layout hold a single array, which is read
+    entirely.
+    """
+
+    # Number of decompressed chunks kept in memory.
+    max_cached_chunks = 4
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._cached_chunks = OrderedDict()
+        with open(filename, 'rb') as f:
+            raw = np.load(f)
+            if 'layout' in raw.files:
+                nrows, ncols, self.chunk_rows = raw['layout'].tolist()
+                self.dtype = raw['template'].dtype
+            else:
+                features = raw['features']
+                nrows, ncols = features.shape
+                self.dtype = features.dtype
+                self.chunk_rows = max(nrows, 1)
+                self._cached_chunks[0] = features
+        self.shape = (nrows, ncols)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @staticmethod
+    def write(f, features, chunk_rows):
+        chunks = dict(('chunk%d' % i, features[start:start + chunk_rows])
+                      for i, start in enumerate(xrange(0, len(features), chunk_rows)))
+        np.savez_compressed(f, layout=np.array(features.shape + (chunk_rows,), dtype='i8'),
+                            template=features[:0], **chunks)
+
+    def _chunk(self, i):
+        try:
+            chunk = self._cached_chunks.pop(i)
+        except KeyError:
+            with open(self.filename, 'rb') as f:
+                chunk = np.load(f)['chunk%d' % i]
+            if len(self._cached_chunks) >= self.max_cached_chunks:
+                self._cached_chunks.popitem(last=False)
+        self._cached_chunks[i] = chunk
+        return chunk
+
+    def __getitem__(self, rows):
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(len(self))
+            assert step == 1
+            if stop <= start:
+                return np.zeros((0, self.shape[1]), dtype=self.dtype)
+            first, last = start // self.chunk_rows, (stop - 1) // self.chunk_rows
+            pieces = [self._chunk(i) for i in range(first, last + 1)]
+            offset = first * self.chunk_rows
+            if len(pieces) == 1:
+                return pieces[0][start - offset:stop - offset]
+            return np.vstack(pieces)[start - offset:stop - offset]
+        rows = np.asarray(rows)
+        result = np.empty((len(rows), self.shape[1]), dtype=self.dtype)
+        chunk_of_row = rows // self.chunk_rows
+        for i in np.unique(chunk_of_row):
+            mask = chunk_of_row == i
+            result[mask] = self._chunk(i)[rows[mask] - i * self.chunk_rows]
+        return result
+
+
+class PlateStore(object):
+    """
+    All the per-cell features of one plate, stored as a single
+    contiguous array (features.npy) together with the object ids
+    (cellids.npy) and an index (index.npy) with one row per image:
+    the image key columns followed by the start and stop offsets of
+    the image's rows in the feature array.  The per-image summary
+    statistics of the rows without NaNs are stored in stats.npz.
+
+    The feature array is memory-mapped, so slicing it does not read
+    or copy anything until the data is used.  Compressed stores keep
+    the features in chunks that are decompressed on demand (see
+    CompressedFeatures).
+    """
+
+    # Rows per independently compressed chunk of a compressed store.
+    chunk_rows = 4096
+
+    def __init__(self, features, cellids, index, plate_dir=None):
+        self.features = features
+        self.cellids = cellids
+        self.offsets = dict((tuple(row[:-2]), (row[-2], row[-1]))
+                            for row in index.tolist())
+        self.positions = dict((tuple(row[:-2]), i)
+                              for i, row in enumerate(index.tolist()))
+        self.plate_dir = plate_dir
+        self._cached_summaries = {}
+
+    def _summary(self, name):
+        """Return the arrays of the per-image summary file NAME.npz as
+        a dictionary, or None if the plate does not have one."""
+        if name not in self._cached_summaries:
+            filename = os.path.join(self.plate_dir or '', name + '.npz')
+            if self.plate_dir is None or not os.path.exists(filename):
+                self._cached_summaries[name] = None
+            else:
+                with open(filename, 'rb') as f:
+                    raw = np.load(f)
+                    self._cached_summaries[name] = dict((k, raw[k]) for k in raw.files)
+        return self._cached_summaries[name]
+
+    def stats(self, image_keys):
+        """Return the merged SummaryStatistics of the images, or None
+        if the plate has no statistics."""
+        s = self._summary('stats')
+        if s is None:
+            return None
+        rows = [self.positions[tuple(image_key)] for image_key in image_keys]
+        count = s['count'][rows]
+        if 'm2' in s:
+            means, m2 = s['mean'][rows], s['m2'][rows]
+        else:
+            # Stores written before the centered moments were kept.
+            n = np.maximum(count, 1)[:, np.newaxis]
+            means = s['sum'][rows] / n
+            m2 = np.maximum(s['sumsq'][rows] - n * means * means, 0)
+        return SummaryStatistics.from_arrays(count, means, m2, s['min'][rows],
+                                             s['max'][rows])
+
+    def sketch(self, image_keys):
+        """Return the merged QuantileSketch of the images, or None if
+        the plate has no sketches."""
+        s = self._summary('sketch')
+        if s is None:
+            return None
+        rows = [self.positions[tuple(image_key)] for image_key in image_keys]
+        return QuantileSketch.merge_all(QuantileSketch(s['values'][row], s['weights'][row])
+                                        for row in rows)
+
+    @staticmethod
+    def filename(plate_dir, name):
+        return os.path.join(plate_dir, name + '.npy')
+
+    @classmethod
+    def exists(cls, plate_dir):
+        return os.path.exists(cls.filename(plate_dir, 'index'))
+
+    @classmethod
+    def open(cls, plate_dir):
+        compressed_filename = os.path.join(plate_dir, 'features.npz')
+        if os.path.exists(compressed_filename):
+            features = CompressedFeatures(compressed_filename)
+        else:
+            features = np.load(cls.filename(plate_dir, 'features'), mmap_mode='r')
+        cellids_filename = cls.filename(plate_dir, 'cellids')
+        if os.path.exists(cellids_filename):
+            cellids = np_load(cellids_filename)
+        else:
+            # Converted from old .npy feature files without object ids.
+            cellids = None
+        return cls(features, cellids, np_load(cls.filename(plate_dir, 'index')),
+                   plate_dir)
+
+    @classmethod
+    def write(cls, plate_dir, image_keys, features, cellids, sketch_size=None,
+              dtype=float, compress=False):
+        """
+        Write a plate store from lists of per-image feature arrays and
+        object id arrays (or None if the object ids are not known).
+        If SKETCH_SIZE is given, also write a QuantileSketch of that
+        size for each image.
+
+        The features are stored as DTYPE; the statistics and sketches
+        are computed from the stored values.  If COMPRESS is true,
+        the features are stored in a compressed features.npz instead
+        of features.npy, in chunks of CHUNK_ROWS rows that are
+        decompressed as they are accessed.
+
+        The index is written last, so a plate store is only
+        considered to exist once all of its files are complete.
+        """
+        features = [np.asarray(f, dtype=dtype) for f in features]
+        counts = [len(f) for f in features]
+        stops = np.cumsum(counts)
+        index = np.array([tuple(image_key) + (stop - count, stop)
+                          for image_key, count, stop
+                          in zip(image_keys, counts, stops)], dtype='i8')
+        ncols = max([f.shape[1] for f in features if f.ndim == 2] or [0])
+        stacked = np.vstack([f for f in features if len(f) > 0] or
+                            [np.zeros((0, ncols), dtype=dtype)])
+        uncompressed_filename = cls.filename(plate_dir, 'features')
+        compressed_filename = os.path.join(plate_dir, 'features.npz')
+        if compress:
+            with cpa.util.replace_atomically(compressed_filename) as f:
+                CompressedFeatures.write(f, stacked, cls.chunk_rows)
+            if os.path.exists(uncompressed_filename):
+                os.unlink(uncompressed_filename)
+        else:
+            with cpa.util.replace_atomically(uncompressed_filename) as f:
+                np.save(f, stacked)
+            if os.path.exists(compressed_filename):
+                os.unlink(compressed_filename)
+        if cellids is not None:
+            with cpa.util.replace_atomically(cls.filename(plate_dir, 'cellids')) as f:
+                np.save(f, np.hstack([np.atleast_1d(c) for c in cellids] or
+                                     [np.zeros(0)]).astype(int))
+        elif os.path.exists(cls.filename(plate_dir, 'cellids')):
+            os.unlink(cls.filename(plate_dir, 'cellids'))
+        stats = [SummaryStatistics.from_data(f.reshape((len(f), ncols)))
+                 for f in features]
+        with cpa.util.replace_atomically(os.path.join(plate_dir, 'stats.npz')) as f:
+            np.savez(f, count=np.array([s.count for s in stats], dtype='i8'),
+                     mean=np.array([s.means for s in stats]).reshape((len(stats), ncols)),
+                     m2=np.array([s.m2 for s in stats]).reshape((len(stats), ncols)),
+                     min=np.array([s.min for s in stats]).reshape((len(stats), ncols)),
+                     max=np.array([s.max for s in stats]).reshape((len(stats), ncols)))
+        sketch_filename = os.path.join(plate_dir, 'sketch.npz')
+        if sketch_size:
+            sketches = [QuantileSketch.from_data(f.reshape((len(f), ncols)), sketch_size)
+                        for f in features]
+            with cpa.util.replace_atomically(sketch_filename) as f:
+                np.savez(f, values=np.array([s.values for s in sketches]).reshape((len(sketches), sketch_size, ncols)),
+                         weights=np.array([s.weights for s in sketches]).reshape((len(sketches), sketch_size)))
+        elif os.path.exists(sketch_filename):
+            os.unlink(sketch_filename)
+        with cpa.util.replace_atomically(cls.filename(plate_dir, 'index')) as f:
+            np.save(f, index)
+
+    def rows(self, image_keys):
+        """
+        Return the features and object ids (or None) of the images.
+        If the images occupy one contiguous range of the plate, the
+        result is a memory-mapped view; otherwise the rows are
+        gathered into a single copy.
+        """
+        ranges = sorted(self.offsets[tuple(image_key)]
+                        for image_key in image_keys)
+        if all(a[1] == b[0] for a, b in zip(ranges[:-1], ranges[1:])):
+            rows = slice(ranges[0][0], ranges[-1][1])
+        else:
+            rows = np.hstack([np.arange(start, stop, dtype='i8')
+                              for start, stop in ranges])
+        features = self.features[rows]
+        cellids = None if self.cellids is None else self.cellids[rows]
+        return features, cellids
+
 
 class Cache(object):
+    # Number of plate stores kept open.
+    max_cached_plates = 100
     _cached_plate_map = None
     _cached_colnames = None
+    _cached_settings = None
 
     def __init__(self, cache_dir):
         self.cache_dir = cache_dir
@@ -65,6 +641,13 @@ class Cache(object):
                                                 'image_to_plate.pickle')
         self._colnames_filename = os.path.join(self.cache_dir, 'colnames.txt')
         self._counts_filename = os.path.join(self.cache_dir, 'counts.npy')
+        self._manifest_filename = os.path.join(self.cache_dir, 'manifest.npy')
+        self._settings_filename = os.path.join(self.cache_dir, 'settings.json')
+        self._plate_stores = OrderedDict()
+        self._normalizers = {}
+
+    def _plate_dir(self, plate):
+        return os.path.join(self.cache_dir, unicode(plate))
 
     def _image_filename(self, plate, imKey):
         return os.path.join(self.cache_dir, unicode(plate),
@@ -75,96 +658,317 @@ class Cache(object):
         return os.path.join(self.cache_dir, unicode(plate),
                             u'-'.join(map(unicode, imKey)) + '.npy')
     @property
+    def settings(self):
+        """Settings chosen when the cache was created (see
+        _create_cache_settings)."""
+        if self._cached_settings is None:
+            if os.path.exists(self._settings_filename):
+                with open(self._settings_filename) as f:
+                    self._cached_settings = json.load(f)
+            else:
+                self._cached_settings = {}
+        return self._cached_settings
+
+    @property
+    def _dtype(self):
+        # Caches created before the setting existed store float64.
+        return np.dtype(str(self.settings.get('dtype', 'float64')))
+
+    @property
+    def _compress(self):
+        return bool(self.settings.get('compress', False))
+
+    def _write_plate_store(self, plate_dir, image_keys, features, cellids):
+        PlateStore.write(plate_dir, image_keys, features, cellids,
+                         self._sketch_size, self._dtype, self._compress)
+
+    @property
+    def _sketch_size(self):
+        sketch_error = self.settings.get('sketch_error')
+        return int(np.ceil(1.0 / sketch_error)) if sketch_error else None
+
+    @property
     def _plate_map(self):
         if self._cached_plate_map is None:
             self._cached_plate_map = cpa.util.unpickle1(self._plate_map_filename)
         return self._cached_plate_map
 
+    def _plate_store(self, plate):
+        """Return the PlateStore of the plate, or None if the plate is
+        stored as one feature file per image.  The stores of the most
+        recently used plates are kept open."""
+        try:
+            plate_store = self._plate_stores.pop(plate)
+        except KeyError:
+            plate_dir = self._plate_dir(plate)
+            if PlateStore.exists(plate_dir):
+                plate_store = PlateStore.open(plate_dir)
+            else:
+                plate_store = None
+            if len(self._plate_stores) >= self.max_cached_plates:
+                self._plate_stores.popitem(last=False)
+        self._plate_stores[plate] = plate_store
+        return plate_store
+
+    def storage_order(self, image_keys):
+        """
+        Return the image keys sorted by plate and, within the plates
+        stored in the per-plate layout, by the position of their
+        cells, so that loading them in turn reads each plate once,
+        sequentially.
+        """
+        def key(image_key):
+            plate = self._plate_map[image_key]
+            plate_store = self._plate_store(plate)
+            offset = None if plate_store is None else plate_store.offsets[tuple(image_key)]
+            return plate, offset
+        return sorted(image_keys, key=key)
+
+    def _normalizer(self, normalization):
+        """
+        Return the normalizer for a normalization class.  One
+        instance per class is reused, so that the normalization
+        parameters it has read stay cached across calls to load().
+        """
+        if normalization not in self._normalizers:
+            self._normalizers[normalization] = normalization(self)
+        return self._normalizers[normalization]
+
     def load_objects(self, object_keys, normalization=DummyNormalization, removeRowsWithNaN=True):
-        objects_by_image = {}
-        for object_key in object_keys:
-            objects_by_image.setdefault(object_key[:-1], []).append(object_key[-1])
-        results = {}
-        for image_key, cell_ids in objects_by_image.items():
-            stackedfeatures, colnames, stackedcellids = self.load([image_key], normalization, removeRowsWithNaN)
-            stackedcellids = list(stackedcellids)
-            for cell_id in cell_ids:
-                index = stackedcellids.index(cell_id)
-                fv = stackedfeatures[index, :]
-                object_key = tuple(list(image_key) + [cell_id])
-                results[object_key] = fv
-        return np.array([results[object_key] for object_key in object_keys])
-
-    def load(self, image_keys, normalization=DummyNormalization, removeRowsWithNaN=True):
+        """
+        Return the features of the objects as a matrix with one row
+        per object key, in the order of OBJECT_KEYS.  Each image is
+        loaded once, plate by plate, and the object ids are looked up
+        by binary search.  Raise ValueError if an object is not in the
+        cache (or was removed because of NaN values).
+        """
+        normalizer = self._normalizer(normalization)
+        if len(object_keys) == 0:
+            return np.zeros((0, len(normalizer.colnames)))
+        object_keys = np.array(object_keys, dtype='i8')
+        image_columns = object_keys[:, :-1]
+        order = np.lexsort(image_columns.T[::-1])
+        boundaries = np.nonzero(np.any(image_columns[order][1:] != 
+                                       image_columns[order][:-1], axis=1))[0] + 1
+        requests = [(tuple(image_columns[indices[0]].tolist()), indices)
+                    for indices in np.split(order, boundaries) if len(indices) > 0]
+        requests.sort(key=lambda (image_key, indices): self._plate_map[image_key])
+
+        result = np.empty((len(object_keys), len(normalizer.colnames)))
+        for image_key, indices in requests:
+            features, colnames, cellids = self._load([image_key], normalizer, 
+                                                     removeRowsWithNaN)
+            if cellids is None:
+                raise ValueError('Object ids are not stored for image %r' % (image_key,))
+            wanted = object_keys[indices, -1]
+            sorter = np.argsort(cellids, kind='mergesort')
+            sorted_cellids = cellids[sorter]
+            positions = np.searchsorted(sorted_cellids, wanted)
+            found = positions < len(sorted_cellids)
+            found[found] = sorted_cellids[positions[found]] == wanted[found]
+            if not np.all(found):
+                raise ValueError('Object %r is not in the cache' % 
+                                 (image_key + (int(wanted[~found][0]),),))
+            result[indices] = features[sorter[positions]]
+        return result
+
+    def _load_image_files(self, plate, imKeys):
+        """Load the features and object ids of images stored as one
+        file per image.  The object ids are None if any of the images
+        was stored in the old .npy format."""
+        features = []
+        cellids = []
+        for imKey in imKeys:
+            filename = self._image_filename(plate, imKey)
+            if not os.path.exists(filename):
+                filename = self._image_filename_backward_compatible(plate, imKey)
+            # Work around bug in numpy that causes file
+            # handles to be left open.
+            with open(filename, 'rb') as file:
+                raw = np.load(file)
+                if filename.endswith('.npy'):
+                    features.append(np.array(raw, dtype=float))
+                    cellids = None
+                else:
+                    features.append(np.array(raw["features"], dtype=float))
+                    if cellids is not None:
+                        cellids.append(np.atleast_1d(np.array(raw["cellids"], dtype=int)))
+        features = [f for f in features if len(f) > 0]
+        if len(features) == 0:
+            return np.zeros((0, len(self.colnames))), np.array([], dtype=int)
+        if cellids is not None:
+            cellids = np.hstack(cellids)
+        return np.vstack(features), cellids
+
+    def load(self, image_keys, normalization=DummyNormalization, removeRowsWithNaN=True,
+             dtype=float):
         """Load the raw features of all the cells in a particular well and
-        return them as a ncells x nfeatures numpy array."""
-        normalizer = normalization(self)
+        return them as a ncells x nfeatures numpy array.
+
+        The features are converted to DTYPE.  With dtype=None they
+        keep the dtype they are stored in (see the dtype setting),
+        which avoids a converted copy of float32 caches.
+
+        Plates stored in the contiguous per-plate layout are read
+        through a memory map, so the unnormalized features of a
+        contiguous range of images are returned without copying.
+        Within a plate, the rows are returned in storage order.
+        """
+        return self._load(image_keys, self._normalizer(normalization), 
+                          removeRowsWithNaN, dtype)
+
+    def _load(self, image_keys, normalizer, removeRowsWithNaN=True, dtype=float):
         images_per_plate = {}
         for imKey in image_keys:
             images_per_plate.setdefault(self._plate_map[imKey], []).append(imKey)
 
-        # check if cellids have been stored
-        plate, imKeys = images_per_plate.items()[0]
-        imf_old = self._image_filename_backward_compatible(plate, imKey)
-        imf_new = self._image_filename(plate, imKey)
-        if os.path.exists(imf_old) and os.path.exists(imf_new):
-            logger.warning('Both new and old feature files found : %s and %s. Using new feature file %s.' \
-                           % (imf_new, imf_old, imf_new))
-            flag_bkwd = False
-        else:
-            flag_bkwd = os.path.exists(imf_old)
-        
-        _image_filename = self._image_filename_backward_compatible if flag_bkwd else \
-            self._image_filename
-
         features = []
         cellids = []
+        has_cellids = True
 
         for plate, imKeys in images_per_plate.items():
-            for imKey in imKeys:
-                # Work around bug in numpy that causes file
-                # handles to be left open.
-                with open(_image_filename(plate, imKey), 'rb') as file:
-                    raw = np.load(file)
-                    if flag_bkwd:
-                        _features = np.array(raw, dtype=float)
-                    else:
-                        _features = np.array(raw["features"], dtype=float)
-                        _cellids = np.array(raw["cellids"], dtype=int)
-
-                #import pdb
-                #pdb.set_trace()
-
-                if removeRowsWithNaN and len(_features) > 0:
-                    prune_rows = np.any(np.isnan(_features),axis=1)
-                    _features = _features[-prune_rows,:]
-                    if not flag_bkwd:
-                        if _cellids.shape != ():
-                            _cellids = _cellids[-prune_rows]
-                        else:
-                            # This is redundant but put in here
-                            # for sake of completeness
-                            if prune_rows[0]:
-                                _cellids = np.array([])
-
-                if len(_features) > 0:
-                    features.append(normalizer.normalize(plate, _features))
-                    if not flag_bkwd:
-                        cellids.append(_cellids)
-
-            if(len(features) > 0):
-                stackedfeatures = np.vstack(features)
-                if not flag_bkwd:
-                    stackedcellids = np.squeeze(np.hstack(cellids))
+            plate_store = self._plate_store(plate)
+            if plate_store is None:
+                _features, _cellids = self._load_image_files(plate, imKeys)
             else:
-                stackedfeatures = np.array([])
-                if not flag_bkwd:
-                    stackedcellids = np.array([])
+                _features, _cellids = plate_store.rows(imKeys)
+            if dtype is not None and _features.dtype != dtype:
+                _features = _features.astype(dtype)
+            has_cellids = has_cellids and _cellids is not None
+
+            if removeRowsWithNaN and len(_features) > 0:
+                prune_rows = np.any(np.isnan(_features), axis=1)
+                if np.any(prune_rows):
+                    _features = _features[~prune_rows]
+                    if _cellids is not None:
+                        _cellids = _cellids[~prune_rows]
+
+            if len(_features) > 0:
+                features.append(normalizer.normalize(plate, _features))
+                cellids.append(_cellids)
+
+        if len(features) == 1:
+            stackedfeatures = features[0]
+            stackedcellids = cellids[0]
+        elif len(features) > 1:
+            stackedfeatures = np.vstack(features)
+            if has_cellids:
+                stackedcellids = np.hstack(cellids)
+        else:
+            stackedfeatures = np.array([])
+            stackedcellids = np.array([])
             
-        if flag_bkwd:
+        if not has_cellids:
             stackedcellids = None
         return stackedfeatures, normalizer.colnames, stackedcellids
 
+    def _load_summary(self, image_keys, normalization, load, normalize):
+        """
+        Return the merged per-image summaries of the images for a
+        normalization, or None if not available.  LOAD(plate_store,
+        image_keys) returns the summary of images on a plate and
+        NORMALIZE(normalizer, plate, summary) normalizes it.
+        """
+        normalizer = self._normalizer(normalization)
+        images_per_plate = {}
+        for imKey in image_keys:
+            images_per_plate.setdefault(self._plate_map[imKey], []).append(imKey)
+        summaries = []
+        for plate, imKeys in images_per_plate.items():
+            plate_store = self._plate_store(plate)
+            summary = None if plate_store is None else load(plate_store, imKeys)
+            if summary is None:
+                return None
+            try:
+                summaries.append(normalize(normalizer, plate, summary))
+            except NotImplementedError:
+                return None
+        if len(summaries) == 0:
+            return None
+        return summaries[0].merge_all(summaries)
+
+    def load_stats(self, image_keys, normalization=DummyNormalization):
+        """
+        Return the SummaryStatistics of the normalized features of the
+        cells of the images (the rows without NaNs, as returned by
+        load()), computed from the per-image statistics without
+        loading any cells.  Return None if the statistics are not
+        available, i.e., if a plate is not stored in the per-plate
+        layout or the normalization is not affine.
+        """
+        return self._load_summary(image_keys, normalization,
+                                  lambda store, imKeys: store.stats(imKeys),
+                                  lambda n, plate, stats: n.normalize_stats(plate, stats))
+
+    def load_sketch(self, image_keys, normalization=DummyNormalization):
+        """
+        Return the merged QuantileSketch of the normalized features of
+        the cells of the images, or None if the cache was built
+        without sketches or the normalization is not affine.
+        """
+        return self._load_summary(image_keys, normalization,
+                                  lambda store, imKeys: store.sketch(imKeys),
+                                  lambda n, plate, sketch: n.normalize_sketch(plate, sketch))
+
+    def iter_batches(self, image_keys, normalization=DummyNormalization,
+                     batch_rows=10000, removeRowsWithNaN=True, readahead=0,
+                     in_storage_order=True):
+        """
+        Iterate over the cells of the images in blocks of BATCH_ROWS
+        rows (the last block may be smaller), regardless of image
+        boundaries.  Yield (features, object_keys) pairs, where
+        object_keys has the image key columns followed by the object
+        id, or is None if the cache does not store object ids.
+
+        Only one image and one block are held in memory at a time.
+        The images are visited in storage order (see storage_order),
+        so each plate's features are read sequentially, unless
+        IN_STORAGE_ORDER is false, e.g. for images in a random order;
+        each image is still read sequentially.  If READAHEAD is
+        positive, up to that many images are loaded ahead on a
+        background thread while the caller processes the current block.
+        """
+        normalizer = self._normalizer(normalization)
+        if in_storage_order:
+            image_keys = self.storage_order(image_keys)
+
+        def load_images():
+            for image_key in image_keys:
+                features, colnames, cellids = self._load([image_key], normalizer, 
+                                                         removeRowsWithNaN)
+                if len(features) == 0:
+                    continue
+                if cellids is None:
+                    object_keys = None
+                else:
+                    object_keys = np.column_stack((np.tile(np.array(image_key, dtype='i8'),
+                                                           (len(cellids), 1)),
+                                                   cellids))
+                yield features, object_keys
+
+        images = _readahead(load_images(), readahead) if readahead > 0 else load_images()
+        pending_features = []
+        pending_keys = []
+        npending = 0
+        for features, object_keys in images:
+            pending_features.append(features)
+            pending_keys.append(object_keys)
+            npending += len(features)
+            if npending < batch_rows:
+                continue
+            features = np.vstack(pending_features)
+            object_keys = None if any(k is None for k in pending_keys) else np.vstack(pending_keys)
+            nbatched = npending - npending % batch_rows
+            for start in xrange(0, nbatched, batch_rows):
+                yield (features[start:start + batch_rows],
+                       None if object_keys is None else object_keys[start:start + batch_rows])
+            pending_features = [features[nbatched:]]
+            pending_keys = [None if object_keys is None else object_keys[nbatched:]]
+            npending -= nbatched
+        if npending > 0:
+            yield (np.vstack(pending_features),
+                   None if any(k is None for k in pending_keys) else np.vstack(pending_keys))
+
     @property
     def colnames(self):
         if self._cached_colnames is None:
@@ -187,16 +991,47 @@ class Cache(object):
         a = np.load(self._counts_filename)
         return dict((tuple(row[:-1]), row[-1]) for row in a)
 
+    def get_manifest(self):
+        """
+        Return a dictionary mapping each image key to the object count
+        and the maximum object id of the image at the time it was
+        cached, or None if the cache has no manifest.  As for the
+        counts, images with zero objects are not included.
+        """
+        if not os.path.exists(self._manifest_filename):
+            return None
+        a = np_load(self._manifest_filename)
+        return dict((tuple(row[:-2]), tuple(row[-2:])) for row in a.tolist())
+
 
     #
     # Methods to create the cache
     #
 
-    def _create_cache(self, resume=False):
+    def _create_cache(self, resume=False, parallel=None, sketch_error=None,
+                      dtype='float32', compress=False):
+        self._create_cache_settings(resume, sketch_error, dtype, compress)
         self._create_cache_colnames(resume)
         self._create_cache_plate_map(resume)
-        self._create_cache_features(resume)
+        # The manifest must not be newer than the features.
         self._create_cache_counts(resume)
+        self._create_cache_features(resume, parallel)
+
+    def _create_cache_settings(self, resume, sketch_error=None, dtype='float32',
+                               compress=False):
+        """
+        Create the settings file.  SKETCH_ERROR is the rank error of
+        the per-image quantile sketches, or None to build no sketches.
+        DTYPE is the type the features are stored as, and COMPRESS
+        whether the per-plate feature files are compressed.
+        """
+        if resume and os.path.exists(self._settings_filename):
+            return
+        self._cached_settings = dict(sketch_error=sketch_error, 
+                                     dtype=np.dtype(dtype).name,
+                                     compress=compress)
+        with cpa.util.replace_atomically(self._settings_filename) as f:
+            json.dump(self._cached_settings, f)
 
     def _create_cache_colnames(self, resume):
         """Create cache of column names"""
@@ -211,46 +1046,194 @@ class Cache(object):
         """Create cache of map from image key to plate name"""
         if resume and os.path.exists(self._plate_map_filename):
             return
-        self._cached_plate_map = dict((tuple(row[1:]), row[0])
-                                      for row in cpa.db.execute('select distinct %s, %s from %s'%
-                                                                (cpa.properties.plate_id, 
-                                                                 ', '.join(cpa.dbconnect.image_key_columns()),
-                                                                 cpa.properties.image_table)))
+        self._cached_plate_map = self._query_plate_map()
         cpa.util.pickle(self._plate_map_filename, self._cached_plate_map)
 
-    def _create_cache_features(self, resume):
-        nimages = len(self._plate_map)
-        for plate, image_keys in make_progress_bar('Features')(invert_dict(self._plate_map).items()):
-            plate_dir = os.path.dirname(self._image_filename(plate, image_keys[0]))
-            if not os.path.exists(plate_dir):
-                os.mkdir(plate_dir)
-            for image_key in image_keys:
-                self._create_cache_image(plate, image_key, resume)
-                
-    def _create_cache_image(self, plate, image_key, resume=False):
-        filename = self._image_filename(plate, image_key)
-        if resume and os.path.exists(filename):
+    def _query_plate_map(self):
+        return dict((tuple(row[1:]), row[0])
+                    for row in cpa.db.execute('select distinct %s, %s from %s'%
+                                              (cpa.properties.plate_id, 
+                                               ', '.join(cpa.dbconnect.image_key_columns()),
+                                               cpa.properties.image_table)))
+
+    def _create_cache_features(self, resume, parallel=None):
+        """
+        Create the per-plate feature stores, one task per plate.  When
+        resuming, plates whose feature store is complete are skipped.
+        """
+        parallel = parallel or Uniprocessing()
+        properties_file = cpa.properties.__dict__.get('_filename')
+        parameters = [(properties_file, self.cache_dir, plate, image_keys, resume)
+                      for plate, image_keys in invert_dict(self._plate_map).items()
+                      if not (resume and PlateStore.exists(self._plate_dir(plate)))]
+        results = parallel.view('cache.features').imap(_create_cache_plate, parameters)
+        for plate in make_progress_bar('Features', len(parameters))(results):
+            pass
+
+    def _create_cache_plate(self, plate, image_keys, resume=False):
+        """
+        Fetch the object ids and features of all the objects on the
+        plate in one query, ordered by image, and store them as the
+        plate's feature store.
+        """
+        plate_dir = self._plate_dir(plate)
+        if resume and PlateStore.exists(plate_dir):
             return
-        features = cpa.db.execute("""select %s from %s where %s""" % (
-                ','.join(self.colnames), cpa.properties.object_table, 
-                cpa.dbconnect.GetWhereClauseForImages([image_key])))
-        cellids  = cpa.db.execute("""select %s from %s where %s""" % (
-                cpa.properties.object_id, cpa.properties.object_table, 
-                cpa.dbconnect.GetWhereClauseForImages([image_key])))
-        np.savez(filename, features=np.array(features, dtype=float), cellids=np.squeeze(np.array(cellids)))
+        if not os.path.exists(plate_dir):
+            os.mkdir(plate_dir)
+        features, cellids = self._query_objects(image_keys)
+        self._write_plate_store(plate_dir, image_keys, features, cellids)
+
+    def _query_objects(self, image_keys):
+        """
+        Return lists of per-image feature and object id arrays for
+        the images, fetched with a single query.
+        """
+        key_columns = cpa.dbconnect.image_key_columns()
+        rows = cpa.db.execute("""select %s, %s, %s from %s where %s order by %s, %s""" % (
+                ','.join(key_columns), cpa.properties.object_id, 
+                ','.join(self.colnames), cpa.properties.object_table,
+                cpa.dbconnect.GetWhereClauseForImages(list(image_keys)),
+                ','.join(key_columns), cpa.properties.object_id))
+        return _split_by_image(rows, len(key_columns),
+                               len(key_columns) + 1 + len(self.colnames),
+                               image_keys)
+
+    def convert(self, remove_image_files=False):
+        """
+        Migrate a cache directory from one feature file per image to
+        the contiguous per-plate layout.  Plates that have already
+        been converted are skipped, so an interrupted conversion can
+        simply be restarted.
+        """
+        for plate, image_keys in make_progress_bar('Converting')(invert_dict(self._plate_map).items()):
+            plate_dir = self._plate_dir(plate)
+            if PlateStore.exists(plate_dir):
+                continue
+            features = []
+            cellids = []
+            for image_key in image_keys:
+                _features, _cellids = self._load_image_files(plate, [image_key])
+                features.append(_features)
+                if cellids is not None and _cellids is not None:
+                    cellids.append(_cellids)
+                else:
+                    cellids = None
+            self._write_plate_store(plate_dir, image_keys, features, cellids)
+            self._plate_stores.pop(plate, None)
+            if remove_image_files:
+                for image_key in image_keys:
+                    for filename in [self._image_filename(plate, image_key),
+                                     self._image_filename_backward_compatible(plate, image_key)]:
+                        if os.path.exists(filename):
+                            os.unlink(filename)
 
     def _create_cache_counts(self, resume):
         """
+        Create the cache of object counts and the manifest.
+
         Does not create a key for images with zero objects
         """
-        if resume and os.path.exists(self._counts_filename):
+        if resume and os.path.exists(self._counts_filename) and \
+                os.path.exists(self._manifest_filename):
             return
-        result = cpa.db.execute("""select {0}, count(*) from {1} group by {0}""".format(
-                cpa.dbconnect.UniqueImageClause(), 
+        self._write_manifest(self._query_manifest())
+
+    def _query_manifest(self):
+        """
+        Return an array with one row per image with objects: the image
+        key columns, the number of objects, and the maximum object id.
+        The last two serve as a cheap fingerprint of the image's rows
+        in the object table.
+        """
+        result = cpa.db.execute("""select {0}, count(*), max({1}) from {2} group by {0}""".format(
+                cpa.dbconnect.UniqueImageClause(), cpa.properties.object_id,
                 cpa.properties.object_table))
-        counts = np.array(result, dtype='i4')
+        nkeycolumns = len(cpa.dbconnect.image_key_columns())
+        return np.array(result, dtype='i8').reshape((len(result), nkeycolumns + 2))
+
+    def _write_manifest(self, manifest):
         with cpa.util.replace_atomically(self._counts_filename) as f:
-            np.save(f, counts)
+            np.save(f, manifest[:, :-1].astype('i4'))
+        with cpa.util.replace_atomically(self._manifest_filename) as f:
+            np.save(f, manifest)
+
+    #
+    # Methods to update the cache
+    #
+
+    def _update_cache(self, parallel=None):
+        """
+        Bring the cache up to date with the database after images or
+        objects have been added or changed.  Only the plates that have
+        new, removed, or changed images are rewritten, and within such
+        a plate only the new or changed images are queried.  Return
+        the names of the plates that were rewritten.
+        """
+        parallel = parallel or Uniprocessing()
+        old_manifest = self.get_manifest()
+        if old_manifest is None:
+            logger.warning('No manifest found in %s; rebuilding all plates' % self.cache_dir)
+            old_manifest = {}
+        old_plate_map = self._plate_map
+        # Take the fingerprints before querying the objects, so that
+        # changes made in the meantime are picked up by the next update.
+        manifest = self._query_manifest()
+        new_manifest = dict((tuple(row[:-2]), tuple(row[-2:])) 
+                            for row in manifest.tolist())
+        plate_map = self._query_plate_map()
+
+        changed_per_plate = {}
+        for plate, image_keys in invert_dict(plate_map).items():
+            changed = [image_key for image_key in image_keys
+                       if image_key not in old_plate_map or
+                       new_manifest.get(image_key) != old_manifest.get(image_key)]
+            if (changed or 
+                set(image_keys) != set(k for k, p in old_plate_map.items() if p == plate) or
+                not PlateStore.exists(self._plate_dir(plate))):
+                changed_per_plate[plate] = (image_keys, changed)
+
+        if plate_map != old_plate_map:
+            with cpa.util.replace_atomically(self._plate_map_filename) as f:
+                cpa.util.pickle(f, plate_map)
+            self._cached_plate_map = plate_map
+
+        properties_file = cpa.properties.__dict__.get('_filename')
+        parameters = [(properties_file, self.cache_dir, plate, image_keys, changed)
+                      for plate, (image_keys, changed) in changed_per_plate.items()]
+        # An interrupted update resumes; a later one is a new run.
+        view = parallel.view('cache.update.%s' % run_digest((parameters, manifest.tolist())))
+        results = view.imap(_update_cache_plate, parameters)
+        for plate in make_progress_bar('Updating', len(parameters))(results):
+            self._plate_stores.pop(plate, None)
+
+        self._write_manifest(manifest)
+        return changed_per_plate.keys()
+
+    def _update_cache_plate(self, plate, image_keys, changed_image_keys):
+        """
+        Rewrite the feature store of the plate, querying only the
+        changed images and copying the rest from the current store.
+        """
+        plate_store = self._plate_store(plate)
+        if plate_store is None or plate_store.cellids is None:
+            return self._create_cache_plate(plate, image_keys)
+        changed = set(changed_image_keys)
+        changed.update(image_key for image_key in image_keys
+                       if tuple(image_key) not in plate_store.offsets)
+        changed = [image_key for image_key in image_keys if image_key in changed]
+        queried = dict(zip(changed, zip(*self._query_objects(changed)))) if changed else {}
+        features = []
+        cellids = []
+        for image_key in image_keys:
+            if image_key in queried:
+                _features, _cellids = queried[image_key]
+            else:
+                _features, _cellids = plate_store.rows([image_key])
+            features.append(np.array(_features))
+            cellids.append(np.array(_cellids))
+        self._write_plate_store(self._plate_dir(plate), image_keys, features, cellids)
+        self._plate_stores.pop(plate, None)
 
 
 def _check_directory(dir, resume):
@@ -264,22 +1247,60 @@ def _check_directory(dir, resume):
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
 
-    parser = OptionParser("usage: %prog [-r] PROPERTIES-FILE CACHE-DIR PREDICATE")
+    parser = OptionParser("usage: %prog [-r|-u] [options] PROPERTIES-FILE CACHE-DIR PREDICATE\n"
+                          "       %prog --convert [--remove-image-files] CACHE-DIR")
+    ParallelProcessor.add_options(parser)
     parser.add_option('-r', dest='resume', action='store_true', help='resume')
+    parser.add_option('-u', '--update', dest='update', action='store_true',
+                      help='update an existing cache with new or changed images')
+    parser.add_option('--sketch-error', dest='sketch_error', type='float',
+                      help='also store per-image quantile sketches with this rank error (e.g., 0.01)')
+    parser.add_option('--approximate', dest='approximate', action='store_true',
+                      help='compute the normalization parameters from the quantile sketches')
+    parser.add_option('--dtype', dest='dtype', default='float32',
+                      help='type to store the features as: float32 (default) or float64')
+    parser.add_option('--compress', dest='compress', action='store_true', default=False,
+                      help='compress the feature file of each plate')
+    parser.add_option('--convert', dest='convert', action='store_true',
+                      help='convert an existing cache with one feature file per image to one contiguous feature file per plate')
+    parser.add_option('--remove-image-files', dest='remove_image_files', action='store_true',
+                      help='remove the per-image feature files after converting')
     options, args = parser.parse_args()
+
+    if options.convert:
+        if len(args) != 1:
+            parser.error('Incorrect number of arguments')
+        Cache(args[0]).convert(options.remove_image_files)
+        sys.exit(0)
+
     if len(args) != 3:
         parser.error('Incorrect number of arguments')
     properties_file, cache_dir, predicate = args
 
+    parallel = ParallelProcessor.create_from_options(parser, options)
+
     cpa.properties.LoadFile(properties_file)
 
+    if options.update:
+        cache = Cache(cache_dir)
+        plates = cache._update_cache(parallel)
+        if predicate != '':
+            for Normalization in normalizations.values():
+                normalizer = Normalization(cache)
+                normalizer.approximate = bool(options.approximate)
+                normalizer._update_cache(predicate, plates, parallel)
+        sys.exit(0)
+
     _check_directory(cache_dir, options.resume)
 
     cache = Cache(cache_dir)
 
-    cache._create_cache(options.resume)
+    cache._create_cache(options.resume, parallel, sketch_error=options.sketch_error,
+                        dtype=options.dtype, compress=options.compress)
     if predicate != '':
         for Normalization in normalizations.values():
-            Normalization(cache)._create_cache(predicate, options.resume)
+            normalizer = Normalization(cache)
+            normalizer.approximate = bool(options.approximate)
+            normalizer._create_cache(predicate, options.resume, parallel)
     else:
         print 'Not performing normalization because not predicate was specified.'
@@ -0,0 +1,196 @@
+"""
+Distances between profiles, computed one tile of rows at a time so
+that the full distance matrix is never held in memory.  Each tile is
+reduced as soon as it is computed, e.g., to the nearest neighbors of
+its rows or to a histogram of its distances.
+
+"""
+
+import collections
+import numpy as np
+from scipy.spatial.distance import cdist
+
+metrics = ['cosine', 'euclidean', 'cityblock']
+
+def _normalize_rows(data):
+    """Return the rows scaled to unit length (NaN for all-zero rows)."""
+    norms = np.sqrt((data * data).sum(1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return data / norms[:, np.newaxis]
+
+def tile_distances(a, b, metric='cosine', normalized=False):
+    """
+    Return the matrix of distances between the rows of A and the rows
+    of B.  Cosine distances are computed as one minus the product of
+    the normalized matrices; if NORMALIZED is true, A and B are
+    already normalized (see _normalize_rows).
+    """
+    if metric == 'cosine':
+        if not normalized:
+            a, b = _normalize_rows(a), _normalize_rows(b)
+        return np.clip(1 - np.dot(a, b.T), 0, 2)
+    return cdist(a, b, metric)
+
+
+class DistanceEngine(object):
+    """
+    Distances from the rows of DATA to the rows of OTHER (default:
+    DATA itself), computed in tiles of BLOCK_SIZE rows by NTHREADS
+    threads.  NumPy and cdist release the interpreter lock while they
+    compute, so the threads run in parallel.  By default the block
+    size is chosen so that a tile has about MAX_TILE_ELEMENTS
+    distances; at most NTHREADS + 1 tiles are in memory at a time.
+
+    When OTHER is not given, the pairs of a row with itself are
+    excluded from all the reductions.
+    """
+
+    max_tile_elements = 2 ** 23
+
+    def __init__(self, data, other=None, metric='cosine', block_size=None, nthreads=1):
+        if metric not in metrics:
+            raise ValueError('Unknown metric: %r' % metric)
+        self.metric = metric
+        self.data = np.asarray(data, dtype=float)
+        self.symmetric = other is None
+        self.other = self.data if other is None else np.asarray(other, dtype=float)
+        if metric == 'cosine':
+            self._data = _normalize_rows(self.data)
+            self._other = self._data if self.symmetric else _normalize_rows(self.other)
+        else:
+            self._data, self._other = self.data, self.other
+        self.block_size = block_size or max(1, self.max_tile_elements // max(1, len(self.other)))
+        self.nthreads = nthreads
+
+    def _tile(self, start):
+        stop = min(start + self.block_size, len(self.data))
+        distances = tile_distances(self._data[start:stop], self._other, self.metric,
+                                   normalized=True)
+        if self.symmetric:
+            rows = np.arange(stop - start)
+            distances[rows, start + rows] = np.nan
+        return start, stop, distances
+
+    def tiles(self):
+        """
+        Yield (start, stop, distances) for consecutive blocks of rows,
+        where distances has one row per row start:stop of DATA and
+        one column per row of OTHER.  The self pairs are NaN.
+        """
+        starts = xrange(0, len(self.data), self.block_size)
+        if self.nthreads <= 1:
+            for start in starts:
+                yield self._tile(start)
+            return
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(self.nthreads)
+        try:
+            pending = collections.deque()
+            for start in starts:
+                pending.append(pool.apply_async(self._tile, (start,)))
+                if len(pending) > self.nthreads:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+
+    def nearest_neighbors(self, k=1, exclude=None):
+        """
+        Return an array with one row per row of DATA holding the
+        indices of its K nearest rows of OTHER, nearest first, and -1
+        where fewer than K rows are eligible.  EXCLUDE(start, stop),
+        if given, returns a boolean mask of shape (stop - start,
+        len(other)) of further pairs to exclude.  Ties are broken by
+        the order of OTHER.
+        """
+        k = min(k, len(self.other))
+        neighbors = -np.ones((len(self.data), k), dtype=int)
+        if k == 0:
+            return neighbors
+        for start, stop, dist in self.tiles():
+            dist[np.isnan(dist)] = np.inf
+            if exclude is not None:
+                dist[exclude(start, stop)] = np.inf
+            rows = np.arange(stop - start)[:, np.newaxis]
+            if k == 1:
+                nearest = np.argmin(dist, axis=1)[:, np.newaxis]
+            else:
+                nearest = np.argpartition(dist, k - 1, axis=1)[:, :k]
+                order = np.lexsort((nearest, dist[rows, nearest]), axis=1)
+                nearest = nearest[rows, order]
+            nearest[np.isinf(dist[rows, nearest])] = -1
+            neighbors[start:stop] = nearest
+        return neighbors
+
+    def group_means(self, labels, other_labels=None):
+        """
+        Return the matrix of mean distances between the groups of
+        rows, where LABELS (and OTHER_LABELS for the rows of OTHER)
+        are arrays of group indices from 0 to ngroups - 1.  NaN
+        distances (the self pairs) are left out, and entries without
+        any pair are NaN.
+        """
+        labels = np.asarray(labels)
+        other_labels = labels if other_labels is None else np.asarray(other_labels)
+        ngroups = max(labels.max(), other_labels.max()) + 1
+        indicators = (other_labels[:, np.newaxis] == np.arange(ngroups)).astype(float)
+        sums = np.zeros((ngroups, ngroups))
+        counts = np.zeros((ngroups, ngroups))
+        for start, stop, dist in self.tiles():
+            valid = ~np.isnan(dist)
+            dist[~valid] = 0
+            np.add.at(sums, labels[start:stop], np.dot(dist, indicators))
+            np.add.at(counts, labels[start:stop], np.dot(valid, indicators))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, sums / counts, np.nan)
+
+    def histograms(self, edges, masks):
+        """
+        Return one histogram with the bin EDGES per function in
+        MASKS, each of which maps (start, stop) to a boolean mask of
+        the pairs of that tile to count.  NaN distances (the self
+        pairs) are not counted.
+        """
+        counts = [np.zeros(len(edges) - 1, dtype=int) for mask in masks]
+        for start, stop, dist in self.tiles():
+            valid = ~np.isnan(dist)
+            for c, mask in zip(counts, masks):
+                c += np.histogram(dist[valid & mask(start, stop)], edges)[0]
+        return counts
+
+    def rank_histogram(self, labels, other_labels=None):
+        """
+        Return an array whose r-th entry counts the pairs of rows in
+        the same group where the row of OTHER is the r-th nearest
+        (from 0) to the row of DATA.
+        """
+        labels = np.asarray(labels)
+        other_labels = labels if other_labels is None else np.asarray(other_labels)
+        counts = np.zeros(len(self.other), dtype=int)
+        for start, stop, dist in self.tiles():
+            dist[np.isnan(dist)] = np.inf
+            order = np.argsort(dist, axis=1, kind='mergesort')
+            ranks = np.empty_like(order)
+            rows = np.arange(stop - start)[:, np.newaxis]
+            ranks[rows, order] = np.arange(len(self.other))
+            same = labels[start:stop, np.newaxis] == other_labels[np.newaxis, :]
+            if self.symmetric:
+                same[rows[:, 0], start + rows[:, 0]] = False
+            counts += np.bincount(ranks[same], minlength=len(self.other))
+        return counts
+
+
+def histogram_auc(positives, negatives):
+    """
+    Return the area under the ROC curve (as cpa.util.auc) estimated
+    from histograms with the same bins: pairs in the same bin count
+    as half.
+    """
+    positives = np.asarray(positives, dtype=float)
+    negatives = np.asarray(negatives, dtype=float)
+    n = positives.sum() * negatives.sum()
+    if n == 0:
+        return np.nan
+    above = positives[::-1].cumsum()[::-1] - positives
+    return (negatives * (above + 0.5 * positives)).sum() / n
@@ -7,7 +7,8 @@ import numpy as np
 import mdp.nodes as nodes
 import cpa.util
 from .cache import Cache
-from .preprocessing import Preprocessor, VariableSelector
+from .preprocessing import (Preprocessor, VariableSelector, add_incremental_options, 
+                            incremental_scatter)
 
 logger = logging.getLogger(__name__)
             
@@ -58,8 +59,105 @@ class FactorAnalysisPreprocessor(Preprocessor):
                          for i in xrange(len(self.input_variables))])
         return VariableSelector(mask, self.input_variables)
 
+class _CovarianceFANode(object):
+    """
+    Factor analysis of a covariance matrix by the EM algorithm of
+    mdp's FANode, with the same attributes (E_y_mtx, A, sigma, mu)
+    and execute() method.
+    """
+
+    def __init__(self, mean, covariance, nfactors, max_cycles=30, tol=1e-4):
+        d = len(covariance)
+        k = nfactors
+        cov_diag = covariance.diagonal()
+        sigma = cov_diag
+        if d <= 300:
+            scale = np.linalg.det(covariance) ** (1. / d)
+        else:
+            scale = np.product(sigma) ** (1. / d)
+        if scale <= 0.:
+            raise ValueError('The covariance matrix of the data is singular. '
+                             'Redundant dimensions need to be removed.')
+        A = np.random.normal(0., np.sqrt(scale / k), size=(d, k))
+        const = -d / 2. * np.log(2. * np.pi)
+        base_lhood = None
+        old_lhood = -np.inf
+        for t in range(max_cycles):
+            B = np.dot(A, A.T) + np.diag(sigma)
+            log_det_B = np.log(abs(np.linalg.det(B)))
+            B = np.linalg.inv(B)
+            trA_B = np.dot(A.T, B)
+            trA_B_cov_mtx = np.dot(trA_B, covariance)
+            # E-step
+            E_yyT = np.eye(k) - np.dot(trA_B, A) + np.dot(trA_B_cov_mtx, trA_B.T)
+            # M-step
+            A = np.dot(trA_B_cov_mtx.T, np.linalg.inv(E_yyT))
+            sigma = cov_diag - np.dot(A, trA_B_cov_mtx).diagonal()
+            lhood = const - 0.5 * log_det_B - 0.5 * (B * covariance.T).sum()
+            if base_lhood is None:
+                base_lhood = lhood
+            elif (lhood - base_lhood) < (1. + tol) * (old_lhood - base_lhood):
+                break
+            old_lhood = lhood
+        self.A = A
+        self.sigma = sigma
+        self.mu = mean.reshape(1, d)
+        self.E_y_mtx = np.dot(np.linalg.inv(np.dot(A, A.T) + np.diag(sigma)).T, A)
+
+    def execute(self, data):
+        return np.dot(data - self.mu, self.E_y_mtx)
+
+
+def _independent_columns(scatter, tol):
+    """
+    Return the indices of the columns that are linearly independent
+    of the previous columns, given the scatter matrix of the data: as
+    the columns whose diagonal entry of R in the QR decomposition of
+    the centered data exceeds TOL in absolute value.
+    """
+    selected = []
+    for j in range(len(scatter)):
+        residual = scatter[j, j]
+        if selected:
+            b = scatter[selected, j]
+            residual -= np.dot(b, np.linalg.solve(scatter[np.ix_(selected, selected)], b))
+        if np.sqrt(max(residual, 0)) > tol:
+            selected.append(j)
+    return np.array(selected, dtype=int)
+
+
+class IncrementalFactorAnalysisPreprocessor(FactorAnalysisPreprocessor):
+    """
+    Factor analysis preprocessor trained from the ScatterMatrix of
+    the training cells instead of the cells themselves, so that it
+    can be trained on all the cells of the cache (see
+    preprocessing.compute_scatter).
+    """
+
+    def __init__(self, scatter, input_variables, nfactors):
+        assert len(scatter.mean) == len(input_variables)
+        self.input_variables = input_variables
+        self.nfactors = nfactors
+        self.variables = ['Factor %d' % (i + 1) for i in range(self.nfactors)]
+        self.selected_variables = range(len(self.variables))
+        self._train(scatter)
+
+    def _train(self, scatter, tol=1e-05):
+        self.selected_variables = _independent_columns(scatter.scatter, tol)
+        nvariables = len(self.selected_variables)
+        if self.nfactors > nvariables:
+            raise ValueError('Cannot find more factors than the number of '
+                             'variables ({0})'.format(nvariables))
+        selected = np.ix_(self.selected_variables, self.selected_variables)
+        self.fa_node = _CovarianceFANode(scatter.mean[self.selected_variables],
+                                         scatter.covariance()[selected],
+                                         self.nfactors)
+
+
 def kaiser(data):
-    c = np.corrcoef(data.T)
+    return kaiser_from_correlation(np.corrcoef(data.T))
+
+def kaiser_from_correlation(c):
     w, v = np.linalg.eig(c)
     return (w >= 1).sum()
 
@@ -70,21 +168,29 @@ def _main(args=None):
 
     logging.basicConfig(level=logging.DEBUG)
  
-    parser = OptionParser("usage: %prog [options] SUBSAMPLE-FILE NFACTORS OUTPUT-FILE")
+    parser = OptionParser("usage: %prog [options] SUBSAMPLE-FILE NFACTORS OUTPUT-FILE\n"
+                          "       %prog [options] --incremental PROPERTIES-FILE CACHE-DIR NFACTORS OUTPUT-FILE")
     parser.add_option('--variable-selection-only', dest='variable_selection_only',
                       help='use factor analysis only to select variables to keep (those most heavily loaded on at least on factor)',
                       action='store_true')
+    add_incremental_options(parser)
     options, args = parser.parse_args(args)
-    if len(args) != 3:
+    if len(args) != (4 if options.incremental else 3):
         parser.error('Incorrect number of arguments')
-    subsample_file = args[0]
-    nfactors = int(args[1])
-    output_file = args[2]
-
-    subsample = cpa.util.unpickle1(subsample_file)
-    print kaiser(subsample.data)
-    preprocessor = cpa.profiling.factor_analysis.FactorAnalysisPreprocessor(
-        standardize(subsample.data), subsample.variables, nfactors)
+    nfactors = int(args[-2])
+    output_file = args[-1]
+
+    if options.incremental:
+        scatter, variables = incremental_scatter(parser, options, *args[:2])
+        scatter = scatter.standardized()
+        print kaiser_from_correlation(scatter.covariance())
+        preprocessor = cpa.profiling.factor_analysis.IncrementalFactorAnalysisPreprocessor(
+            scatter, variables, nfactors)
+    else:
+        subsample = cpa.util.unpickle1(args[0])
+        print kaiser(subsample.data)
+        preprocessor = cpa.profiling.factor_analysis.FactorAnalysisPreprocessor(
+            standardize(subsample.data), subsample.variables, nfactors)
     if options.variable_selection_only:
         preprocessor = preprocessor.get_variable_selector()
     cpa.util.pickle(output_file, preprocessor)
@@ -3,20 +3,133 @@ import re
 import logging
 from optparse import OptionParser
 import numpy as np
-from scipy.spatial.distance import cdist
-import pylab
 import cpa
-from .profiles import add_common_options
+from .profiles import add_common_options, images_per_plate
 from .preprocessing import NullPreprocessor
-from .cache import Cache, normalizations
+from .cache import Cache, make_progress_bar
+from .normalization import RobustLinearNormalization, normalizations
+from .parallel import ParallelProcessor, Uniprocessing
+
+def reduce_candidates(candidates, nbins):
+    """
+    Reduce the candidate cells of one factor, a tuple (values, keys)
+    of a vector with the factor's value of each cell and an array
+    with the object key of each cell in its rows, to the smallest and
+    largest value in each of NBINS equal-width bins of their range.
+    The cell nearest to any value is then among the candidates, or
+    within one bin width of it; the extreme cells are always kept.
+    """
+    values, keys = candidates
+    if len(values) <= 2 * nbins:
+        return values, keys
+    lo, hi = values.min(), values.max()
+    bins = np.minimum(((values - lo) / ((hi - lo) or 1.0) * nbins).astype(int), nbins - 1)
+    order = np.lexsort((values, bins))
+    sorted_bins = bins[order]
+    first = np.flatnonzero(np.r_[True, sorted_bins[1:] != sorted_bins[:-1]])
+    last = np.r_[first[1:] - 1, len(order) - 1]
+    keep = order[np.unique(np.r_[first, last])]
+    return values[keep], keys[keep]
+
+def merge_candidates(a, b, nbins):
+    """Merge and reduce two lists of per-factor candidates (see
+    reduce_candidates)."""
+    return [reduce_candidates((np.concatenate((va, vb)), np.concatenate((ka, kb))), nbins)
+            for (va, ka), (vb, kb) in zip(a, b)]
+
+def _compute_plate_candidates((cache_dir, normalization_name, preprocess_file,
+                               image_keys, nbins)):
+    """
+    Return the candidate cells of the images of a plate, which are
+    loaded once each in storage order: a list with one (values, keys)
+    tuple per factor (see reduce_candidates), or None if the images
+    have no cells.
+    """
+    import numpy as np
+    import cpa.util
+    from cpa.profiling.cache import Cache
+    from cpa.profiling.normalization import normalizations
+    from cpa.profiling.parallel import worker_local
+    from cpa.profiling.factor_cells import reduce_candidates, merge_candidates
+    cache = worker_local(('cache', cache_dir), Cache, cache_dir)
+    normalization = normalizations[normalization_name]
+    preprocessor = None
+    if preprocess_file:
+        preprocessor = worker_local(('preprocessor', preprocess_file),
+                                    cpa.util.unpickle1, preprocess_file)
+    candidates = None
+    for image_key in cache.storage_order(image_keys):
+        data, colnames, cellids = cache.load([image_key], normalization=normalization)
+        if len(data) == 0:
+            continue
+        if preprocessor:
+            data = preprocessor(data)
+        keys = np.column_stack((np.tile(np.array(image_key), (len(data), 1)), cellids))
+        image_candidates = [reduce_candidates((data[:, factor], keys), nbins)
+                            for factor in range(data.shape[1])]
+        if candidates is None:
+            candidates = image_candidates
+        else:
+            candidates = merge_candidates(candidates, image_candidates, nbins)
+    return candidates
+
+def factor_cells(cache_dir, image_keys, nsteps=20, 
+                 normalization=RobustLinearNormalization, preprocess_file=None,
+                 parallel=Uniprocessing(), nbins=None, show_progress=True):
+    """
+    For each factor and each of NSTEPS evenly spaced values between
+    the smallest and largest value of the factor over the cells,
+    return the object key of the cell whose value is nearest.  Return
+    the ranges as an array with one (min, max) row per factor and the
+    object keys as an array with one row per factor and step.
+
+    The plates are processed in parallel in a single pass, each cell
+    being loaded once; every plate keeps only NBINS (default: 100 *
+    NSTEPS) pairs of candidate cells per factor, and the candidates
+    of each plate are merged into the running total as they arrive.
+    The ranges are exact, and each chosen cell is the nearest, or
+    within (max - min) / NBINS of the nearest.
+    """
+    nbins = nbins or 100 * nsteps
+    cache = Cache(cache_dir)
+    per_plate = images_per_plate(cache, [image_keys])
+    parameters = [(cache_dir, normalization.__name__, preprocess_file,
+                   per_plate[plate], nbins)
+                  for plate in sorted(per_plate.keys())]
+    results = parallel.view('factor_cells.plates').imap(
+        _compute_plate_candidates, parameters, 
+        chunksize=getattr(parallel, 'chunksize', None))
+    if show_progress:
+        results = make_progress_bar('Plates', len(parameters))(results)
+    candidates = None
+    for plate_candidates in results:
+        if plate_candidates is None:
+            continue
+        if candidates is None:
+            candidates = plate_candidates
+        else:
+            candidates = merge_candidates(candidates, plate_candidates, nbins)
+    if candidates is None:
+        raise ValueError('No cells to choose from')
+
+    ranges = np.array([(values.min(), values.max()) for values, keys in candidates])
+    nearest_neighbors = []
+    for (values, keys), (lo, hi) in zip(candidates, ranges):
+        for value in np.linspace(lo, hi, nsteps):
+            nearest_neighbors.append(keys[np.argmin(np.abs(values - value))])
+    return ranges, np.array(nearest_neighbors)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
 
     parser = OptionParser("usage: %prog [options] PROPERTIES-FILE CACHE-DIR PREPROCESSOR [NSTEPS]")
+    ParallelProcessor.add_options(parser)
     parser.add_option('-f', dest='filter', help='only profile images matching this CPAnalyst filter')
+    parser.add_option('--bins', dest='nbins', type='int', 
+                      help='number of candidate bins per factor and plate (default: 100 * NSTEPS)')
     add_common_options(parser)
     options, args = parser.parse_args()
+    parallel = ParallelProcessor.create_from_options(parser, options)
 
     if len(args) not in [3, 4]:
         parser.error('Incorrect number of arguments')
@@ -24,76 +137,27 @@ if __name__ == '__main__':
     nsteps = int(args[3]) if len(args) == 4 else 20
 
     normalization = normalizations[options.normalization]
+    cpa.properties.LoadFile(properties_file)
     if preprocess_file is None:
-        preprocessor = NullPreprocessor(normalization.colnames)
+        preprocessor = NullPreprocessor(normalization(Cache(cache_dir)).colnames)
     else:
         preprocessor = cpa.util.unpickle1(preprocess_file)
-    cpa.properties.LoadFile(properties_file)
-    cache = Cache(cache_dir)
 
     if options.filter:
         image_keys = cpa.db.GetFilteredImages(options.filter)
     else:
         image_keys = cpa.db.GetAllImageKeys()
 
-    nfactors = len(preprocessor.variables)
-    min_distances = np.ones(nfactors * nsteps) * np.inf
-    nearest_neighbors = [None] * nfactors * nsteps
-    min_profile = np.ones(nfactors) * np.inf
-    max_profile = np.ones(nfactors) * -np.inf
-
-    njobs = len(image_keys)
-
-    def make_progress():
-        show_progress = True
-        if show_progress:
-            import progressbar
-            return progressbar.ProgressBar(widgets=[progressbar.Percentage(), ' ',
-                                                        progressbar.Bar(), ' ', 
-                                                        progressbar.Counter(), '/', 
-                                                        str(njobs), ' ',
-                                                        progressbar.ETA()],
-                                               maxval=njobs)
-        else:
-            return lambda x: x
-
-    # Get the range of each variable
-
-    for image_key in make_progress()(image_keys):
-        data, colnames, object_keys = cache.load([image_key], normalization=normalization)
-        if len(data) == 0:
-            continue
-        data = preprocessor(data)
-        min_profile = np.minimum(min_profile, np.min(data, 0))
-        max_profile = np.maximum(max_profile, np.max(data, 0))
+    ranges, nearest_neighbors = factor_cells(cache_dir, image_keys, nsteps, 
+                                             normalization=normalization,
+                                             preprocess_file=preprocess_file,
+                                             parallel=parallel, nbins=options.nbins)
 
     print >>sys.stderr, 'RANGES:'
-    for i in range(nfactors):
-        print >>sys.stderr, i + 1, min_profile[i], max_profile[i]
+    for i, (lo, hi) in enumerate(ranges):
+        print >>sys.stderr, i + 1, lo, hi
     print >>sys.stderr
 
-    values = np.vstack([np.linspace(min_profile[i], max_profile[i], nsteps)
-                        for i in range(nfactors)])
-
-    # Pick cells
-
-    for image_key in make_progress()(image_keys):
-        data, colnames, object_keys = cache.load([image_key], normalization=normalization)
-        if len(data) == 0:
-            continue
-        data = preprocessor(data)
-        distances = np.zeros((len(data), nfactors * nsteps))
-        for i in range(len(data)):
-            for factor in range(nfactors):
-                for step in range(nsteps):
-                    distance = np.abs(data[i, factor] - values[factor, step])
-                    distances[i, factor * nsteps + step] = distance
-        assert distances.shape[1] == nfactors * nsteps
-        cell_indices, target_indices = np.nonzero(distances < min_distances)
-        for i, j in zip(cell_indices, target_indices):
-            min_distances[j] = distances[i, j]
-            nearest_neighbors[j] = image_key + (object_keys[i],)
-
     print 'label', ' '.join([re.sub(' ', '_', v) for v in preprocessor.variables])
     for i, label in enumerate(preprocessor.variables):
         for j in range(nsteps):
@@ -1,15 +1,16 @@
+import sys
 from optparse import OptionParser
 import numpy as np
 from scipy.spatial.distance import pdist, cdist
 import pylab
 from .profiles import Profiles
 import cpa
-from cpa.util import auc
+from .distances import DistanceEngine, histogram_auc
 
 def compute_inter_intra_distances(profiles, true_group_name):
     label_map = profiles.regroup(true_group_name)
-    labels = label_map.values()
-    label_indices = np.array([labels.index(label_map[k])
+    label_to_index = dict((l, i) for i, l in enumerate(set(label_map.values())))
+    label_indices = np.array([label_to_index[label_map[k]]
                               for k in profiles.keys()], dtype='i4')
     grouped_data = [profiles.data[label_indices == i]
                     for i in range(label_indices.max() + 1)]
@@ -20,16 +21,50 @@ def compute_inter_intra_distances(profiles, true_group_name):
                                  for d2 in grouped_data])
     return inter_distances, intra_distances
 
-def plot_inter_intra_distances(profiles, true_group_name):
-    inter_distances, intra_distances = compute_inter_intra_distances(profiles,
-                                                                     true_group_name)
-    print 'AUC:', auc(inter_distances, intra_distances)
-    h_intra, e_intra = np.histogram(intra_distances, 15, normed=True)
-    h_inter, e_inter = np.histogram(inter_distances, 15, normed=True)
-    pylab.bar(e_intra[:-1], h_intra, e_intra[1] - e_intra[0], color='r', 
-              alpha=0.5, label='Intra-' + true_group_name)
-    pylab.bar(e_inter[:-1], h_inter, e_inter[1] - e_inter[0], color='b', 
-              alpha=0.5, label='Inter-' + true_group_name)
+def inter_intra_histograms(profiles, true_group_name, edges, nthreads=1,
+                           block_size=None):
+    """
+    Return the histograms with the bin EDGES of the cosine distances
+    between the pairs of profiles in different groups (inter) and in
+    the same group (intra).  The distances are computed in tiles by a
+    DistanceEngine and never held in memory all at once.
+    """
+    label_map = profiles.regroup(true_group_name)
+    mask = np.array([tuple(k) in label_map for k in profiles.keys()], dtype=bool)
+    label_to_index = dict((l, i) for i, l in enumerate(set(label_map.values())))
+    label_indices = np.array([label_to_index[label_map[tuple(k)]]
+                              for k, m in zip(profiles.keys(), mask) if m], dtype='i4')
+    engine = DistanceEngine(np.asarray(profiles.data)[mask], metric='cosine',
+                            nthreads=nthreads, block_size=block_size)
+    def pairs(same_group):
+        def mask(start, stop):
+            same = label_indices[start:stop, np.newaxis] == label_indices
+            # Count each unordered pair once.
+            upper = np.arange(start, stop)[:, np.newaxis] < np.arange(len(label_indices))
+            return upper & (same == same_group)
+        return mask
+    h_inter, h_intra = engine.histograms(edges, [pairs(False), pairs(True)])
+    return h_inter, h_intra
+
+def plot_inter_intra_distances(profiles, true_group_name, nthreads=1):
+    edges = np.linspace(0, 2, 1501)
+    h_inter, h_intra = inter_intra_histograms(profiles, true_group_name, edges,
+                                              nthreads=nthreads)
+    nonzero = np.flatnonzero(h_inter + h_intra)
+    if len(nonzero) == 0:
+        raise ValueError('No pairs of profiles to compare')
+    print 'AUC:', histogram_auc(h_inter, h_intra)
+    # Plot about 15 bins over the range of the distances.
+    step = max(1, int(np.ceil((nonzero[-1] + 1 - nonzero[0]) / 15.)))
+    starts = np.arange(nonzero[0], nonzero[-1] + 1, step)
+    width = step * (edges[1] - edges[0])
+    for h, color, label in [(h_intra, 'r', 'Intra-'), (h_inter, 'b', 'Inter-')]:
+        if h.sum() == 0:
+            # E.g., no intra-group pairs if every group has one profile.
+            continue
+        h = np.add.reduceat(h, starts).astype(float)
+        pylab.bar(edges[starts], h / (h.sum() * width), width, color=color,
+                  alpha=0.5, label=label + true_group_name)
     pylab.legend(loc='upper right')
     pylab.xlabel('Cosine distance')
     pylab.ylabel('Normalized frequency (probability density)')
@@ -38,6 +73,8 @@ def plot_inter_intra_distances(profiles, true_group_name):
 if __name__ == '__main__':
     parser = OptionParser("usage: %prog PROPERTIES-FILE PROFILES-FILENAME TRUE-GROUP")
     parser.add_option('-o', dest='output_filename', help='file to store the profiles in')
+    parser.add_option('-j', '--threads', dest='nthreads', type='int', default=1,
+                      help='number of threads that compute distances (default: 1)')
     options, args = parser.parse_args()
     if len(args) != 3:
         parser.error('Incorrect number of arguments')
@@ -46,7 +83,11 @@ if __name__ == '__main__':
 
     profiles = Profiles.load(profiles_filename)
 
-    plot_inter_intra_distances(profiles, true_group_name)
+    try:
+        plot_inter_intra_distances(profiles, true_group_name, nthreads=options.nthreads)
+    except ValueError, e:
+        print >>sys.stderr, 'Error:', e
+        sys.exit(1)
     if options.output_filename:
         pylab.savefig(options.output_filename)
     else:
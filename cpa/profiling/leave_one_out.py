@@ -7,6 +7,7 @@ import cpa
 from scipy.spatial.distance import cdist, cosine, euclidean, cityblock
 from .profiles import Profiles
 from .confusion import confusion_matrix, write_confusion
+from .distances import DistanceEngine
 
 def vote(predictions):
     votes = {}
@@ -103,6 +104,66 @@ def crossvalidate(profiles, true_group_name, holdout_group_name=None,
             confusion[true, predicted] = confusion.get((true, predicted), 0) + 1
     return confusion
 
+def nearest_neighbors(test, training, k=1, distance='cosine', exclude=None,
+                      block_size=None, nthreads=1):
+    """
+    Return an array with one row per test profile holding the indices
+    of its K nearest training profiles, nearest first, and -1 where
+    fewer than K training profiles are eligible.  Training profiles
+    that are all zero are never neighbors, and EXCLUDE(start, stop),
+    if given, returns a boolean mask of shape (stop - start,
+    ntraining) of the pairs to exclude for test profiles start:stop.
+
+    The distances are computed by a DistanceEngine, BLOCK_SIZE test
+    profiles at a time.
+    """
+    all_zero = np.all(np.asarray(training) == 0, 1)
+    def excluded(start, stop):
+        mask = np.tile(all_zero, (stop - start, 1))
+        if exclude is not None:
+            mask |= exclude(start, stop)
+        return mask
+    engine = DistanceEngine(test, training, metric=distance, block_size=block_size,
+                            nthreads=nthreads)
+    return engine.nearest_neighbors(k, exclude=excluded)
+
+def crossvalidate_vectorized(profiles, true_group_name, holdout_group_name=None,
+                             distance='cosine', k=1, block_size=None, nthreads=1):
+    """
+    Nearest-neighbor cross-validation like crossvalidate, but with the
+    distances computed blockwise by a DistanceEngine and the held-out profiles
+    masked with boolean indexing instead of training a classifier per
+    holdout group.  The prediction is the vote of the K nearest
+    training profiles outside the test profile's holdout group.
+    Profiles without any eligible neighbor are not counted.
+    """
+    profiles.assert_not_isnan()
+    true_labels = profiles.regroup(true_group_name)
+    mask = np.array([tuple(key) in true_labels for key in profiles.keys()], dtype=bool)
+    keys = [tuple(key) for key, m in zip(profiles.keys(), mask) if m]
+    data = np.asarray(profiles.data)[mask]
+    labels = [true_labels[key] for key in keys]
+
+    if holdout_group_name:
+        holdouts = profiles.regroup(holdout_group_name)
+        holdout_ids = {}
+        holdout = np.array([holdout_ids.setdefault(tuple(holdouts[key]), len(holdout_ids))
+                            for key in keys])
+    else:
+        holdout = np.arange(len(keys))
+    exclude = lambda start, stop: holdout[start:stop, np.newaxis] == holdout[np.newaxis, :]
+
+    neighbors = nearest_neighbors(data, data, k=k, distance=distance, exclude=exclude,
+                                  block_size=block_size, nthreads=nthreads)
+    confusion = {}
+    for true, nearest in zip(labels, neighbors):
+        predictions = [labels[j] for j in nearest if j >= 0]
+        if len(predictions) == 0:
+            continue
+        predicted = vote(predictions)
+        confusion[true, predicted] = confusion.get((true, predicted), 0) + 1
+    return confusion
+
 def print_confusion_matrix(confusion):
    cm = confusion_matrix(confusion)
    print cm
@@ -114,6 +175,11 @@ if __name__ == '__main__':
     parser.add_option('-c', dest='csv', help='input as CSV', action='store_true')
     parser.add_option('-d', dest='distance', help='distance metric', default='cosine', action='store')
     parser.add_option('-H', dest='holdout_group', help='hold out all that map to the same holdout group', action='store')
+    parser.add_option('-k', dest='k', type='int', default=1, help='number of nearest neighbors that vote (default: 1)')
+    parser.add_option('--block-size', dest='block_size', type='int', default=None,
+                      help='number of profiles whose distances are computed at a time (default: about 8 million distances at a time)')
+    parser.add_option('-j', '--threads', dest='nthreads', type='int', default=1,
+                      help='number of threads that compute distances (default: 1)')
     options, args = parser.parse_args()
     if len(args) != 3:
         parser.error('Incorrect number of arguments')
@@ -125,6 +191,8 @@ if __name__ == '__main__':
     else:
        profiles = Profiles.load(profiles_filename)
 
-    confusion = crossvalidate(profiles, true_group_name, options.holdout_group,
-                              distance=options.distance)
+    confusion = crossvalidate_vectorized(profiles, true_group_name, options.holdout_group,
+                                         distance=options.distance, k=options.k,
+                                         block_size=options.block_size,
+                                         nthreads=options.nthreads)
     write_confusion(confusion, sys.stdout)
@@ -8,10 +8,13 @@ import pickle
 import marshal
 import os
 import tempfile
-import progressbar
+import subprocess
 import traceback
 
 class LSF(object):
+    # Default chunksize for callers that do not choose one.
+    chunksize = None
+
     def __init__(self, njobs, directory=None, memory=None, job_array_name = 'CPA'):
         self.njobs = njobs
         self.memory = memory
@@ -23,11 +26,27 @@ class LSF(object):
             if not os.path.exists(self.directory):
                 os.mkdir(self.directory)
 
+    def broadcast(self, value):
+        """Publish a value in the control directory, which the
+        workers on all hosts can read."""
+        from cpa.profiling.parallel import broadcast
+        return broadcast(value, os.path.abspath(os.path.join(self.directory, 'broadcast')))
+
     def view(self, name):
         return LSFView(self.njobs, os.path.join(self.directory, name), self.memory, self.job_array_name)
 
 
 class LSFView(object):
+    # Target duration of a task when the batch size is adapted.
+    task_seconds = 60
+    poll_seconds = 1
+    rescan_seconds = 60
+    # Workers are started start_batch at a time, at most one batch
+    # every start_seconds, so that a large job array does not hit the
+    # shared file system and the database all at once.
+    start_batch = 10
+    start_seconds = 10
+
     def __init__(self, njobs, directory=None, memory=None, job_array_name = 'CPA'):
         self.njobs = njobs
         self.memory = memory
@@ -46,11 +65,14 @@ class LSFView(object):
             path = os.path.join(self.directory, subdir)
             os.mkdir(path)
 
-    def start_workers(self):
+    def start_workers(self, njobs, first=1):
+        """Start NJOBS workers with the array indices FIRST, FIRST + 1, ..."""
+        if njobs <= 0:
+            return
         args = ['bsub']
         if self.memory:
             args.extend(['-R', 'rusage[mem=%d]' % int(self.memory)])
-        args.extend(['-J', '"%s[1-%d]"' % (self.job_array_name, self.njobs), '-o', 
+        args.extend(['-J', '"%s[%d-%d]"' % (self.job_array_name, first, first + njobs - 1), '-o', 
                      '"%s/out/j%%Ja%%I.out"' % self.directory, sys.executable,
                      '-m', 'cpa.profiling.lsf', self.directory])
         cmd = ' '.join(args)
@@ -68,69 +90,244 @@ class LSFView(object):
             pickle.dump(task_dict, f)
         os.rename(tmp_filename, os.path.join(self.directory, 'new', basename))
 
+    def poll_workers(self, npending):
+        """Called about once a second while waiting for results."""
+        pass
+
+    def stop_workers(self):
+        """Called when all results have been returned."""
+        pass
+
     def signal_done_submitting(self):
         # Signal that we are done submitting tasks.
         open(os.path.join(self.directory, 'submitted'), 'w').close()
 
-    def progress(self, s, n):
-        return progressbar.ProgressBar(widgets=[s, progressbar.Percentage(), 
-                                                ' ', progressbar.Bar(), ' ', 
-                                                progressbar.Counter(), '/', 
-                                                str(n), ' ', progressbar.ETA()],
-                                       maxval=n)
-
     def read_results(self, task_id):
         with open(os.path.join(self.directory, 'done', 't%d.pickle' % task_id)) as f:
             results = pickle.load(f)['result']
             for r in results:
                 yield r
 
-    def imap(self, function, parameters):
+    def read_batch_log(self):
+        """Return the (task_id, start, stop) of the batches submitted so
+        far, in the order of the parameters."""
+        filename = os.path.join(self.directory, 'batches.log')
+        if not os.path.exists(filename):
+            return []
+        with open(filename) as f:
+            return [tuple(int(x) for x in line.split()) 
+                    for line in f if line.endswith('\n')]
+
+    def log_batch(self, task_id, start, stop):
+        with open(os.path.join(self.directory, 'batches.log'), 'a') as f:
+            f.write('%d %d %d\n' % (task_id, start, stop))
+
+    def read_completions(self):
+        """
+        Return the (task_id, elapsed) pairs appended to the completion
+        log by the workers since the last call.  ELAPSED is None for
+        tasks that failed.
+        """
+        filename = os.path.join(self.directory, 'completed.log')
+        if not os.path.exists(filename):
+            return []
+        with open(filename) as f:
+            f.seek(self.completion_log_offset)
+            data = f.read()
+        # Only consume complete lines; a worker may be appending.
+        data = data[:data.rfind('\n') + 1]
+        self.completion_log_offset += len(data)
+        completions = []
+        for line in data.splitlines():
+            task_id, elapsed = line.split()
+            completions.append((int(task_id), 
+                                None if elapsed == 'failed' else float(elapsed)))
+        return completions
+
+    def imap(self, function, parameters, chunksize=None, initializer=None, initargs=()):
+        """
+        The parameters are submitted in batches (tasks), keeping about
+        two tasks per worker queued.  Unless CHUNKSIZE is given, the
+        first batches have the size of 1/4000 of the parameters; later
+        batches are sized so that a task takes about task_seconds,
+        based on the elapsed times of the tasks completed so far.
+
+        Workers announce completed tasks in an append-only log, which
+        is read instead of listing the queue directories; the done
+        directory is only rescanned every rescan_seconds in case a
+        log entry was lost (e.g., on NFS).  A resumed run reuses the
+        batches of the previous run and only submits the unfinished
+        ones.  Workers are started in batches of start_batch, one
+        batch every start_seconds, up to njobs workers or the number
+        of tasks left.
+
+        If INITIALIZER is given, each worker calls
+        initializer(*initargs) once before its first task.  Like the
+        function, the initializer is sent as code, so it must import
+        what it needs itself.
+        """
+        parameters = list(parameters)
         if not self.resuming:
             self.create_subdirectories()
-        self.start_workers()
-        done_tasks = self.list_precomputed_results()
-        # Divide the paramaters into batches (tasks).
-        batch_size = 1 + len(parameters) // 4000
-        print 'Batch size:', batch_size
-        all_batches = []
-        while parameters:
-            all_batches.append(parameters[:batch_size])
-            parameters = parameters[batch_size:]
-        # Remove already-computed tasks.
-        batches = [(task_id, batch)
-                   for task_id, batch in enumerate(all_batches) 
-                   if task_id not in done_tasks]
-        # Submit tasks.
-        if len(batches) > 0:
-            progress = self.progress('Submitting tasks: ', len(batches))
-            for task_id, batch in progress(batches):
-                self.submit_task(task_id, dict(function=marshal.dumps(function.func_code), 
-                                               batch=batch,
-                                               task_id=task_id, attempts=3))
-            self.signal_done_submitting()
+        submitted_marker = os.path.join(self.directory, 'submitted')
+        if os.path.exists(submitted_marker):
+            os.unlink(submitted_marker)
+        function_code = marshal.dumps(function.func_code)
+        if initializer is not None:
+            initializer = marshal.dumps(initializer.func_code)
+        self.completion_log_offset = 0
+
+        def submit(task_id, start, stop):
+            self.submit_task(task_id, dict(function=function_code,
+                                           batch=parameters[start:stop],
+                                           initializer=initializer,
+                                           initargs=initargs,
+                                           task_id=task_id, attempts=3))
+
+        # Batches of a previous run, and which of them are done.
+        batches = self.read_batch_log()
+        sizes = dict((task_id, stop - start) for task_id, start, stop in batches)
+        done_tasks = (set(task_id for task_id, elapsed in self.read_completions()
+                          if elapsed is not None) |
+                      self.list_precomputed_results()) & set(sizes)
+        position = max([stop for task_id, start, stop in batches] or [0])
+        assert position <= len(parameters)
+        next_task_id = max([task_id for task_id, start, stop in batches] or [-1]) + 1
+        outstanding = set()
+        for task_id, start, stop in batches:
+            if task_id not in done_tasks:
+                submit(task_id, start, stop)
+                outstanding.add(task_id)
+
+        initial_batch_size = chunksize or 1 + len(parameters) // 4000
+        total_elapsed = 0.0
+        total_items = 0
+        order = [task_id for task_id, start, stop in batches]
         next = 0
+        last_rescan = time.time()
+        started = 0
+        last_start = None
         while True:
-            try:
-                npending = len(os.listdir(os.path.join(self.directory, 'new')))
-                nrunning = len(os.listdir(os.path.join(self.directory, 'cur')))
-            except OSError, e:
-                if e.errno == errno.EIO:
-                    continue
+            # Keep the queue filled.
+            while position < len(parameters) and len(outstanding) < 2 * self.njobs:
+                if chunksize or total_items == 0:
+                    batch_size = initial_batch_size
                 else:
-                    raise
-            for fn in os.listdir(os.path.join(self.directory, 'done')):
-                task_id = int(re.match('t(\d+)\.pickle$', fn).group(1))
-                if task_id not in done_tasks:
-                    done_tasks.add(task_id)
+                    seconds_per_item = total_elapsed / total_items
+                    batch_size = max(1, int(self.task_seconds / max(seconds_per_item, 1e-6)))
+                stop = min(len(parameters), position + batch_size)
+                self.log_batch(next_task_id, position, stop)
+                submit(next_task_id, position, stop)
+                sizes[next_task_id] = stop - position
+                order.append(next_task_id)
+                outstanding.add(next_task_id)
+                next_task_id += 1
+                position = stop
+            if position == len(parameters) and not os.path.exists(submitted_marker):
+                self.signal_done_submitting()
+
+            # Start the next batch of workers, but not more workers
+            # than there can be tasks.
+            if position < len(parameters):
+                wanted = self.njobs
+            else:
+                wanted = min(self.njobs, len(outstanding))
+            if started < wanted and (last_start is None or 
+                                     time.time() - last_start >= self.start_seconds):
+                n = min(self.start_batch, wanted - started)
+                self.start_workers(n, started + 1)
+                started += n
+                last_start = time.time()
+
+            completed = self.read_completions()
+            if time.time() - last_rescan >= self.rescan_seconds:
+                completed.extend((task_id, 0.0) for task_id 
+                                 in self.list_precomputed_results() & outstanding)
+                last_rescan = time.time()
+            for task_id, elapsed in completed:
+                if task_id not in outstanding:
+                    continue
+                if elapsed is None:
+                    raise RuntimeError('Task %d failed; see %s' % 
+                                       (task_id, os.path.join(self.directory, 'failed')))
+                outstanding.discard(task_id)
+                done_tasks.add(task_id)
+                if elapsed > 0:
+                    total_elapsed += elapsed
+                    total_items += sizes[task_id]
+
             # Return results
-            while next in done_tasks:
-                for r in self.read_results(next):
+            while next < len(order) and order[next] in done_tasks:
+                for r in self.read_results(order[next]):
                     yield r
                 next += 1
-            if next == len(all_batches):
+            if next == len(order) and position == len(parameters):
+                self.stop_workers()
                 return
-            time.sleep(1)
+            self.poll_workers(len(outstanding))
+            time.sleep(self.poll_seconds)
+
+class LocalLSF(LSF):
+    """
+    Run the workers of the LSF directory protocol as processes on the
+    local machine instead of submitting them with bsub.  Runs can be
+    resumed like LSF runs, and more workers can be added, e.g. on
+    other hosts that share the directory, by running
+
+        python -m cpa.profiling.lsf DIRECTORY
+
+    """
+
+    def view(self, name):
+        return LocalLSFView(self.njobs, os.path.join(self.directory, name))
+
+
+class LocalLSFView(LSFView):
+    # Number of times a worker that exits with an error is restarted
+    # before the run fails.
+    max_restarts = 3
+
+    def __init__(self, njobs, directory=None):
+        super(LocalLSFView, self).__init__(njobs, directory)
+        self.workers = {}
+        self.restarts = {}
+
+    def start_worker(self, array_index):
+        out = open(os.path.join(self.directory, 'out', 
+                                'local%da%d.out' % (os.getpid(), array_index)), 'a')
+        env = dict(os.environ, LSB_JOBID=str(os.getpid()), 
+                   LSB_JOBINDEX=str(array_index))
+        self.workers[array_index] = subprocess.Popen(
+            [sys.executable, '-m', 'cpa.profiling.lsf', self.directory],
+            stdout=out, stderr=subprocess.STDOUT, env=env)
+        out.close()
+
+    def start_workers(self, njobs, first=1):
+        for array_index in range(first, first + njobs):
+            self.start_worker(array_index)
+
+    def poll_workers(self, npending):
+        # Workers exit after an hour or when they crash; replace them
+        # as long as there are tasks left.
+        # Workers that crash, e.g. at startup, are only restarted a
+        # few times.
+        for array_index, worker in self.workers.items():
+            status = worker.poll()
+            if status is None or npending == 0:
+                continue
+            if status != 0:
+                self.restarts[array_index] = self.restarts.get(array_index, 0) + 1
+                if self.restarts[array_index] > self.max_restarts:
+                    raise RuntimeError('Worker %d exited with status %d %d times; see %s' %
+                                       (array_index, status, self.restarts[array_index],
+                                        os.path.join(self.directory, 'out')))
+            self.start_worker(array_index)
+
+    def stop_workers(self):
+        for worker in self.workers.values():
+            worker.wait()
+        self.workers.clear()
+
 
 def test_function((seconds)):
     import time
@@ -151,6 +348,18 @@ class Worker(object):
         self.job_id = job_id
         self.array_index = array_index
         self.start_time = time.time()
+        # Initializers that have already been called by this worker.
+        self.initialized = set()
+
+    def initialize(self, task):
+        initializer = task.get('initializer')
+        if initializer is None:
+            return
+        key = (initializer, pickle.dumps(task['initargs']))
+        if key not in self.initialized:
+            code = marshal.loads(initializer)
+            types.FunctionType(code, globals(), "initializer")(*task['initargs'])
+            self.initialized.add(key)
 
     def run(self):
         while True:
@@ -162,6 +371,7 @@ class Worker(object):
             print 'Got task', task_id
             start_time = time.time()
             try:
+                self.initialize(task)
                 code = marshal.loads(task['function'])
                 function = types.FunctionType(code, globals(), "function")
                 result = map(function, task['batch'])
@@ -176,6 +386,7 @@ class Worker(object):
                 else:
                     os.rename(self.filename('cur', task_id),
                               self.filename('failed', task_id))
+                    self.log_completion(task_id, 'failed')
                 continue
             end_time = time.time()
             done = dict(start_time=start_time, end_time=end_time, 
@@ -186,10 +397,17 @@ class Worker(object):
                 pickle.dump(done, f)
             os.rename(self.filename('tmp', task_id), self.filename('done', task_id))
             os.unlink(self.filename('cur', task_id))
+            self.log_completion(task_id, '%f' % (end_time - start_time))
             if self.is_too_old():
                 print "I'm too old and will kill myself."
                 break
 
+    def log_completion(self, task_id, status):
+        # A single short write in append mode, so that lines of
+        # concurrent workers do not interleave.
+        with open(os.path.join(self.directory, 'completed.log'), 'a') as f:
+            f.write('%d %s\n' % (task_id, status))
+
     def filename(self, subdir, task_id):
         if subdir == 'cur':
             basename = 'j%da%dt%d' % (self.job_id, self.array_index, task_id)
@@ -198,6 +416,9 @@ class Worker(object):
         return os.path.join(self.directory, subdir, basename)
 
     def get_task(self):
+        # Tasks are submitted as others complete, so check again soon
+        # at first and back off while the queue stays empty.
+        wait = 0.1
         while True:
             tasks = os.listdir(os.path.join(self.directory, 'new'))
             if len(tasks) == 0:
@@ -205,7 +426,8 @@ class Worker(object):
                     return None
                 else:
                     print 'Waiting for more tasks to be submitted.'
-                    time.sleep(5)
+                    time.sleep(wait)
+                    wait = min(2 * wait, 5)
                     continue
             task_basename = tasks[random.randint(0, len(tasks) - 1)]
             new_filename = os.path.join(self.directory, 'new', task_basename)
@@ -234,8 +456,10 @@ class Worker(object):
 if __name__ == '__main__':
     if len(sys.argv) == 2:
         directory = sys.argv[1]
-        job_id = int(os.environ['LSB_JOBID'])
-        array_index = int(os.environ['LSB_JOBINDEX'])
+        # Workers started by hand, e.g. on another host sharing the
+        # directory, are identified by their process id.
+        job_id = int(os.environ.get('LSB_JOBID', os.getpid()))
+        array_index = int(os.environ.get('LSB_JOBINDEX', 0))
         worker = Worker(directory, job_id, array_index)
         worker.run()    
     elif len(sys.argv) == 1:
@@ -2,14 +2,15 @@ import sys
 import os
 import logging
 import json
+from collections import OrderedDict
 from optparse import OptionParser
 import progressbar
 import numpy as np
-from scipy.stats.stats import scoreatpercentile
 from scipy.stats import norm as Gaussian
 import cpa
 import cpa.dbconnect
 import cpa.util
+from .parallel import ParallelProcessor, Uniprocessing, run_digest
 
 logger = logging.getLogger(__name__)
 
@@ -20,11 +21,11 @@ def np_load(filename):
         f.close()
     return x
 
-def make_progress_bar(text=None):
+def make_progress_bar(text=None, maxval=None):
     widgets = (['%s: ' % text] if text else []) + [progressbar.Percentage(), ' ', 
                                                    progressbar.Bar(), ' ', 
                                                    progressbar.ETA()]
-    return progressbar.ProgressBar(widgets=widgets)
+    return progressbar.ProgressBar(widgets=widgets, maxval=maxval)
 
 def _check_directory(dir, resume):
     if os.path.exists(dir):
@@ -34,16 +35,31 @@ def _check_directory(dir, resume):
     else:
         os.makedirs(dir)
 
+def _create_cache_params_1((cache_dir, normalization_name, plate, imKeys, filename,
+                            approximate)):
+    from cpa.profiling.cache import Cache
+    from cpa.profiling.normalization import normalizations
+    normalizer = normalizations[normalization_name](Cache(cache_dir))
+    normalizer.approximate = approximate
+    normalizer._create_cache_params_1(plate, imKeys, filename)
+    return plate
+
 import abc
 class BaseNormalization(object):
     __metaclass__ = abc.ABCMeta
     
     _cached_colmask = None
+    # Number of plates whose parameters are kept in memory.
+    max_cached_plates = 100
+    # Compute the parameters from the per-image quantile sketches of
+    # the cache, if available, instead of loading the control cells.
+    approximate = False
 
     def __init__(self, cache, param_dir):
         self.cache = cache
         self.dir = os.path.join(cache.cache_dir, param_dir)
         self._colmask_filename = os.path.join(self.dir, 'colmask.npy')
+        self._cached_shift_scale = OrderedDict()
 
     def _params_filename(self, plate):
         return os.path.join(self.dir, 'params', 
@@ -58,6 +74,70 @@ class BaseNormalization(object):
     @abc.abstractmethod
     def normalize(self, plate, data):
         pass
+
+    def normalize_stats(self, plate, stats):
+        """
+        Return the SummaryStatistics of the normalized data given
+        those of the data of a plate.  Only possible for
+        normalizations that are affine transformations.
+        """
+        raise NotImplementedError
+
+    def normalize_sketch(self, plate, sketch):
+        """
+        Return the QuantileSketch of the normalized data given that of
+        the data of a plate.  Only possible for normalizations that
+        are affine transformations.
+        """
+        raise NotImplementedError
+
+    def _shift_and_scale(self, params):
+        """
+        Return the shift and scale vectors corresponding to the
+        parameters of a plate, for normalizations of the form 
+        (data - shift) / scale.
+        """
+        raise NotImplementedError
+
+    def _plate_shift_and_scale(self, plate):
+        """
+        Return the shift and scale vectors of the plate, restricted to
+        the columns of the column mask.  The vectors of the most
+        recently used plates are kept in memory, so the parameter file
+        of a plate is normally read only once.
+        """
+        try:
+            shift_and_scale = self._cached_shift_scale.pop(plate)
+        except KeyError:
+            params = np_load(self._params_filename(plate))
+            assert params.shape[1] == len(self._colmask)
+            shift, scale = self._shift_and_scale(params[:, self._colmask])
+            assert np.all(scale > 0)
+            shift_and_scale = (shift, scale)
+            if len(self._cached_shift_scale) >= self.max_cached_plates:
+                self._cached_shift_scale.popitem(last=False)
+        self._cached_shift_scale[plate] = shift_and_scale
+        return shift_and_scale
+
+    def _normalize_affine(self, plate, data):
+        assert data.shape[1] == len(self._colmask)
+        shift, scale = self._plate_shift_and_scale(plate)
+        # Selecting the columns copies the data, so the rest can be
+        # done in place without further temporary arrays.
+        data = data[:, self._colmask]
+        if data.dtype.kind != 'f':
+            data = data.astype(float)
+        data -= shift
+        data /= scale
+        return data
+
+    def _normalize_stats_affine(self, plate, stats):
+        shift, scale = self._plate_shift_and_scale(plate)
+        return stats.select(self._colmask).affine(shift, scale)
+
+    def _normalize_sketch_affine(self, plate, sketch):
+        shift, scale = self._plate_shift_and_scale(plate)
+        return sketch.select(self._colmask).affine(shift, scale)
         
     @property
     def colnames(self):
@@ -77,8 +157,8 @@ class BaseNormalization(object):
     # Methods to precompute the normalizations
     #
 
-    def _create_cache(self, predicate, resume=False):
-        self._create_cache_params(predicate, resume)
+    def _create_cache(self, predicate, resume=False, parallel=None):
+        self._create_cache_params(predicate, resume, parallel)
         self._create_cache_colmask(predicate)
 
     def _get_controls(self, predicate):
@@ -105,12 +185,21 @@ class BaseNormalization(object):
             else:
                 colmask &= nonzero
         np.save(self._colmask_filename, colmask)
+        self._cached_colmask = None
+        self._cached_shift_scale.clear()
             
     @abc.abstractmethod
     #@staticmethod
     def _compute_params(self, features):
         pass
 
+    def _compute_params_from_sketch(self, sketch):
+        """
+        Return the parameters computed from the QuantileSketch of the
+        features instead of the features themselves.
+        """
+        raise NotImplementedError
+
     @abc.abstractproperty
     def _null_param(self):
         """
@@ -129,6 +218,15 @@ class BaseNormalization(object):
         pass
         
     def _create_cache_params_1(self, plate, imKeys, filename):
+        if self.approximate:
+            sketch = self.cache.load_sketch(imKeys)
+            if sketch is not None and sketch.count > 0:
+                try:
+                    np.save(filename, self._compute_params_from_sketch(sketch))
+                    self._cached_shift_scale.pop(plate, None)
+                    return
+                except NotImplementedError:
+                    pass
         features = self.cache.load(imKeys)[0]
         if len(features) == 0:
             logger.warning('No DMSO features for plate %s' % str(plate))
@@ -136,16 +234,55 @@ class BaseNormalization(object):
         else:
             params = self._compute_params(features)
         np.save(filename, params)
+        self._cached_shift_scale.pop(plate, None)
 
-    def _create_cache_params(self, predicate, resume=False):
+    def _create_cache_params(self, predicate, resume=False, parallel=None):
         controls = self._get_controls(predicate)
-        for i, (plate, imKeys) in enumerate(make_progress_bar('Params')(controls.items())):
-            filename = self._params_filename(plate)
-            if i == 0:
-                _check_directory(os.path.dirname(filename), resume)
-            if resume and os.path.exists(filename):
-                continue
-            self._create_cache_params_1(plate, imKeys, filename)
+        if len(controls) > 0:
+            filename = self._params_filename(controls.keys()[0])
+            _check_directory(os.path.dirname(filename), resume)
+        self._create_cache_params_plates([(plate, imKeys) 
+                                          for plate, imKeys in controls.items()
+                                          if not (resume and 
+                                                  os.path.exists(self._params_filename(plate)))],
+                                         parallel)
+
+    def _create_cache_params_plates(self, plates_and_images, parallel=None):
+        """
+        Compute the parameters of the plates, one task per plate.
+        """
+        parallel = parallel or Uniprocessing()
+        parameters = [(self.cache.cache_dir, self.__class__.__name__, plate, 
+                       imKeys, self._params_filename(plate), self.approximate)
+                      for plate, imKeys in plates_and_images]
+        # Each class and set of plates has its own view, as an LSF view
+        # resumes the tasks of an earlier run with the same name.  The
+        # manifest entries of the images tell an update of the same
+        # plates from the initial run.
+        manifest = self.cache.get_manifest() or {}
+        fingerprints = [[manifest.get(tuple(imKey)) for imKey in imKeys]
+                        for plate, imKeys in plates_and_images]
+        view = parallel.view('normalization.params.%s.%s' % 
+                             (self.__class__.__name__, 
+                              run_digest((parameters, fingerprints))))
+        results = view.imap(_create_cache_params_1, parameters)
+        for plate in make_progress_bar('Params', len(parameters))(results):
+            self._cached_shift_scale.pop(plate, None)
+
+    def _update_cache(self, predicate, plates, parallel=None):
+        """
+        Recompute the parameters of the given plates, e.g. the plates
+        rewritten by Cache._update_cache(), and then the column mask.
+        """
+        controls = self._get_controls(predicate)
+        plates = [plate for plate in plates if plate in controls]
+        if len(plates) > 0:
+            params_dir = os.path.dirname(self._params_filename(plates[0]))
+            if not os.path.exists(params_dir):
+                os.makedirs(params_dir)
+        self._create_cache_params_plates([(plate, controls[plate]) for plate in plates],
+                                         parallel)
+        self._create_cache_colmask(predicate)
             
             
             
@@ -156,6 +293,12 @@ class DummyNormalization(BaseNormalization):
     def normalize(self, plate, data):
         return data
 
+    def normalize_stats(self, plate, stats):
+        return stats
+
+    def normalize_sketch(self, plate, sketch):
+        return sketch
+
     def _null_param(self):
         return np.zeros((0, len(self.cache.colnames)))
         
@@ -174,22 +317,20 @@ class StdNormalization(BaseNormalization):
         super(StdNormalization, self).__init__(cache, param_dir)
 
     def normalize(self, plate, data):
-        params = np_load(self._params_filename(plate))
-        assert data.shape[1] == params.shape[1]
-        data = data[:, self._colmask]
-        params = params[:, self._colmask]
-        shift = params[0]
-        scale = params[1]
-        assert np.all(scale > 0)
-        return (data - shift) / scale
+        return self._normalize_affine(plate, data)
+
+    def normalize_stats(self, plate, stats):
+        return self._normalize_stats_affine(plate, stats)
+
+    def normalize_sketch(self, plate, sketch):
+        return self._normalize_sketch_affine(plate, sketch)
+
+    def _shift_and_scale(self, params):
+        return params[0], params[1]
 
     def _compute_params(self, features):
-        m = features.shape[1]
-        params = np.ones((2, m)) * np.nan
-        for j in xrange(m):
-            params[0, j] = np.mean(features[:, j])
-            params[1, j] = np.std(features[:, j])
-        return params                   
+        return np.vstack((np.mean(features, axis=0), 
+                          np.std(features, axis=0)))
 
     def _null_param(self):
         return np.zeros((0, len(self.cache.colnames)))
@@ -202,14 +343,13 @@ class RobustStdNormalization(StdNormalization):
         super(RobustStdNormalization, self).__init__(cache, param_dir)
         
     def _compute_params(self, features):
-        m = features.shape[1]
-        params = np.ones((2, m)) * np.nan
         c = Gaussian.ppf(3/4.)
-        for j in xrange(m):
-            d = np.median(features[:, j])
-            params[0, j] = d
-            params[1, j] = np.median(np.fabs(features[:, j] - d) / c)
-        return params                   
+        d = np.median(features, axis=0)
+        return np.vstack((d, np.median(np.fabs(features - d), axis=0) / c))
+
+    def _compute_params_from_sketch(self, sketch):
+        d = sketch.median()
+        return np.vstack((d, sketch.mad(d) / Gaussian.ppf(3/4.)))
 
 class RobustLinearNormalization(BaseNormalization):
     def __init__(self, cache, param_dir='robust_linear', lower_q=1, upper_q=99):
@@ -218,21 +358,22 @@ class RobustLinearNormalization(BaseNormalization):
         self.upper_q = upper_q
         
     def normalize(self, plate, data):
-        percentiles = np_load(self._params_filename(plate))
-        assert data.shape[1] == percentiles.shape[1]
-        data = data[:, self._colmask]
-        percentiles = percentiles[:, self._colmask]
-        divisor = (percentiles[1] - percentiles[0])
-        assert np.all(divisor > 0)
-        return (data - percentiles[0]) / divisor
+        return self._normalize_affine(plate, data)
+
+    def normalize_stats(self, plate, stats):
+        return self._normalize_stats_affine(plate, stats)
+
+    def normalize_sketch(self, plate, sketch):
+        return self._normalize_sketch_affine(plate, sketch)
+
+    def _shift_and_scale(self, percentiles):
+        return percentiles[0], percentiles[1] - percentiles[0]
         
     def _compute_params(self, features):
-        m = features.shape[1]
-        percentiles = np.ones((2, m)) * np.nan
-        for j in xrange(m):
-            percentiles[0, j] = scoreatpercentile(features[:, j], self.lower_q)
-            percentiles[1, j] = scoreatpercentile(features[:, j], self.upper_q)
-        return percentiles
+        return np.percentile(features, [self.lower_q, self.upper_q], axis=0)
+
+    def _compute_params_from_sketch(self, sketch):
+        return sketch.quantiles([self.lower_q / 100., self.upper_q / 100.])
 
     def _null_param(self):
         return np.zeros((0, len(self.cache.colnames)))
@@ -249,10 +390,15 @@ normalizations = dict((c.__name__, c)
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
 
-    parser = OptionParser("usage: %prog [-r] [-m method] PROPERTIES-FILE CACHE-DIR PREDICATE")
+    parser = OptionParser("usage: %prog [-r] [-m method] [options] PROPERTIES-FILE CACHE-DIR PREDICATE")
     parser.add_option('-m', '--method', dest='method', action='store', default='RobustStdNormalization', help='method')
+    parser.add_option('-r', dest='resume', action='store_true', help='resume')
+    parser.add_option('--approximate', dest='approximate', action='store_true',
+                      help='compute the parameters from the quantile sketches of the cache')
+    ParallelProcessor.add_options(parser)
     
     options, args = parser.parse_args()
+    parallel = ParallelProcessor.create_from_options(parser, options)
 
     if len(args) != 3:
         parser.error('Incorrect number of arguments')
@@ -263,4 +409,5 @@ if __name__ == '__main__':
     from cpa.profiling.cache import Cache
     cache = Cache(cache_dir)
     normalizer = normalizations[options.method](cache)
-    normalizer._create_cache(predicate)
+    normalizer.approximate = bool(options.approximate)
+    normalizer._create_cache(predicate, options.resume, parallel)
@@ -1,16 +1,145 @@
+import os
 import logging
 import itertools
+import hashlib
+import cPickle
+import tempfile
 from optparse import OptionGroup
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
+# Objects kept by the current worker process across tasks.
+_worker_memo = {}
+
+def worker_local(key, factory, *args):
+    """
+    Return the object stored under KEY in the memo of the current
+    worker process, creating it as factory(*args) the first time.
+    Task functions use this for objects that are expensive to set up
+    and the same for many tasks, such as a Cache or a preprocessor,
+    so that they are built once per worker rather than once per task.
+    """
+    try:
+        return _worker_memo[key]
+    except KeyError:
+        value = _worker_memo[key] = factory(*args)
+        return value
+
+def clear_worker_memo():
+    _worker_memo.clear()
+
+def _remember(key, value):
+    _worker_memo[key] = value
+
+def _load_broadcast(filename):
+    if filename.endswith('.npy'):
+        return np.load(filename, mmap_mode='r')
+    with open(filename, 'rb') as f:
+        return cPickle.load(f)
+
+class Broadcast(object):
+    """
+    Handle of a value published with broadcast().  The handle is
+    small, so it can be passed in the parameters of every task
+    instead of the value itself; get() loads the value once per
+    worker process.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def get(self):
+        return worker_local(('broadcast', self.filename), _load_broadcast, 
+                            self.filename)
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+
+def broadcast(value, directory=None):
+    """
+    Write VALUE to a file in DIRECTORY (by default a temporary
+    directory on the local machine) and return a Broadcast handle to
+    it.  NumPy arrays are stored as .npy files, which the workers
+    memory-map and therefore share through the page cache; other
+    values are pickled.  The file is named after the contents, so
+    publishing the same value again (e.g., in a resumed run) reuses
+    the file.
+    """
+    if directory is None:
+        directory = os.path.join(tempfile.gettempdir(), 'cpa-broadcast')
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+    digest = hashlib.sha1(data).hexdigest()
+    is_array = isinstance(value, np.ndarray) and not value.dtype.hasobject
+    filename = os.path.join(directory, digest + ('.npy' if is_array else '.pickle'))
+    if not os.path.exists(filename):
+        import cpa.util
+        with cpa.util.replace_atomically(filename) as f:
+            if is_array:
+                np.save(f, value)
+            else:
+                f.write(data)
+    return Broadcast(filename)
+
+def run_digest(value):
+    """
+    Return a short digest of a picklable value, such as the
+    parameters of a run.  Adding it to a view name makes the view
+    specific to the run, as backends that resume by view name (LSF)
+    would otherwise return the results of an earlier run with
+    different parameters.
+    """
+    return hashlib.sha1(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)).hexdigest()[:12]
+
+_initializer_tokens = itertools.count()
+
+class _InitializedFunction(object):
+    """
+    Picklable wrapper that calls initializer(*initargs) once in each
+    worker process before the first call of the function.
+    """
+
+    def __init__(self, function, initializer, initargs):
+        self.function = function
+        self.initializer = initializer
+        self.initargs = initargs
+        # Identifies this imap call in the worker memo.
+        self.token = ('initializer', os.getpid(), _initializer_tokens.next())
+
+    def __call__(self, args):
+        worker_local(self.token, self.initializer, *self.initargs)
+        return self.function(args)
+
+
 class ParallelProcessor(object):
     """
     A ParallelProcessor has a method view() that takes an optional
     keyword argument "name".  This method returns a view.  A view is
-    an object that has an imap method.
+    an object that has an imap method:
+
+        imap(function, parameters, chunksize=None, initializer=None, initargs=())
+
+    The function is applied to each of the parameters and the results
+    are returned in order.  If an initializer is given, each worker
+    process calls initializer(*initargs) before its first task.  The
+    parameters are sent to the workers CHUNKSIZE at a time (None for
+    the default of the backend).
 
     """
+    # Default chunksize for callers that do not choose one.
+    chunksize = None
+
+    def broadcast(self, value):
+        """Publish a value to the workers and return a handle to pass
+        to the tasks instead (see broadcast())."""
+        return broadcast(value)
 
     @classmethod
     def add_options(cls, parser):
@@ -24,12 +153,20 @@ class ParallelProcessor(object):
         group.add_option('--multiprocessing', dest='multiprocessing', 
                          help='use multiprocessing on the local machine', 
                          action='store_true')
+        group.add_option('--local-workers', dest='local_workers', type='int',
+                         metavar='N',
+                         help='use the cpa.profiling.lsf interface with N worker processes on the local machine (with --lsf-directory, or a temporary directory)')
         group.add_option('--memory', dest='memory',
                          help='main memory requirement in gigabytes')
         group.add_option('--njobs', dest='njobs', type='int', default=50,
                          help='number of jobs to start on LSF')
         group.add_option('--jobname', dest='jobname', default='CPA',
                          help='job name on LSF')
+        group.add_option('--chunksize', dest='chunksize', type='int',
+                         help='number of tasks to send to a worker at a time')
+        group.add_option('--checkpoint-directory', dest='checkpoint_directory',
+                         metavar='/path/to/checkpoint/directory',
+                         help='store the results of completed tasks here, so that an interrupted run can be resumed')
         parser.add_option_group(group)
 
     @classmethod
@@ -52,30 +189,136 @@ class ParallelProcessor(object):
     @classmethod
     def create_from_options(cls, parser, options):
         noptions = ((options.ipython_profile and 1 or 0) +
-                    (options.lsf_directory and 1 or 0) + 
+                    ((options.lsf_directory or options.local_workers) and 1 or 0) + 
                     (options.multiprocessing and 1 or 0))
         if noptions > 1:
             parser.error('You can only specify one of --ipython-profile, --lsf-directory, and --multiprocessing.')
-        if options.lsf_directory:
+        if options.local_workers:
             import lsf
-            return lsf.LSF(options.njobs, options.lsf_directory, memory=options.memory, job_array_name = options.jobname)
+            parallel = lsf.LocalLSF(options.local_workers, options.lsf_directory)
+        elif options.lsf_directory:
+            import lsf
+            parallel = lsf.LSF(options.njobs, options.lsf_directory, memory=options.memory, job_array_name = options.jobname)
         elif options.ipython_profile:
             from IPython.parallel import Client, LoadBalancedView
             client = Client(profile=options.ipython_profile)
-            return IPython(client)
+            parallel = IPython(client)
         elif options.multiprocessing:
-            return Multiprocessing()
+            parallel = Multiprocessing()
         else:
-            return Uniprocessing()
+            parallel = Uniprocessing()
+        parallel.chunksize = options.chunksize
+        if options.checkpoint_directory:
+            parallel = Checkpointing(parallel, options.checkpoint_directory)
+        return parallel
+
+
+class Checkpointing(ParallelProcessor):
+    """
+    Wraps another ParallelProcessor and stores the result of each
+    completed task in a directory, so that a run that is interrupted
+    can be restarted without recomputing the tasks that finished.
+    """
+
+    def __init__(self, parallel, directory):
+        self.parallel = parallel
+        self.directory = directory
+        self.chunksize = getattr(parallel, 'chunksize', None)
+
+    def broadcast(self, value):
+        return self.parallel.broadcast(value)
+
+    def view(self, name=None):
+        return CheckpointView(self.parallel.view(name), 
+                              os.path.join(self.directory, name or 'default'))
+
+class CheckpointView(object):
+    """
+    The results are appended to a file keyed by a hash of the
+    function and the parameters, as pickled (task index, result)
+    records.  A later imap with the same function and parameters
+    reads the file and only runs the tasks that are missing from it.
+    """
+
+    def __init__(self, view, directory):
+        self.view = view
+        self.directory = directory
+
+    def filename(self, function, parameters):
+        digest = hashlib.sha1()
+        digest.update('%s.%s' % (function.__module__, function.__name__))
+        digest.update(cPickle.dumps(parameters, cPickle.HIGHEST_PROTOCOL))
+        return os.path.join(self.directory, digest.hexdigest() + '.pickle')
+
+    def read_checkpoint(self, filename):
+        results = {}
+        if os.path.exists(filename):
+            with open(filename, 'r+b') as f:
+                while True:
+                    valid_length = f.tell()
+                    try:
+                        index, result = cPickle.load(f)
+                    except (EOFError, cPickle.UnpicklingError, ValueError):
+                        # The last record may be incomplete if the
+                        # run was killed while writing it; drop it
+                        # before appending to the file.
+                        f.truncate(valid_length)
+                        break
+                    results[index] = result
+        return results
+
+    def imap(self, function, parameters, chunksize=None, initializer=None, initargs=()):
+        parameters = list(parameters)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        filename = self.filename(function, parameters)
+        done = self.read_checkpoint(filename)
+        if done:
+            logger.info('Resuming from %s: %d of %d tasks done' % 
+                        (filename, len(done), len(parameters)))
+        remaining = [i for i in range(len(parameters)) if i not in done]
+        results = self.view.imap(function, [parameters[i] for i in remaining],
+                                 chunksize=chunksize, initializer=initializer,
+                                 initargs=initargs)
+        with open(filename, 'ab') as f:
+            for i in range(len(parameters)):
+                if i in done:
+                    yield done.pop(i)
+                else:
+                    result = results.next()
+                    cPickle.dump((i, result), f, cPickle.HIGHEST_PROTOCOL)
+                    f.flush()
+                    yield result
 
 
 class IPython(ParallelProcessor):
     def __init__(self, client):
         self.client = client
 
+    def broadcast(self, value):
+        """
+        Publish a value by pushing it into the worker memo of every
+        engine, under the key that Broadcast.get() looks up, since
+        the engines need not share a file system with this process.
+        The local file is still written for tasks that are retried
+        locally.  Engines started later do not have the value.
+        """
+        handle = broadcast(value)
+        self.client[:].apply_sync(_remember, ('broadcast', handle.filename), value)
+        return handle
+
     def view(self, name=None):
         logger.debug('%s: %d iPython engines' % (name, len(self.client.ids)))
-        return self.client.load_balanced_view()
+        return IPythonView(self.client.load_balanced_view())
+
+class IPythonView(object):
+    def __init__(self, view):
+        self.view = view
+
+    def imap(self, function, parameters, chunksize=None, initializer=None, initargs=()):
+        if initializer is not None:
+            function = _InitializedFunction(function, initializer, initargs)
+        return self.view.imap(function, parameters, chunksize=chunksize or 1)
 
 
 class Multiprocessing(ParallelProcessor): 
@@ -88,7 +331,16 @@ class Multiprocessing(ParallelProcessor):
         self.pool = Pool()
 
     def view(self, name=None):
-        return self.pool
+        return MultiprocessingView(self.pool)
+
+class MultiprocessingView(object):
+    def __init__(self, pool):
+        self.pool = pool
+
+    def imap(self, function, parameters, chunksize=None, initializer=None, initargs=()):
+        if initializer is not None:
+            function = _InitializedFunction(function, initializer, initargs)
+        return self.pool.imap(function, parameters, chunksize or 1)
 
 
 class Uniprocessing(ParallelProcessor):
@@ -97,7 +349,10 @@ class Uniprocessing(ParallelProcessor):
         return UniprocessingView()
 
 class UniprocessingView(object):
-    imap = itertools.imap
+    def imap(self, function, parameters, chunksize=None, initializer=None, initargs=()):
+        if initializer is not None:
+            initializer(*initargs)
+        return itertools.imap(function, parameters)
 
 def test_function((seconds)):
     import time
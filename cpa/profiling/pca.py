@@ -7,7 +7,8 @@ import numpy as np
 import mdp.nodes as nodes
 import cpa.util
 from .cache import Cache
-from .preprocessing import Preprocessor, VariableSelector
+from .preprocessing import (Preprocessor, VariableSelector, add_incremental_options, 
+                            incremental_scatter)
 
 logger = logging.getLogger(__name__)
             
@@ -41,6 +42,44 @@ class PCAPreprocessor(Preprocessor):
         return self.pca_node.execute(data)
 
 
+class _CovariancePCANode(object):
+    """The principal components of a covariance matrix, with the
+    execute() method of mdp's PCANode."""
+
+    def __init__(self, mean, covariance, npcs):
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1][:npcs]
+        self.avg = mean
+        self.d = eigenvalues[order]
+        self.v = eigenvectors[:, order]
+
+    def execute(self, data):
+        return np.dot(data - self.avg, self.v)
+
+
+class IncrementalPCAPreprocessor(PCAPreprocessor):
+    """
+    PCA preprocessor trained from the ScatterMatrix of the training
+    cells instead of the cells themselves, so that it can be trained
+    on all the cells of the cache (see preprocessing.compute_scatter).
+    """
+
+    def __init__(self, scatter, input_variables, npcs):
+        assert len(scatter.mean) == len(input_variables)
+        self.input_variables = input_variables
+        self.npcs = npcs
+        self.variables = ['PC %d' % (i + 1) for i in range(self.npcs)]
+        self._train(scatter)
+
+    def _train(self, scatter):
+        nvariables = len(scatter.mean)
+        if self.npcs > nvariables:
+            raise ValueError('Cannot find more principal components than the '
+                             'number of variables ({0})'.format(nvariables))
+        self.pca_node = _CovariancePCANode(scatter.mean, scatter.covariance(ddof=1), 
+                                           self.npcs)
+
+
 def _main(args=None):
     # Import the module under its full name so the class can be found
     # when unpickling.
@@ -48,17 +87,23 @@ def _main(args=None):
 
     logging.basicConfig(level=logging.DEBUG)
  
-    parser = OptionParser("usage: %prog [options] SUBSAMPLE-FILE NPCS OUTPUT-FILE")
+    parser = OptionParser("usage: %prog [options] SUBSAMPLE-FILE NPCS OUTPUT-FILE\n"
+                          "       %prog [options] --incremental PROPERTIES-FILE CACHE-DIR NPCS OUTPUT-FILE")
+    add_incremental_options(parser)
     options, args = parser.parse_args(args)
-    if len(args) != 3:
+    if len(args) != (4 if options.incremental else 3):
         parser.error('Incorrect number of arguments')
-    subsample_file = args[0]
-    npcs = int(args[1])
-    output_file = args[2]
+    npcs = int(args[-2])
+    output_file = args[-1]
 
-    subsample = cpa.util.unpickle1(subsample_file)
-    preprocessor = cpa.profiling.pca.PCAPreprocessor(
-        standardize(subsample.data), subsample.variables, npcs)
+    if options.incremental:
+        scatter, variables = incremental_scatter(parser, options, *args[:2])
+        preprocessor = cpa.profiling.pca.IncrementalPCAPreprocessor(
+            scatter.standardized(), variables, npcs)
+    else:
+        subsample = cpa.util.unpickle1(args[0])
+        preprocessor = cpa.profiling.pca.PCAPreprocessor(
+            standardize(subsample.data), subsample.variables, npcs)
     cpa.util.pickle(output_file, preprocessor)
 
 if __name__ == '__main__':
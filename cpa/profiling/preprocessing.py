@@ -1,3 +1,4 @@
+import numpy as np
 import cpa.util
 
 
@@ -21,3 +22,124 @@ class VariableSelector(Preprocessor):
 
     def __call__(self, data):
         return data[:, self.mask]
+
+
+class ScatterMatrix(object):
+    """
+    Number, mean, and scatter matrix (the sum of the outer products
+    of the centered rows) of a set of cells.  The scatter matrices of
+    disjoint sets of cells can be merged, so they can be accumulated
+    block by block and plate by plate, in bounded memory.
+    """
+
+    def __init__(self, count, mean, scatter):
+        self.count = count
+        self.mean = mean
+        self.scatter = scatter
+
+    @classmethod
+    def from_data(cls, data):
+        data = np.asarray(data, dtype=float)
+        if len(data) == 0:
+            ncols = data.shape[1]
+            return cls(0, np.zeros(ncols), np.zeros((ncols, ncols)))
+        mean = data.mean(axis=0)
+        centered = data - mean
+        return cls(len(data), mean, np.dot(centered.T, centered))
+
+    def merge(self, other):
+        count = self.count + other.count
+        if count == 0:
+            return self
+        delta = other.mean - self.mean
+        return ScatterMatrix(count, self.mean + delta * other.count / float(count),
+                             self.scatter + other.scatter + 
+                             np.outer(delta, delta) * self.count * other.count / float(count))
+
+    def covariance(self, ddof=0):
+        return self.scatter / (self.count - ddof)
+
+    def std(self):
+        return np.sqrt(self.scatter.diagonal() / self.count)
+
+    def standardized(self):
+        """Return the scatter matrix of the standardized cells (see
+        pca.standardize)."""
+        std = self.std()
+        return ScatterMatrix(self.count, np.zeros(len(self.mean)),
+                             self.scatter / np.outer(std, std))
+
+
+def _compute_plate_scatter((cache_dir, normalization_name, image_keys, batch_rows)):
+    """Return the ScatterMatrix of the normalized cells of the images,
+    accumulated BATCH_ROWS cells at a time."""
+    import numpy as np
+    from cpa.profiling.cache import Cache
+    from cpa.profiling.normalization import normalizations
+    from cpa.profiling.parallel import worker_local
+    from cpa.profiling.preprocessing import ScatterMatrix
+    cache = worker_local(('cache', cache_dir), Cache, cache_dir)
+    normalization = normalizations[normalization_name]
+    total = None
+    for features, _ in cache.iter_batches(image_keys, normalization, batch_rows=batch_rows):
+        features = features[~np.any(np.isnan(features), axis=1)]
+        scatter = ScatterMatrix.from_data(features)
+        total = scatter if total is None else total.merge(scatter)
+    return total
+
+def compute_scatter(cache_dir, image_keys, normalization, parallel, batch_rows=10000,
+                    show_progress=True):
+    """
+    Return the ScatterMatrix of the normalized cells of the images
+    (None if there are none), computed by one task per plate that
+    reads the plate's cells BATCH_ROWS at a time.  The incremental
+    preprocessors are trained from it without loading all the cells.
+    """
+    from .cache import Cache, make_progress_bar
+    cache = Cache(cache_dir)
+    keys_per_plate = {}
+    for image_key in image_keys:
+        keys_per_plate.setdefault(cache._plate_map[image_key], []).append(image_key)
+    parameters = [(cache_dir, normalization.__name__, keys_per_plate[plate], batch_rows)
+                  for plate in sorted(keys_per_plate.keys())]
+    results = parallel.view('preprocessing.scatter').imap(_compute_plate_scatter, parameters)
+    if show_progress:
+        results = make_progress_bar('Scatter matrix', len(parameters))(results)
+    total = None
+    for scatter in results:
+        if scatter is not None:
+            total = scatter if total is None else total.merge(scatter)
+    return total
+
+def add_incremental_options(parser):
+    """Add the options for training a preprocessor incrementally on
+    the cells of the cache (see incremental_scatter)."""
+    from .parallel import ParallelProcessor
+    ParallelProcessor.add_options(parser)
+    parser.add_option('--incremental', dest='incremental', action='store_true', default=False,
+                      help='train on all the cells of the cache instead of a subsample')
+    parser.add_option('-f', dest='filter', help='only train on images matching this CPAnalyst filter (with --incremental)')
+    parser.add_option('--normalization', help='normalization method (default: RobustLinearNormalization)',
+                      default='RobustLinearNormalization')
+    parser.add_option('--batch-rows', dest='batch_rows', type='int', default=10000,
+                      help='number of cells read at a time (with --incremental, default: 10000)')
+
+def incremental_scatter(parser, options, properties_file, cache_dir):
+    """Return the ScatterMatrix of the cells of the cache and the
+    names of the variables, as selected by the options."""
+    import cpa
+    from .cache import Cache
+    from .normalization import normalizations
+    from .parallel import ParallelProcessor
+    parallel = ParallelProcessor.create_from_options(parser, options)
+    cpa.properties.LoadFile(properties_file)
+    if options.filter is None:
+        image_keys = cpa.db.GetAllImageKeys()
+    else:
+        image_keys = cpa.db.GetFilteredImages(options.filter)
+    normalization = normalizations[options.normalization]
+    scatter = compute_scatter(cache_dir, image_keys, normalization, parallel,
+                              batch_rows=options.batch_rows)
+    if scatter is None or scatter.count < 2:
+        parser.error('Too few cells to train on')
+    return scatter, normalization(Cache(cache_dir)).colnames
@@ -1,17 +1,22 @@
 #!/usr/bin/env python
 
 def _compute_mixture_probabilities((cache_dir, normalization_name, 
-                                    preprocess_file, images, gmm, meanvector, 
-                                    loadings)):
+                                    preprocess_file, images, model)):
     import numpy as np        
-    from cpa.profiling import cache
-    cache = Cache(cache_dir)
+    import cpa.util
+    from cpa.profiling.cache import Cache
+    from cpa.profiling.normalization import normalizations
+    from cpa.profiling.parallel import worker_local
+    # The model is the same for all tasks, so it is broadcast once.
+    gmm, meanvector, loadings = model.get()
+    cache = worker_local(('cache', cache_dir), Cache, cache_dir)
     normalization = normalizations[normalization_name]
     normalizeddata, normalized_colnames, _ = cache.load(images, normalization=normalization)
     if len(normalizeddata) == 0:
         return np.empty(len(normalized_colnames)) * np.nan
     if preprocess_file:
-        preprocessor = cpa.util.unpickle1(preprocess_file)
+        preprocessor = worker_local(('preprocessor', preprocess_file),
+                                    cpa.util.unpickle1, preprocess_file)
         normalizeddata = preprocessor(normalizeddata)
     if len(normalizeddata) == 0:
         return np.empty(len(normalized_colnames)) * np.nan
@@ -20,27 +25,192 @@ def _compute_mixture_probabilities((cache_dir, normalization_name,
     mixture_probabilities = gmm.predict_proba(projected)
     return mixture_probabilities.mean(0)
 
+def _compute_plate_posteriors((cache_dir, normalization_name, preprocess_file,
+                               images, model)):
+    """
+    Return a list of (image key, (sum of the posterior probabilities
+    of the cells, number of cells)) pairs for the images of a plate,
+    which are visited in storage order and loaded once each.
+    """
+    import numpy as np
+    import cpa.util
+    from cpa.profiling.cache import Cache
+    from cpa.profiling.normalization import normalizations
+    from cpa.profiling.parallel import worker_local
+    gmm, meanvector, loadings = model.get()
+    cache = worker_local(('cache', cache_dir), Cache, cache_dir)
+    normalization = normalizations[normalization_name]
+    preprocessor = None
+    if preprocess_file:
+        preprocessor = worker_local(('preprocessor', preprocess_file),
+                                    cpa.util.unpickle1, preprocess_file)
+    results = []
+    for image in cache.storage_order(images):
+        data, colnames, _ = cache.load([image], normalization=normalization)
+        if len(data) > 0 and preprocessor:
+            data = preprocessor(data)
+        if len(data) == 0:
+            results.append((image, (np.zeros(len(gmm.weights_)), 0)))
+            continue
+        posteriors = gmm.predict_proba(np.dot(data - meanvector, loadings))
+        results.append((image, (posteriors.sum(0), len(posteriors))))
+    return results
+
 import logging
 import sys
 import os
 from optparse import OptionParser
 import numpy as np
 from scipy import linalg
-from sklearn.mixture import GMM
 import cpa
 from .cache import Cache
 from normalization import RobustLinearNormalization, normalizations
-from .profiles import Profiles, add_common_options
+from .profiles import Profiles, add_common_options, compute_plate_major, images_per_plate
 from .parallel import ParallelProcessor, Uniprocessing
     
+
+def _logsumexp(a):
+    m = a.max(axis=1)
+    return m + np.log(np.exp(a - m[:, np.newaxis]).sum(axis=1))
+
+
+class OnlineGMM(object):
+    """
+    Gaussian mixture with diagonal covariances, fitted by stepwise
+    (online) EM on mini-batches of cells, so that it can be fitted on
+    all the cells of the cache in bounded memory.  After each batch,
+    the running averages of the sufficient statistics (per cell) are
+    moved towards those of the batch by a step size of (t + 2) **
+    -DECAY, and the parameters are reestimated from them.
+
+    It has the attributes of scikit-learn's GMM used here (weights_,
+    means_, covars_, and predict_proba), so the two can be used in
+    the same way.
+    """
+
+    min_covar = 1e-3
+
+    def __init__(self, ncomponents, decay=0.7, random_state=None):
+        self.ncomponents = ncomponents
+        self.decay = decay
+        self.random_state = np.random.RandomState(random_state)
+        self._statistics = None
+        self._nbatches = 0
+
+    def initialize(self, data):
+        """Initialize the means to random cells of DATA and the
+        variances to those of DATA."""
+        data = np.asarray(data, dtype=float)
+        indices = self.random_state.permutation(len(data))[:self.ncomponents]
+        self.means_ = data[indices]
+        self.covars_ = np.tile(data.var(axis=0) + self.min_covar, (len(indices), 1))
+        self.weights_ = np.ones(len(indices)) / len(indices)
+        self._statistics = None
+        self._nbatches = 0
+        return self
+
+    def _log_responsibilities(self, data):
+        log_densities = -0.5 * (data.shape[1] * np.log(2 * np.pi)
+                                + np.log(self.covars_).sum(1)
+                                + (self.means_ ** 2 / self.covars_).sum(1)
+                                - 2 * np.dot(data, (self.means_ / self.covars_).T)
+                                + np.dot(data ** 2, (1.0 / self.covars_).T))
+        weighted = log_densities + np.log(self.weights_)
+        return weighted - _logsumexp(weighted)[:, np.newaxis]
+
+    def predict_proba(self, data):
+        return np.exp(self._log_responsibilities(np.asarray(data, dtype=float)))
+
+    def partial_fit(self, data):
+        """Do one stepwise EM update on a batch of cells."""
+        data = np.asarray(data, dtype=float)
+        if len(data) == 0:
+            return self
+        responsibilities = self.predict_proba(data)
+        batch = (responsibilities.sum(0) / len(data),
+                 np.dot(responsibilities.T, data) / len(data),
+                 np.dot(responsibilities.T, data ** 2) / len(data))
+        if self._statistics is None:
+            self._statistics = batch
+        else:
+            step = (self._nbatches + 2) ** -self.decay
+            self._statistics = tuple((1 - step) * s + step * b 
+                                     for s, b in zip(self._statistics, batch))
+        self._nbatches += 1
+        weights, sums, squares = self._statistics
+        denominators = weights[:, np.newaxis] + 10 * np.finfo(float).eps
+        self.weights_ = weights / weights.sum()
+        self.means_ = sums / denominators
+        self.covars_ = np.maximum(squares / denominators - self.means_ ** 2, 0) + self.min_covar
+        return self
+
+def _iter_projected_batches(cache, image_keys, normalization, preprocessor, meanvector,
+                            loadings, batch_rows, random_state, shuffle_batches=10):
+    """
+    Yield mini-batches of BATCH_ROWS projected cells of the images,
+    which are visited in a random order.  The cells pass through a
+    buffer of SHUFFLE_BATCHES batches from which each batch is drawn
+    at random, so that a batch mixes cells of several images and
+    plates rather than following the layout of the cache.
+    """
+    images = [image_keys[i] for i in random_state.permutation(len(image_keys))]
+    buffer = np.zeros((0, loadings.shape[1]))
+    for features, _ in cache.iter_batches(images, normalization, batch_rows=batch_rows,
+                                          readahead=2, in_storage_order=False):
+        if preprocessor:
+            features = preprocessor(features)
+        buffer = np.vstack((buffer, np.dot(features - meanvector, loadings)))
+        while len(buffer) >= shuffle_batches * batch_rows:
+            buffer = buffer[random_state.permutation(len(buffer))]
+            yield buffer[:batch_rows]
+            buffer = buffer[batch_rows:]
+    buffer = buffer[random_state.permutation(len(buffer))]
+    for start in xrange(0, len(buffer), batch_rows):
+        yield buffer[start:start + batch_rows]
+
+def fit_online(gmm, cache, image_keys, normalization, preprocessor, meanvector, loadings,
+               epochs=1, batch_rows=10000, seed=None):
+    """
+    Fit GMM (an initialized OnlineGMM) by stepwise EM on the cells of
+    the images, projected on the LOADINGS, EPOCHS times.  Each epoch
+    visits the images and cells in a new random order, drawn from a
+    random state seeded with SEED, so the decaying step size does not
+    favor the plates that happen to be stored last.
+    """
+    random_state = np.random.RandomState(seed)
+    image_keys = sorted(image_keys)
+    for epoch in range(epochs):
+        for batch in _iter_projected_batches(cache, image_keys, normalization,
+                                             preprocessor, meanvector, loadings,
+                                             batch_rows, random_state):
+            gmm.partial_fit(batch)
+    return gmm
+
 def profile_gmm(cache_dir, subsample_file, group_name, ncomponents=50, 
                 filter=None, parallel=Uniprocessing(),
-                normalization=RobustLinearNormalization, preprocess_file=None):
+                normalization=RobustLinearNormalization, preprocess_file=None,
+                online=False, epochs=1, batch_rows=10000, plate_major=False,
+                show_progress=True, seed=None):
+    """
+    Compute the profiles of the groups as the average posterior
+    probabilities of the components of a Gaussian mixture model of
+    the cells, fitted in the space of the principal components of the
+    subsample.
+
+    If ONLINE is true, the model is initialized from the subsample
+    and then fitted by stepwise EM on the cells of all the groups,
+    streamed from the cache in batches of BATCH_ROWS cells, EPOCHS
+    times, visiting the cells in a random order seeded with SEED.  If
+    PLATE_MAJOR is true, the posteriors are computed in one pass over
+    the plates, each image being loaded once and its posteriors added
+    to all the groups that contain it.
+    """
     cache = Cache(cache_dir)
     group, colnames_group = cpa.db.group_map(group_name, reverse=True, filter=filter)
 
     keys = group.keys()
     subsample = cpa.util.unpickle1(subsample_file)
+    preprocessor = None
     if preprocess_file:
         preprocessor = cpa.util.unpickle1(preprocess_file)
         subsample_data = preprocessor(subsample.data)
@@ -64,15 +234,41 @@ def profile_gmm(cache_dir, subsample_file, group_name, ncomponents=50,
 
     # GMM
     #gmm = GMM(ncomponents, covariance_type='full', n_iter=100000, thresh=1e-7)
-    gmm = GMM(ncomponents, covariance_type='diag', n_iter=100, tol=0.001)
-    gmm.fit(scores[:, :npc])
+    if online:
+        gmm = OnlineGMM(ncomponents, random_state=seed).initialize(scores[:, :npc])
+        image_keys = set(image for g in keys for image in group[g])
+        fit_online(gmm, cache, image_keys, normalization, preprocessor, meanvector,
+                   loadings[:, :npc], epochs=epochs, batch_rows=batch_rows, seed=seed)
+    else:
+        from sklearn.mixture import GMM
+        gmm = GMM(ncomponents, covariance_type='diag', n_iter=100, tol=0.001)
+        gmm.fit(scores[:, :npc])
 
-    parameters = [(cache_dir, normalization.__name__, preprocess_file,
-                   group[g], gmm, meanvector, loadings[:, :npc])
-                  for g in keys]
+    model = parallel.broadcast((gmm, meanvector, loadings[:, :npc]))
     variables = ['Component %d' % i for i in range(ncomponents)]
-    return Profiles.compute(keys, variables, _compute_mixture_probabilities, 
-                            parameters, parallel=parallel, group_name=group_name)
+    if plate_major:
+        groups = [group[g] for g in keys]
+        per_plate = images_per_plate(cache, groups)
+        parameters = [(cache_dir, normalization.__name__, preprocess_file,
+                       per_plate[plate], model)
+                      for plate in sorted(per_plate.keys())]
+        def finalize(partials):
+            ncells = sum(n for _, n in partials)
+            if ncells == 0:
+                return None
+            return sum(posteriors for posteriors, _ in partials) / ncells
+        data = compute_plate_major(_compute_plate_posteriors, parameters, groups,
+                                   finalize, parallel, show_progress=show_progress)
+        profiles = Profiles.from_results(keys, data, variables, group_name=group_name)
+    else:
+        parameters = [(cache_dir, normalization.__name__, preprocess_file,
+                       group[g], model)
+                      for g in keys]
+        profiles = Profiles.compute(keys, variables, _compute_mixture_probabilities, 
+                                    parameters, parallel=parallel, group_name=group_name,
+                                    show_progress=show_progress)
+    model.remove()
+    return profiles
 
     
 if __name__ == '__main__':
@@ -81,11 +277,24 @@ if __name__ == '__main__':
     parser = OptionParser("usage: %prog [options] PROPERTIES-FILE CACHE-DIR SUBSAMPLE-FILE GROUP")
     ParallelProcessor.add_options(parser)
     parser.add_option('-o', dest='output_filename', help='file to store the profiles in')
+    parser.add_option('-b', '--binary', dest='binary', help='output in the binary format, which loads faster (requires -o)', action='store_true')
     parser.add_option('-f', dest='filter', help='only profile images matching this CPAnalyst filter')
     parser.add_option('-c', dest='csv', help='output as CSV', action='store_true')
     parser.add_option('--components', dest='ncomponents', type='int', default=5, help='number of mixture components')
+    parser.add_option('--online', dest='online', action='store_true', default=False,
+                      help='fit the model by mini-batch EM on all the cells of the groups, streamed from the cache, after initializing it from the subsample')
+    parser.add_option('--epochs', dest='epochs', type='int', default=1,
+                      help='number of passes over the cells with --online (default: 1)')
+    parser.add_option('--batch-rows', dest='batch_rows', type='int', default=10000,
+                      help='number of cells per mini-batch with --online (default: 10000)')
+    parser.add_option('--plate-major', dest='plate_major', action='store_true', default=False,
+                      help='compute the posteriors plate by plate, loading each image once even if it belongs to several groups')
+    parser.add_option('--seed', dest='seed', type='int', default=None,
+                      help='random seed for the online fit')
     add_common_options(parser)
     options, args = parser.parse_args()
+    if options.binary and not options.output_filename:
+        parser.error('The binary format requires an output file (-o)')
     parallel = ParallelProcessor.create_from_options(parser, options)
 
     if len(args) != 4:
@@ -97,8 +306,13 @@ if __name__ == '__main__':
                            ncomponents=options.ncomponents, 
                            filter=options.filter, parallel=parallel,
                            normalization=normalizations[options.normalization],
-                           preprocess_file=options.preprocess_file)
-    if options.csv:
+                           preprocess_file=options.preprocess_file,
+                           online=options.online, epochs=options.epochs,
+                           batch_rows=options.batch_rows, plate_major=options.plate_major,
+                           seed=options.seed)
+    if options.binary:
+        profiles.save_binary(options.output_filename)
+    elif options.csv:
         profiles.save_csv(options.output_filename)
     else:
         profiles.save(options.output_filename)
@@ -1,32 +1,62 @@
 #!/usr/bin/env python
 
+def _load_sorted_controls(cache, control_images, normalization, preprocess_file):
+    import cpa.util
+    from cpa.profiling.ks_2samp import SortedColumns
+    from cpa.profiling.parallel import worker_local
+    control_data, control_colnames, _ = cache.load(control_images, normalization=normalization)
+    if preprocess_file:
+        preprocessor = worker_local(('preprocessor', preprocess_file),
+                                    cpa.util.unpickle1, preprocess_file)
+        control_data = preprocessor(control_data)
+    return SortedColumns(control_data)
+
 def _compute_ksstatistic((cache_dir, images, control_images, normalization_name,
                           preprocess_file)):
+    """CONTROL_IMAGES is a pair of a Broadcast handle of a dictionary
+    that maps plates to control images and the plates to use."""
     import numpy as np 
     import sys
-    import cpa
+    import cpa.util
+    from collections import OrderedDict
     from cpa.profiling.cache import Cache
     from cpa.profiling.normalization import normalizations
-    from cpa.profiling.ks_2samp import ks_2samp
+    from cpa.profiling.ks_2samp import ks_2samp_columns
+    from cpa.profiling.parallel import worker_local
+    from cpa.profiling.profile_ksstatistic import _load_sorted_controls, max_cached_controls
 
-    cache = Cache(cache_dir)
+    cache = worker_local(('cache', cache_dir), Cache, cache_dir)
+    control_images_by_plate, plates = control_images
     normalization = normalizations[normalization_name]
+
+    # The sorted controls of the most recently used plates are kept
+    # by the worker, as many groups share the controls of a plate.
+    cached_controls = worker_local(('ks-controls',), OrderedDict)
+    # The broadcast file is named after the control map, so runs with
+    # different controls do not share entries.
+    key = (cache_dir, normalization_name, preprocess_file,
+           control_images_by_plate.filename, tuple(plates))
+    try:
+        controls = cached_controls.pop(key)
+    except KeyError:
+        control_images_by_plate = control_images_by_plate.get()
+        control_images = sorted(set(image for plate in plates
+                                    for image in control_images_by_plate[plate]))
+        controls = _load_sorted_controls(cache, control_images, normalization,
+                                         preprocess_file)
+        if len(cached_controls) >= max_cached_controls:
+            cached_controls.popitem(last=False)
+    cached_controls[key] = controls
+
     normalizeddata, variables, _ = cache.load(images, normalization=normalization)
-    control_data, control_colnames, _ = cache.load(control_images, normalization=normalization)
-    assert len(control_data) >= len(normalizeddata)
-    assert variables == control_colnames
+    assert controls.n >= len(normalizeddata)
     if preprocess_file:
-        preprocessor = cpa.util.unpickle1(preprocess_file)
+        preprocessor = worker_local(('preprocessor', preprocess_file),
+                                    cpa.util.unpickle1, preprocess_file)
         normalizeddata = preprocessor(normalizeddata)
-        control_data = preprocessor(control_data)
         variables = preprocessor.variables
-    #downsampled = control_data[np.random.randint(0, len(control_data), len(normalizeddata)), :]
-    m = len(variables)
-    profile = np.empty(m)
-    for j in range(m):
-        profile[j] = ks_2samp(control_data[:, j], normalizeddata[:, j],
-			      signed=True)[0]
-    return profile
+    assert controls.m == len(variables)
+    return ks_2samp_columns(controls, normalizeddata)
 
 import io
 import sys
@@ -42,6 +72,9 @@ from profiles import Profiles, add_common_options
 from .parallel import ParallelProcessor, Uniprocessing
 
 logger = logging.getLogger(__name__)
+
+# Number of sets of sorted control data kept by each worker.
+max_cached_controls = 4
         
 def images_by_plate(filter, plate_group=None):
     if plate_group is None:
@@ -60,12 +93,16 @@ def profile_ksstatistic(cache_dir, group_name, control_filter, plate_group,
     plate_by_image = dict((row[:-2], tuple(row[-2:-1]))
                           for row in cpa.db.GetPlatesAndWellsPerImage())
 
+    # The control images are sent to the workers once, and each task
+    # only names the plates whose controls it uses.
+    shared_control_images = parallel.broadcast(control_images_by_plate)
+
     def control_images(treated_images):
         if plate_group is None:
-            return control_images_by_plate[None]
+            plates = [None]
         else:
-            return list(set(r for image in treated_images
-                            for r in control_images_by_plate[plate_by_image[image]]))
+            plates = sorted(set(plate_by_image[image] for image in treated_images))
+        return shared_control_images, plates
 
     keys = group.keys()
     parameters = [(cache_dir, group[k], control_images(group[k]), 
@@ -78,9 +115,11 @@ def profile_ksstatistic(cache_dir, group_name, control_filter, plate_group,
     else:
         cache = Cache(cache_dir)
         variables = normalization(cache).colnames
-    return Profiles.compute(keys, variables, _compute_ksstatistic, 
-                            parameters, parallel=parallel, 
-                            group_name=group_name)
+    profiles = Profiles.compute(keys, variables, _compute_ksstatistic, 
+                                parameters, parallel=parallel, 
+                                group_name=group_name)
+    shared_control_images.remove()
+    return profiles
     
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
@@ -88,10 +127,13 @@ if __name__ == '__main__':
     parser = OptionParser("usage: %prog [options] PROPERTIES-FILE CACHE-DIR GROUP CONTROL-FILTER")
     ParallelProcessor.add_options(parser)
     parser.add_option('-o', dest='output_filename', help='file to store the profiles in')
+    parser.add_option('-b', '--binary', dest='binary', help='output in the binary format, which loads faster (requires -o)', action='store_true')
     parser.add_option('-p', dest='plate_group', help='CPA group defining plates')
     parser.add_option('-f', dest='filter', help='only profile images matching this CPAnalyst filter')
     add_common_options(parser)
     options, args = parser.parse_args()
+    if options.binary and not options.output_filename:
+        parser.error('The binary format requires an output file (-o)')
     parallel = ParallelProcessor.create_from_options(parser, options)
 
     if len(args) != 4:
@@ -104,4 +146,7 @@ if __name__ == '__main__':
                                    filter=options.filter, parallel=parallel,
                                    normalization=normalizations[options.normalization],
                                    preprocess_file=options.preprocess_file)
-    profiles.save(options.output_filename)
+    if options.binary:
+        profiles.save_binary(options.output_filename)
+    else:
+        profiles.save(options.output_filename)
@@ -13,76 +13,314 @@ from .normalization import DummyNormalization, RobustLinearNormalization, Robust
 from .profiles import Profiles, add_common_options
 from .parallel import ParallelProcessor, Uniprocessing
 
+def method_variables(method, variables):
+    """Return the names of the values that METHOD computes for the
+    variables."""
+    if method == 'mean+std':
+        return variables + ['std_' + v for v in variables]
+    elif method == 'median+mad':
+        return variables + ['mad_' + v for v in variables]
+    elif method == 'gmm2':
+        return ['m1_' + v for v in variables] + ['m2_' + v for v in variables]
+    elif method == 'deciles':
+        return ['decile_%02d_%s' % (dec, v) for dec in range(10,100,10) for v in variables]
+    elif method == 'mean+deciles':
+        return variables + ['decile_%02d_%s' % (dec, v) for dec in range(10,100,10) for v in variables]
+    elif method == 'cellcount':
+        return ['Cells_Count']
+    else:
+        return variables
+
+# Methods whose profiles follow from mergeable per-image summaries:
+# the summary statistics, and with approximate the quantile sketches.
+stats_methods = ['mean', 'mean+std', 'cellcount']
+sketch_methods = ['median', 'median+mad', 'deciles', 'mean+deciles']
+
+def _profile_from_summaries(method, stats, sketch):
+    """Return the profile given the SummaryStatistics and the
+    QuantileSketch of the cells (either may be None if METHOD does
+    not need it)."""
+    from scipy.stats import norm as Gaussian
+    nan = lambda n: np.empty(len(method_variables(method, [''] * n))) * np.nan
+
+    if method in stats_methods:
+        if method == 'cellcount':
+            return np.ones(1) * stats.count
+        if stats.count == 0:
+            return nan(len(stats.means))
+        if method == 'mean':
+            return stats.mean()
+        return np.hstack((stats.mean(), stats.std()))
+
+    if sketch.count == 0:
+        return nan(sketch.values.shape[1])
+    if method == 'median':
+        return sketch.median()
+    elif method == 'median+mad':
+        d = sketch.median()
+        return np.hstack((d, sketch.mad(d) / Gaussian.ppf(3/4.)))
+    deciles = sketch.quantiles(np.arange(1, 10) / 10.).ravel()
+    if method == 'deciles':
+        return deciles
+    return np.hstack((stats.mean(), deciles))
+
+def _summary_profile(cache, images, normalization, method, approximate):
+    """
+    Return the profile computed from the per-image summaries of the
+    cache, or None if the method needs the cells.
+    """
+    # These methods only need the per-image summary statistics.
+    if method in stats_methods:
+        stats = cache.load_stats(images, normalization=normalization)
+        if stats is not None:
+            return _profile_from_summaries(method, stats, None)
+
+    # With approximate, these methods use the per-image quantile
+    # sketches instead.
+    if approximate and method in sketch_methods:
+        sketch = cache.load_sketch(images, normalization=normalization)
+        stats = (cache.load_stats(images, normalization=normalization)
+                 if method == 'mean+deciles' else None)
+        if sketch is not None and (stats is not None or method != 'mean+deciles'):
+            return _profile_from_summaries(method, stats, sketch)
+    return None
+
+def _data_profile(data, method):
+    """Return the profile of the cells (without NaNs)."""
+    from scipy.stats import norm as Gaussian
+    if method == 'mean':
+        return np.mean(data, axis=0)
+    elif method == 'mean+std':
+        return np.hstack((np.mean(data, axis=0), np.std(data, axis=0)))
+    elif method == 'mode':
+        return mode(data, axis=0)[0][0]
+    elif method == 'median':
+        return np.median(data, axis=0)
+    elif method == 'median+mad':
+        c = Gaussian.ppf(3/4.)
+        d = np.median(data, axis=0)
+        return np.hstack((d,
+                          np.median((np.fabs(data-d)) / c, axis=0)))
+    elif method == 'gmm2':
+        max_sample_size = 2000
+        if data.shape[0] > max_sample_size:
+            data = data[np.random.random_integers(0,data.shape[0]-1,size=max_sample_size),:]
+        from sklearn.decomposition import PCA
+        from sklearn.mixture import GMM
+        pca = PCA(n_components=0.99).fit(data)
+        pca_data = pca.transform(data)
+        #gmm = GMM(2, covariance_type='full', n_iter=100000, thresh=1e-7).fit(pca_data)
+        gmm = GMM(2, covariance_type='full').fit(pca_data)
+        return pca.inverse_transform(gmm.means_).flatten()
+    elif method == 'deciles':
+        return np.hstack(map(lambda d: np.percentile(data, d, axis=0), range(10,100,10)))
+    elif method == 'mean+deciles':
+        return np.hstack((np.mean(data, axis=0), np.hstack(map(lambda d: np.percentile(data, d, axis=0), range(10,100,10)))))
+    raise ValueError('Unknown method: %r' % method)
+
 def _compute_group_mean((cache_dir, images, normalization_name, 
-                         preprocess_file, method)):
+                         preprocess_file, method, approximate)):
+    """
+    METHOD is a method or a list of methods, whose profiles are
+    concatenated.  The cells are loaded at most once for all the
+    methods.
+    """
     try:
         import numpy as np
+        import cpa.util
         from cpa.profiling.cache import Cache
         from cpa.profiling.normalization import normalizations
-        from scipy.stats import norm as Gaussian
-        cache = Cache(cache_dir)
+        from cpa.profiling.parallel import worker_local
+        from cpa.profiling.profile_mean import (method_variables, _summary_profile, 
+                                                _data_profile)
+        cache = worker_local(('cache', cache_dir), Cache, cache_dir)
         normalization = normalizations[normalization_name]
-        data, colnames, _ = cache.load(images, normalization=normalization)
-        
-        cellcount = np.ones(1) * data.shape[0]
-        if method == 'cellcount':
-            return cellcount
-        
-        if len(data) == 0:
-            return np.empty(len(colnames)) * np.nan
-
-        data = data[~np.isnan(np.sum(data, 1)), :]
+        methods = [method] if isinstance(method, basestring) else method
 
-        if len(data) == 0:
-            return np.empty(len(colnames)) * np.nan
+        profiles = []
+        data = None
+        for method in methods:
+            profile = None
+            if not preprocess_file:
+                profile = _summary_profile(cache, images, normalization, method,
+                                           approximate)
+            if profile is None:
+                if data is None:
+                    # Order statistics do not accumulate rounding
+                    # errors, so these methods avoid the converted
+                    # copy of float32 caches.
+                    order_statistics = all(m in ['median', 'deciles'] for m in methods)
+                    dtype = None if order_statistics and not preprocess_file else float
+                    data, colnames, _ = cache.load(images, normalization=normalization,
+                                                   dtype=dtype)
+                    cellcount = np.ones(1) * data.shape[0]
+                    if len(data) > 0:
+                        data = data[~np.isnan(np.sum(data, 1)), :]
+                    if preprocess_file:
+                        preprocessor = worker_local(('preprocessor', preprocess_file),
+                                                    cpa.util.unpickle1, preprocess_file)
+                        nvariables = len(preprocessor.variables)
+                        if len(data) > 0:
+                            data = preprocessor(data)
+                    else:
+                        nvariables = len(colnames)
+                if method == 'cellcount':
+                    profile = cellcount
+                elif len(data) == 0:
+                    profile = np.empty(len(method_variables(method, [''] * nvariables))) * np.nan
+                else:
+                    profile = _data_profile(data, method)
+            profiles.append(profile)
+        return np.hstack(profiles)
+    except: # catch *all* exceptions
+        from traceback import print_exc
+        import sys
+        print_exc(None, sys.stderr)
+        return None
 
+def _compute_plate_summaries((cache_dir, plate, blocks, normalization_name,
+                              preprocess_file, sketch_size)):
+    """
+    Return a list of (block key, (SummaryStatistics, QuantileSketch
+    or None)) pairs for BLOCKS, a list of (block key, image keys)
+    pairs that partition the images of a plate.  Without a
+    preprocessor, the summaries are merged from the per-image
+    summaries of the cache when it has them.  Otherwise each image is
+    loaded and normalized once, in storage order.  The sketches of a
+    block are merged as they are computed, so only one sketch per
+    block is kept and returned.
+    """
+    try:
+        import numpy as np
+        import cpa.util
+        from cpa.profiling.cache import Cache, SummaryStatistics, QuantileSketch
+        from cpa.profiling.normalization import normalizations
+        from cpa.profiling.parallel import worker_local
+        cache = worker_local(('cache', cache_dir), Cache, cache_dir)
+        normalization = normalizations[normalization_name]
+        preprocessor = None
         if preprocess_file:
-            preprocessor = cpa.util.unpickle1(preprocess_file)
-            data = preprocessor(data)
+            preprocessor = worker_local(('preprocessor', preprocess_file),
+                                        cpa.util.unpickle1, preprocess_file)
 
-        if method == 'mean':
-            return np.mean(data, axis=0)
-        elif method == 'mean+std':
-            return np.hstack((np.mean(data, axis=0), np.std(data, axis=0)))
-        elif method == 'mode':
-            return mode(data, axis=0)
-        elif method == 'median':
-            return np.median(data, axis=0)
-        elif method == 'median+mad':
-            c = Gaussian.ppf(3/4.)
-            d = np.median(data, axis=0)
-            return np.hstack((d,
-                              np.median((np.fabs(data-d)) / c, axis=0)))
-        elif method == 'gmm2':
-            max_sample_size = 2000
-            if data.shape[0] > max_sample_size:
-                data = data[np.random.random_integers(0,data.shape[0]-1,size=max_sample_size),:]
-            from sklearn.decomposition import PCA
-            from sklearn.mixture import GMM
-            pca = PCA(n_components=0.99).fit(data)
-            pca_data = pca.transform(data)
-            #gmm = GMM(2, covariance_type='full', n_iter=100000, thresh=1e-7).fit(pca_data)
-            gmm = GMM(2, covariance_type='full').fit(pca_data)
-            return pca.inverse_transform(gmm.means_).flatten()
-        elif method == 'deciles':
-            return np.hstack(map(lambda d: np.percentile(data, d, axis=0), range(10,100,10)))
-        elif method == 'mean+deciles':
-            return np.hstack((np.mean(data, axis=0), np.hstack(map(lambda d: np.percentile(data, d, axis=0), range(10,100,10)))))
+        def image_summaries(images, stats):
+            """Yield the sketch of each image and append its
+            statistics to STATS."""
+            for image in cache.storage_order(images):
+                data, colnames, _ = cache.load([image], normalization=normalization)
+                nvariables = len(preprocessor.variables if preprocessor else colnames)
+                if len(data) > 0:
+                    data = data[~np.isnan(np.sum(data, 1)), :]
+                    if preprocessor and len(data) > 0:
+                        data = preprocessor(data)
+                data = np.reshape(data, (len(data), nvariables))
+                stats.append(SummaryStatistics.from_data(data))
+                yield QuantileSketch.from_data(data, sketch_size) if sketch_size else None
+
+        results = []
+        for key, images in blocks:
+            stats = sketch = None
+            if preprocessor is None:
+                stats = cache.load_stats(images, normalization=normalization)
+                if sketch_size:
+                    sketch = cache.load_sketch(images, normalization=normalization)
+            if stats is None or (sketch_size and sketch is None):
+                image_stats = []
+                sketches = image_summaries(images, image_stats)
+                if sketch_size:
+                    sketch = QuantileSketch.merge_all(sketches)
+                else:
+                    for _ in sketches:
+                        pass
+                stats = SummaryStatistics.merge_all(image_stats)
+            results.append((key, (stats, sketch)))
+        return results
     except: # catch *all* exceptions
         from traceback import print_exc
         import sys
         print_exc(None, sys.stderr)
         return None
 
+def _compute_plate_major(cache_dir, groups, normalization, preprocess_file, methods,
+                         parallel, show_progress=True, sketch_size=1000):
+    """
+    Return the concatenated profiles of the methods for each group of
+    images (None for groups without images).  The plates are
+    processed once each, in order.  The images of a plate are split
+    into blocks of images that belong to the same groups; each block
+    is summarized once and its summaries are scattered to all of its
+    groups, so an image shared by several groups is not loaded again.
+    A group's profile is computed as soon as its last block arrives.
+
+    Only methods whose profiles follow from mergeable summaries
+    (stats_methods and sketch_methods) are supported; the sketch
+    methods use per-image quantile sketches of the cache's sketch
+    size, or SKETCH_SIZE if the cache has none.
+    """
+    from .cache import SummaryStatistics, QuantileSketch
+    from .profiles import compute_plate_major
+    unsupported = [m for m in methods if m not in stats_methods + sketch_methods]
+    if unsupported:
+        raise ValueError('Plate-major scheduling does not support the method(s) %s'
+                         % ', '.join(unsupported))
+    cache = Cache(cache_dir)
+    if any(m in sketch_methods for m in methods):
+        sketch_size = cache._sketch_size or sketch_size
+    else:
+        sketch_size = None
+
+    # A block is keyed by its plate and the indices of its groups.
+    groups_of_image = {}
+    for i, images in enumerate(groups):
+        for image in set(images):
+            groups_of_image.setdefault(image, []).append(i)
+    blocks = {}
+    for image, indices in groups_of_image.items():
+        blocks.setdefault((cache._plate_map[image], tuple(indices)), []).append(image)
+    blocks_per_plate = {}
+    block_groups = [[] for images in groups]
+    for key in sorted(blocks.keys()):
+        blocks_per_plate.setdefault(key[0], []).append((key, blocks[key]))
+        for i in key[1]:
+            block_groups[i].append(key)
+    parameters = [(cache_dir, plate, blocks_per_plate[plate], normalization.__name__,
+                   preprocess_file, sketch_size)
+                  for plate in sorted(blocks_per_plate.keys())]
+
+    def finalize(partials):
+        if len(partials) == 0:
+            return None
+        stats = SummaryStatistics.merge_all([s for s, _ in partials])
+        sketch = None
+        if sketch_size:
+            sketch = QuantileSketch.merge_all([k for _, k in partials])
+        return np.hstack([_profile_from_summaries(m, stats, sketch) for m in methods])
+
+    return compute_plate_major(_compute_plate_summaries, parameters, block_groups,
+                               finalize, parallel, show_progress=show_progress)
+
 def profile_mean(cache_dir, group_name, filter=None, parallel=Uniprocessing(),
                  normalization=RobustLinearNormalization, preprocess_file=None,
                  show_progress=True, method='mean',
-                 full_group_header=False):
+                 full_group_header=False, approximate=False, plate_major=False):
+    """
+    Compute the profiles of the groups.  METHOD can also be a list of
+    methods, which are computed in a single pass over the cache; then
+    a list with the profiles of each method is returned.  The profiles
+    of all methods have the same keys: groups for which any method
+    returns NaN are left out.
+
+    If PLATE_MAJOR is true, the cache is traversed plate by plate
+    instead of group by group, so that each image is loaded once even
+    if it belongs to several groups (see _compute_plate_major).  The
+    median and decile methods are then approximate.
+    """
     group, colnames_group = cpa.db.group_map(group_name, reverse=True,
                                              filter=filter)
 
     keys = group.keys()
-    parameters = [(cache_dir, group[g], normalization.__name__, preprocess_file, method)
+    parameters = [(cache_dir, group[g], normalization.__name__, preprocess_file, method,
+                   approximate)
                   for g in keys]
 
     if "CPA_DEBUG" in os.environ:
@@ -98,22 +336,36 @@ def profile_mean(cache_dir, group_name, filter=None, parallel=Uniprocessing(),
     else:
         cache = Cache(cache_dir)
         variables = normalization(cache).colnames
-    if method == 'mean+std':
-        variables = variables + ['std_' + v for v in variables]
-    elif method == 'median+mad':
-        variables = variables + ['mad_' + v for v in variables]
-    elif method == 'gmm2':
-        variables = ['m1_' + v for v in variables] + ['m2_' + v for v in variables]
-    elif method == 'deciles':
-        variables = ['decile_%02d_%s' % (dec, v) for dec in range(10,100,10) for v in variables]
-    elif method == 'mean+deciles':
-        variables = variables + ['decile_%02d_%s' % (dec, v) for dec in range(10,100,10) for v in variables]
-    elif method == 'cellcount':
-        variables = ['Cells_Count']
-    return Profiles.compute(keys, variables, _compute_group_mean, parameters,
-                            parallel=parallel, group_name=group_name,
-                            show_progress=show_progress, 
-                            group_header=colnames_group if full_group_header else None)
+    methods = [method] if isinstance(method, basestring) else list(method)
+    variables_per_method = [method_variables(m, variables) for m in methods]
+    group_header = colnames_group if full_group_header else None
+    if plate_major:
+        data = _compute_plate_major(cache_dir, [group[g] for g in keys], normalization,
+                                    preprocess_file, methods, parallel,
+                                    show_progress=show_progress)
+        if all(d is None for d in data):
+            profiles = None
+        else:
+            profiles = Profiles.from_results(keys, data, sum(variables_per_method, []),
+                                             group_name=group_name, group_header=group_header)
+    else:
+        profiles = Profiles.compute(keys, sum(variables_per_method, []), 
+                                    _compute_group_mean, parameters,
+                                    parallel=parallel, group_name=group_name,
+                                    show_progress=show_progress, 
+                                    group_header=group_header)
+    if isinstance(method, basestring) or profiles is None:
+        return profiles
+    # Split the columns by method.
+    result = []
+    start = 0
+    for method_vars in variables_per_method:
+        stop = start + len(method_vars)
+        result.append(Profiles(profiles.keys(), profiles.data[:, start:stop], method_vars,
+                               profiles.key_size, group_name=profiles.group_name, 
+                               group_header=profiles.group_header))
+        start = stop
+    return result
 
     # def save_as_csv_file(self, output_file):
     #     csv_file = csv.writer(output_file)
@@ -127,15 +379,22 @@ if __name__ == '__main__':
     parser = OptionParser("usage: %prog [options] PROPERTIES-FILE CACHE-DIR GROUP")
     ParallelProcessor.add_options(parser)
     parser.add_option('-o', dest='output_filename', help='file to store the profiles in')
+    parser.add_option('-b', '--binary', dest='binary', help='output in the binary format, which loads faster (requires -o)', action='store_true')
     parser.add_option('-f', dest='filter', help='only profile images matching this CPAnalyst filter')
     parser.add_option('-c', dest='csv', help='output as CSV', action='store_true')
     parser.add_option('--no-progress', dest='no_progress', help='Do not show progress bar', action='store_true')
     parser.add_option('-g', '--full-group-header', dest='full_group_header', default=False, 
                       help='Include full group header in csv file', action='store_true')
-    parser.add_option('--method', dest='method', help='method: mean (default), mean+std, mode, median, median+mad, deciles, mean+deciles', 
+    parser.add_option('--method', dest='method', help='method: mean (default), mean+std, mode, median, median+mad, deciles, mean+deciles, cellcount, or a comma-separated list of methods, which are computed in one pass and saved in separate files (FILENAME.METHOD.EXT, requires -o)', 
                       action='store', default='mean')
+    parser.add_option('--approximate', dest='approximate', action='store_true', default=False,
+                      help='compute medians and deciles from the quantile sketches of the cache (see cache.py --sketch-error)')
+    parser.add_option('--plate-major', dest='plate_major', action='store_true', default=False,
+                      help='process the cache plate by plate, loading each image once even if it belongs to several groups (only for mean, mean+std, cellcount, and the approximate median, median+mad, deciles, and mean+deciles)')
     add_common_options(parser)
     options, args = parser.parse_args()
+    if options.binary and not options.output_filename:
+        parser.error('The binary format requires an output file (-o)')
     parallel = ParallelProcessor.create_from_options(parser, options)
 
     if len(args) != 3:
@@ -144,15 +403,32 @@ if __name__ == '__main__':
 
     cpa.properties.LoadFile(properties_file)
 
+    methods = options.method.split(',')
+    if len(methods) > 1 and not options.output_filename:
+        parser.error('Several methods require an output file (-o)')
+
     profiles = profile_mean(cache_dir, group, filter=options.filter,
                             parallel=parallel, 
                             normalization=normalizations[options.normalization],
                             preprocess_file=options.preprocess_file,
-                            method=options.method,
+                            method=methods if len(methods) > 1 else methods[0],
                             show_progress=not options.no_progress,
-                            full_group_header=options.full_group_header)
-    print profiles
-    if options.csv:
-        profiles.save_csv(options.output_filename)
+                            full_group_header=options.full_group_header,
+                            approximate=options.approximate,
+                            plate_major=options.plate_major)
+    if profiles is None:
+        print >>sys.stderr, 'Error: No profiles were computed; check the group and the filter'
+        sys.exit(1)
+    if len(methods) > 1:
+        root, ext = os.path.splitext(options.output_filename)
+        outputs = [(p, '%s.%s%s' % (root, m, ext)) for m, p in zip(methods, profiles)]
     else:
-        profiles.save(options.output_filename)
+        outputs = [(profiles, options.output_filename)]
+    for profiles, output_filename in outputs:
+        print profiles
+        if options.binary:
+            profiles.save_binary(output_filename)
+        elif options.csv:
+            profiles.save_csv(output_filename)
+        else:
+            profiles.save(output_filename)
@@ -17,7 +17,8 @@ def _transform_cell_feats((cache_dir, images, normalization_name, output_filenam
         import numpy as np
         from .cache import Cache
         from .normalization import DummyNormalization, RobustLinearNormalization, RobustStdNormalization, normalizations
-        cache = Cache(cache_dir)
+        from .parallel import worker_local
+        cache = worker_local(('cache', cache_dir), Cache, cache_dir)
         normalization = normalizations[normalization_name]
         normalizeddata, normalized_colnames, cell_ids = cache.load(images,
                                                                    normalization=normalization)
@@ -81,13 +81,15 @@ def _compute_svmnormalvector((cache_dir, images, control_images,
         from cpa.profiling.normalization import RobustLinearNormalization, normalizations
         from sklearn.svm import LinearSVC
         from cpa.profiling.profile_svmnormalvector import _compute_rfe
+        from cpa.profiling.parallel import worker_local
 
-        cache = Cache(cache_dir)
+        cache = worker_local(('cache', cache_dir), Cache, cache_dir)
         normalization = normalizations[normalization_name]
         normalizeddata, normalized_colnames, _ = cache.load(images, normalization=normalization)
         control_data, control_colnames, _ = cache.load(control_images, normalization=normalization)
         if preprocess_file:
-            preprocessor = cpa.util.unpickle1(preprocess_file)
+            preprocessor = worker_local(('preprocessor', preprocess_file),
+                                        cpa.util.unpickle1, preprocess_file)
             normalizeddata = preprocessor(normalizeddata)
             control_data = preprocessor(control_data)
         assert len(control_data) >= len(normalizeddata)
@@ -167,9 +169,12 @@ if __name__ == '__main__':
     parser.add_option('-J', dest='job', help='Compute only one profile, 1 <= j <= n', default=None, type=int)
     parser.add_option('--rfe', dest='rfe', help='Recursive feature elimination', action='store_true')
     parser.add_option('-o', dest='output_filename', help='file to store the profiles in')
+    parser.add_option('-b', '--binary', dest='binary', help='output in the binary format, which loads faster (requires -o)', action='store_true')
     parser.add_option('-f', dest='filter', help='only profile images matching this CPAnalyst filter')
     add_common_options(parser)
     options, args = parser.parse_args()
+    if options.binary and not options.output_filename:
+        parser.error('The binary format requires an output file (-o)')
     parallel = ParallelProcessor.create_from_options(parser, options)
 
     if len(args) != 4:
@@ -186,4 +191,7 @@ if __name__ == '__main__':
                                        parallel=parallel, job=options.job,
                                        normalization=normalizations[options.normalization],
                                        preprocess_file=options.preprocess_file)
-    profiles.save(options.output_filename)
+    if options.binary:
+        profiles.save_binary(options.output_filename)
+    else:
+        profiles.save(options.output_filename)
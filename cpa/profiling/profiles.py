@@ -1,6 +1,7 @@
 import sys
 import itertools
 import logging
+import json
 import numpy as np
 import cpa
 from .parallel import ParallelProcessor
@@ -11,6 +12,12 @@ if not hasattr(itertools, 'compress'):
 
 logger = logging.getLogger(__name__)
 
+# First line of files written by Profiles.save_binary.
+BINARY_MAGIC = 'CPA-PROFILES-BINARY 1\n'
+
+def _str(s):
+    return s.encode('utf-8') if isinstance(s, unicode) else s
+
 class InputError(Exception):
     def __init__(self, filename, message, line=None):
         self.filename = filename
@@ -30,8 +37,12 @@ class Profiles(object):
         assert all(isinstance(k, tuple) for k in keys)
         assert all(isinstance(v, str) for v in variables)
         self._keys = [tuple(map(str, t)) for t in keys]
-        assert ~np.any(np.isnan(data))
-        self.data = np.array(data)
+        # Scanning memory-mapped data (see load_binary) would read all
+        # of it; save_binary only writes data that passed this check.
+        if not isinstance(data, np.memmap):
+            assert ~np.any(np.isnan(data))
+        # Keep memory-mapped data mapped.
+        self.data = np.asarray(data)
         self.variables = variables
         self.group_header = group_header
         if key_size is None:
@@ -42,6 +53,10 @@ class Profiles(object):
 
     @classmethod
     def load(cls, filename):
+        """Load profiles saved by save() or save_binary()."""
+        with open(filename, 'rb') as f:
+            if f.read(len(BINARY_MAGIC)) == BINARY_MAGIC:
+                return cls.load_binary(filename)
         data = []
         keys = []
         for i, line in enumerate(open(filename).readlines()):
@@ -65,8 +80,39 @@ class Profiles(object):
                 if len(values) != len(variables):
                     raise InputError(filename, 'Expected %d feature values, found %d' % (len(variables), len(values)), i + 1)
                 keys.append(key)
-                data.append(map(float, values))
-        return cls(keys, np.array(data), variables, key_size, group_name=group_name)
+                data.append(values)
+        # Converting all the values at once is much faster than
+        # converting each row.
+        data = np.array(data, dtype=float).reshape((len(keys), len(variables)))
+        return cls(keys, data, variables, key_size, group_name=group_name)
+
+    @classmethod
+    def load_binary(cls, filename):
+        """
+        Load profiles saved by save_binary().  The data are memory-
+        mapped, so only the parts that are used are read.
+        """
+        with open(filename, 'rb') as f:
+            if f.readline() != BINARY_MAGIC:
+                raise InputError(filename, 'Not a binary profiles file', 1)
+            header = json.loads(f.readline())
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        if 0 in shape:
+            data = np.zeros(shape, dtype=dtype)
+        else:
+            data = np.memmap(filename, dtype=dtype, mode='r', offset=offset, 
+                             shape=shape, order='F' if fortran_order else 'C')
+        group_header = header['group_header']
+        if group_header is not None:
+            group_header = [_str(h) for h in group_header]
+        return cls([tuple(_str(k) for k in key) for key in header['keys']], data,
+                   [_str(v) for v in header['variables']], header['key_size'],
+                   group_name=_str(header['group_name']), group_header=group_header)
 
     @classmethod
     def load_csv(cls, filename):
@@ -123,6 +169,20 @@ class Profiles(object):
         finally:
             f.close()
 
+    def save_binary(self, filename):
+        """
+        Save the profiles in a binary file that load() recognizes: a
+        header line with the keys, variables, group name, and key size,
+        followed by the data in .npy format, which loads memory-mapped.
+        """
+        header = dict(keys=self._keys, variables=self.variables,
+                      group_name=self.group_name, key_size=self.key_size,
+                      group_header=self.group_header)
+        with open(filename, 'wb') as f:
+            f.write(BINARY_MAGIC)
+            f.write(json.dumps(header) + '\n')
+            np.lib.format.write_array(f, np.ascontiguousarray(self.data, dtype=float))
+
     def save_csv(self, filename=None):
         import csv
         header = self.header()
@@ -155,15 +215,21 @@ class Profiles(object):
 
     @classmethod
     def compute(cls, keys, variables, function, parameters, parallel=None,
-                ipython_profile=None, group_name=None, show_progress=True, group_header=None):
+                ipython_profile=None, group_name=None, show_progress=True, group_header=None,
+                initializer=None, initargs=()):
         """
         Compute profiles by applying the parameters to the function in parallel.
+        If INITIALIZER is given, each worker calls initializer(*initargs)
+        before its first task.
 
         """
         assert len(keys) == len(parameters)
         njobs = len(parameters)
         parallel = parallel or ParallelProcessor.create_from_legacy(ipython_profile)
-        generator = parallel.view('profiles.compute').imap(function, parameters)
+        generator = parallel.view('profiles.compute').imap(function, parameters,
+                                                           chunksize=getattr(parallel, 'chunksize', None),
+                                                           initializer=initializer,
+                                                           initargs=initargs)
         if show_progress:
             import progressbar
             progress = progressbar.ProgressBar(widgets=[progressbar.Percentage(), ' ',
@@ -185,6 +251,13 @@ class Profiles(object):
                 logger.info('Retrying failed computation locally')
                 data[i] = function(p)
 
+        return cls.from_results(keys, data, variables, group_name=group_name, 
+                                group_header=group_header)
+
+    @classmethod
+    def from_results(cls, keys, data, variables, group_name=None, group_header=None):
+        """Return profiles of the keys whose result is not None and
+        does not contain NaNs."""
         rowmask = [(l != None) and all(~np.isnan(l)) for l in data]
         import itertools
         data = list(itertools.compress(data, rowmask))
@@ -229,6 +302,82 @@ class Profiles(object):
 
 
 
+def scatter_to_groups(results, groups, finalize):
+    """
+    Aggregate per-image results into per-group results.  RESULTS
+    iterates over (image_key, partial) pairs, e.g., as the plates are
+    processed, and GROUPS is a list of lists of image keys; an image
+    can belong to several groups.  As soon as the last image of a
+    group has arrived, (group index, FINALIZE(partials)) is yielded,
+    where PARTIALS is the list of the group's partial results, and
+    the group's list is released.  Groups without images are
+    finalized first, with an empty list.  Each image must occur at
+    most once in RESULTS.
+    """
+    groups_of_image = {}
+    remaining = []
+    for i, images in enumerate(groups):
+        images = set(images)
+        remaining.append(len(images))
+        for image in images:
+            groups_of_image.setdefault(image, []).append(i)
+    for i, n in enumerate(remaining):
+        if n == 0:
+            yield i, finalize([])
+    partials = {}
+    for image_key, partial in results:
+        for i in groups_of_image.pop(image_key, []):
+            partials.setdefault(i, []).append(partial)
+            remaining[i] -= 1
+            if remaining[i] == 0:
+                yield i, finalize(partials.pop(i))
+
+def compute_plate_major(function, parameters, groups, finalize, parallel, 
+                        show_progress=True):
+    """
+    Compute per-group results in one pass over the plates.
+    FUNCTION is applied in parallel to PARAMETERS, one per plate, and
+    returns a list of (image_key, partial) pairs for the images of
+    the plate.  Return a list with FINALIZE(partials) for each group
+    in GROUPS (see scatter_to_groups).  Plates whose computation
+    fails (returns None) are retried locally.
+    """
+    generator = parallel.view('profiles.plates').imap(
+        function, parameters, chunksize=getattr(parallel, 'chunksize', None))
+    if show_progress:
+        import progressbar
+        progress = progressbar.ProgressBar(widgets=[progressbar.Percentage(), ' ',
+                                                    progressbar.Bar(), ' ', 
+                                                    progressbar.Counter(), '/', 
+                                                    str(len(parameters)), ' ',
+                                                    progressbar.ETA()],
+                                           maxval=len(parameters))
+    else:
+        progress = lambda x: x
+
+    def image_results():
+        for p, result in zip(parameters, progress(generator)):
+            if result is None:
+                logger.info('Retrying failed plate computation locally')
+                result = function(p)
+                if result is None:
+                    raise RuntimeError('Failed to compute the results of a plate')
+            for item in result:
+                yield item
+
+    data = [None] * len(groups)
+    for i, result in scatter_to_groups(image_results(), groups, finalize):
+        data[i] = result
+    return data
+
+def images_per_plate(cache, groups):
+    """Return a dictionary mapping each plate to the list of the
+    images of the groups on it."""
+    per_plate = {}
+    for image in set(image for images in groups for image in images):
+        per_plate.setdefault(cache._plate_map[image], []).append(image)
+    return per_plate
+
 def add_common_options(parser):
     parser.add_option('--normalization', help='normalization method (default: RobustLinearNormalization)',
                       default='RobustLinearNormalization')
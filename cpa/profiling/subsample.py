@@ -10,6 +10,38 @@ def _compute_group_subsample((cache_dir, normalization_name, image_key,
                                                         removeRowsWithNaN=False)
     return normalizeddata[indices], np.hstack((np.array([image_key]*indices.shape[0]), _[indices][:,np.newaxis]))
 
+def _compute_plate_reservoirs((cache_dir, normalization_name, plate, strata, seed)):
+    """
+    Return one reservoir (see _merge_reservoirs) per (image_keys,
+    size) in STRATA, sampling SIZE of the cells of the images of the
+    plate in one pass.  Each cell gets a random priority from a
+    random state seeded with SEED, and the reservoir keeps the cells
+    with the smallest priorities.
+    """
+    import numpy as np
+    from cpa.profiling.cache import Cache
+    from cpa.profiling.normalization import normalizations
+    from cpa.profiling.parallel import worker_local
+    from cpa.profiling.subsample import _merge_reservoirs
+    cache = worker_local(('cache', cache_dir), Cache, cache_dir)
+    normalization = normalizations[normalization_name]
+    random_state = np.random.RandomState(seed)
+    reservoirs = []
+    for image_keys, size in strata:
+        reservoir = None
+        for image_key in cache.storage_order(image_keys):
+            data, colnames, cellids = cache.load([image_key], normalization=normalization,
+                                                 removeRowsWithNaN=False)
+            if len(data) == 0:
+                continue
+            objkeys = np.column_stack((np.tile(np.array(image_key), (len(data), 1)),
+                                       cellids))
+            reservoir = _merge_reservoirs(reservoir, (random_state.random_sample(len(data)),
+                                                      data, objkeys), size)
+        reservoirs.append(reservoir)
+    return reservoirs
+
+import os
 import cPickle as pickle
 import operator
 import random
@@ -44,6 +76,39 @@ def _make_parameters(cache_dir, normalization_name, image_keys,
 def _combine_subsample(generator):
     return np.vstack([a for a in generator])
 
+def _merge_reservoirs(a, b, size):
+    """
+    Merge two reservoirs, each a tuple (priorities, data, objkeys) of
+    arrays with one entry per cell, or None if empty, keeping the SIZE
+    cells with the smallest priorities (in no particular order).  As
+    the priorities are independent and uniform, the cells kept are a
+    uniform sample without replacement of all the cells that went
+    into the reservoirs, however they were merged.
+    """
+    if a is None or b is None:
+        merged = b if a is None else a
+    else:
+        if len(a[0]) == size:
+            # Only cells with smaller priorities than all of A can enter.
+            b = tuple(x[b[0] < a[0].max()] for x in b)
+        merged = tuple(np.concatenate((x, y)) for x, y in zip(a, b))
+    if merged is None or len(merged[0]) <= size:
+        return merged
+    keep = np.argpartition(merged[0], size - 1)[:size] if size > 0 else []
+    return tuple(np.asarray(x)[keep] for x in merged)
+
+def _make_progress(title, njobs, show_progress):
+    if not show_progress:
+        return lambda x: x
+    import progressbar
+    return progressbar.ProgressBar(widgets=[title,
+                                            progressbar.Percentage(), ' ',
+                                            progressbar.Bar(), ' ', 
+                                            progressbar.Counter(), '/', 
+                                            str(njobs), ' ',
+                                            progressbar.ETA()],
+                                   maxval=njobs)
+
 def make_count_cells_function(cache):
     """
     Return a function that computes the total number of cells
@@ -64,17 +129,65 @@ def organize_image_keys_per_group(image_keys, group):
 
 
 class Subsample(object):
+    """
+    A random sample of the normalized cells of the cache, with an
+    equal number of cells from each group if GROUP is given.
+
+    If STREAMING is true, each plate is read once in parallel, the
+    cells of each group being reservoir sampled as they are loaded,
+    and the per-plate reservoirs are merged at the end.  Otherwise
+    the indices of the sampled cells are drawn first and the images
+    containing them loaded.  With SEED, the sample is reproducible.
+    """
+
+    # Set by save() with memmap=True.
+    data_filename = None
+    objkeys_filename = None
+
     def __init__(self, cache_dir, sample_size, filter=None, group=None,
                  normalization=RobustLinearNormalization,
-                 parallel=Uniprocessing(), show_progress=True, verbose=True):
+                 parallel=Uniprocessing(), show_progress=True, verbose=True,
+                 streaming=False, seed=None):
         self.cache_dir = cache_dir
         self.normalization_name = normalization.__name__
         cache = Cache(self.cache_dir)
         self.variables = normalization(cache).colnames
+        self.streaming = streaming
+        self.seed = seed
         self.data, self.objkeys = self._compute(sample_size, filter, group, 
                                                 parallel, show_progress, 
                                                 verbose)
 
+    def save(self, filename, memmap=False):
+        """
+        Pickle the subsample to FILENAME.  If MEMMAP is true, the data
+        and the object keys are instead written to FILENAME.data.npy
+        and FILENAME.objkeys.npy, which are memory-mapped when the
+        subsample is unpickled, so that large subsamples can be used
+        without reading them into memory.
+        """
+        if memmap:
+            self.data_filename = os.path.abspath(filename + '.data.npy')
+            self.objkeys_filename = os.path.abspath(filename + '.objkeys.npy')
+            with replace_atomically(self.data_filename) as f:
+                np.save(f, self.data)
+            with replace_atomically(self.objkeys_filename) as f:
+                np.save(f, self.objkeys)
+        with replace_atomically(filename) as f:
+            pickle.dump(self, f)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.data_filename:
+            del state['data'], state['objkeys']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.data_filename:
+            self.data = np.load(self.data_filename, mmap_mode='r')
+            self.objkeys = np.load(self.objkeys_filename, mmap_mode='r')
+
     def _compute(self, sample_size, filter, group, parallel, show_progress, 
                  verbose):
         cache = Cache(self.cache_dir)
@@ -89,8 +202,7 @@ class Subsample(object):
         if verbose:
             print 'Subsampling {0} of {1} cells'.format(sample_size, ncells)
         if group is None:
-            return self._compute1([(sample_size, image_keys)], count_cells,
-                                  parallel, show_progress)
+            sample_sizes_and_keys = [(sample_size, image_keys)]
         else:
             per_group = organize_image_keys_per_group(image_keys, group)
             ngroups = len(per_group)
@@ -103,31 +215,55 @@ class Subsample(object):
                 needed = min(needed, ncells_this_group)
                 nchosen += needed
                 sample_sizes_and_keys.append((needed, keys))
-            return self._compute1(sample_sizes_and_keys, count_cells,
-                                  parallel, show_progress)
+        if self.streaming:
+            return self._compute_streaming(sample_sizes_and_keys, cache, parallel, 
+                                           show_progress)
+        return self._compute1(sample_sizes_and_keys, count_cells,
+                              parallel, show_progress)
+
+    def _compute_streaming(self, sample_sizes_and_keys, cache, parallel, show_progress):
+        strata_per_plate = {}
+        for i, (sample_size, image_keys) in enumerate(sample_sizes_and_keys):
+            keys_per_plate = {}
+            for image_key in image_keys:
+                keys_per_plate.setdefault(cache._plate_map[image_key], []).append(image_key)
+            for plate, keys in keys_per_plate.items():
+                strata_per_plate.setdefault(plate, []).append((i, keys, sample_size))
+        plates = sorted(strata_per_plate.keys())
+        # Seed each plate separately, so that the sample does not
+        # depend on how the plates are scheduled.
+        parameters = [(self.cache_dir, self.normalization_name, plate,
+                       [(keys, size) for i, keys, size in strata_per_plate[plate]],
+                       None if self.seed is None else [self.seed, j])
+                      for j, plate in enumerate(plates)]
+
+        generator = parallel.view('subsample.streaming').imap(_compute_plate_reservoirs,
+                                                              parameters)
+        progress = _make_progress('Subsampling:', len(parameters), show_progress)
+        reservoirs = [None] * len(sample_sizes_and_keys)
+        for plate, result in zip(plates, progress(generator)):
+            for (i, keys, size), reservoir in zip(strata_per_plate[plate], result):
+                reservoirs[i] = _merge_reservoirs(reservoirs[i], reservoir, size)
+        reservoirs = [r for r in reservoirs if r is not None]
+        if len(reservoirs) == 0:
+            return np.zeros((0, len(self.variables))), np.zeros((0, 0), dtype=int)
+        orders = [np.argsort(priorities) for priorities, _, _ in reservoirs]
+        return (np.vstack([data[order] for (_, data, _), order in zip(reservoirs, orders)]),
+                np.vstack([objkeys[order] for (_, _, objkeys), order in zip(reservoirs, orders)]))
 
     def _compute1(self, sample_sizes_and_keys, count_cells, parallel, show_progress):
         parameters = []
+        random_state = random.Random(self.seed)
         for sample_size, image_keys in sample_sizes_and_keys:
             ncells = count_cells(image_keys)
-            indices = np.array(random.sample(xrange(ncells), sample_size))
+            indices = np.array(random_state.sample(xrange(ncells), sample_size))
             per_image_indices = _break_indices(indices, image_keys, count_cells)
             parameters.extend(_make_parameters(self.cache_dir, self.normalization_name, 
                                                image_keys, per_image_indices))
 
         njobs = len(parameters)
         generator = parallel.view('subsample').imap(_compute_group_subsample, parameters)
-        if show_progress:
-            import progressbar
-            progress = progressbar.ProgressBar(widgets=['Subsampling:',
-                                                        progressbar.Percentage(), ' ',
-                                                        progressbar.Bar(), ' ', 
-                                                        progressbar.Counter(), '/', 
-                                                        str(njobs), ' ',
-                                                        progressbar.ETA()],
-                                               maxval=njobs)
-        else:
-            progress = lambda x: x
+        progress = _make_progress('Subsampling:', njobs, show_progress)
         results = list(progress(generator))
         data = _combine_subsample([a for (a,b) in results])
         objkey = _combine_subsample([b for (a,b) in results])
@@ -144,6 +280,11 @@ def _parse_arguments():
     parser.add_option('-v', dest='verbose', action='store_true', help='print additional information')
     parser.add_option('--normalization', help='normalization method (default: RobustLinearNormalization)',
                       default='RobustLinearNormalization')
+    parser.add_option('--streaming', dest='streaming', action='store_true', default=False,
+                      help='sample in a single pass over each plate (reservoir sampling)')
+    parser.add_option('--seed', dest='seed', type='int', help='random seed, for a reproducible sample')
+    parser.add_option('--memmap', dest='memmap', action='store_true', default=False,
+                      help='store the sampled cells in OUTPUT-FILENAME.data.npy and OUTPUT-FILENAME.objkeys.npy, which are memory-mapped when loaded')
     options, args = parser.parse_args()
     parallel = ParallelProcessor.create_from_options(parser, options)
     if len(args) < 3 or len(args) > 4:
@@ -165,6 +306,6 @@ if __name__ == '__main__':
     subsample = cpa.profiling.subsample.Subsample(
         cache_dir, sample_size, filter=options.filter, group=options.group,
         parallel=parallel, show_progress=options.progress, 
-        verbose=options.verbose, normalization=normalization)
-    with replace_atomically(output_filename) as f:
-        pickle.dump(subsample, f)
+        verbose=options.verbose, normalization=normalization,
+        streaming=options.streaming, seed=options.seed)
+    subsample.save(output_filename, memmap=options.memmap)
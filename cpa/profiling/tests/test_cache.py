@@ -1,3 +1,4 @@
+import os
 import tempfile
 import numpy as np
 import unittest
@@ -11,6 +12,15 @@ def test_make_progress_bar_no_text():
 def test_make_progress_bar_with_text():
     p = cache.make_progress_bar('Foo')
 
+def test_split_by_image():
+    rows = [(0, 1, 7, 1., 2.), (0, 1, 8, 3., 4.), (0, 3, 9, 5., 6.)]
+    features, cellids = cache._split_by_image(rows, 2, 5, [(0, 3), (0, 2), (0, 1)])
+    assert np.array_equal(features[0], [[5., 6.]])
+    assert features[1].shape == (0, 2)
+    assert np.array_equal(features[2], [[1., 2.], [3., 4.]])
+    assert np.array_equal(cellids[0], [9])
+    assert np.array_equal(cellids[2], [7, 8])
+
 def test_invert_dict():
     d = {'a': 1, 'b': 2, 'c': 1}
     inv = cache.invert_dict(d)
@@ -268,19 +278,356 @@ class CacheTestCase(unittest.TestCase):
                                         (3, 14): 'p1'})
 
     @patch('cpa.profiling.cache.make_progress_bar')
+    @patch.object(cache.Cache, '_create_cache_plate')
     @patch.object(cache.Cache, '_plate_map')
-    def test_create_cache_features(self, plate_map, make_progress_bar):
+    def test_create_cache_features(self, plate_map, create_cache_plate,
+                                   make_progress_bar):
         cache_dir = tempfile.mkdtemp()
         c = cache.Cache(cache_dir)
         plate_map.__get__ = Mock(return_value={(0L, 42L): 'p1', (1L, 23L): 'p2'})
         make_progress_bar.return_value = lambda x: x
-        c._create_cache_image = Mock()
         c._create_cache_features(False)
-        calls = c._create_cache_image.call_args_list
+        calls = create_cache_plate.call_args_list
         assert len(calls) == 2
-        assert call('p1', (0L, 42L), False) in calls
-        assert call('p2', (1L, 23L), False) in calls
+        assert call('p1', [(0L, 42L)], False) in calls
+        assert call('p2', [(1L, 23L)], False) in calls
+
+    @patch('cpa.db.execute')
+    @patch('cpa.dbconnect.GetWhereClauseForImages')
+    @patch('cpa.dbconnect.image_key_columns')
+    def test_create_cache_plate(self, image_key_columns, where, execute):
+        image_key_columns.return_value = ('TableNumber', 'ImageNumber')
+        where.return_value = 'where'
+        execute.return_value = [(0, 1, 1, 1., 2.), (0, 1, 2, 3., 4.),
+                                (0, 3, 1, 5., None)]
+        c = cache.Cache(tempfile.mkdtemp())
+        c._cached_colnames = ['foo', 'bar']
+        c._cached_plate_map = {(0, 1): 'p1', (0, 2): 'p1', (0, 3): 'p1'}
+        c._create_cache_plate('p1', [(0, 1), (0, 2), (0, 3)])
+        self.assertEqual(execute.call_count, 1)
+        features, colnames, cellids = c.load([(0, 1), (0, 2), (0, 3)],
+                                             removeRowsWithNaN=False)
+        assert np.array_equal(features[:2], [[1., 2.], [3., 4.]])
+        assert np.isnan(features[2, 1])
+        assert np.array_equal(cellids, [1, 2, 1])
+        self.assertEqual(len(c.load([(0, 2)])[0]), 0)
 
     # TODO: test_create_image
 
+    @patch.object(cache.Cache, '_query_objects')
+    def test_update_cache(self, query_objects):
+        c = cache.Cache(tempfile.mkdtemp())
+        c._cached_colnames = ['foo', 'bar']
+        c._cached_plate_map = {(0, 1): 'p1', (0, 2): 'p1', (0, 3): 'p2'}
+        for plate, image_keys, features, cellids in [
+            ('p1', [(0, 1), (0, 2)], [[[1., 2.]], [[3., 4.]]], [[1], [1]]),
+            ('p2', [(0, 3)], [[[5., 6.]]], [[1]])]:
+            os.mkdir(c._plate_dir(plate))
+            cache.PlateStore.write(c._plate_dir(plate), image_keys, 
+                                   map(np.array, features), map(np.array, cellids))
+        c._write_manifest(np.array([[0, 1, 1, 1], [0, 2, 1, 1], [0, 3, 1, 1]]))
+
+        # One object added to image (0, 2).
+        c._query_manifest = Mock(return_value=np.array([[0, 1, 1, 1], [0, 2, 2, 2], 
+                                                        [0, 3, 1, 1]]))
+        c._query_plate_map = Mock(return_value=c._cached_plate_map)
+        query_objects.return_value = ([np.array([[3., 4.], [7., 8.]])],
+                                      [np.array([1, 2])])
+        self.assertEqual(c._update_cache(), ['p1'])
+        query_objects.assert_called_once_with([(0, 2)])
+        features, colnames, cellids = c.load([(0, 1), (0, 2)])
+        assert np.array_equal(features, [[1., 2.], [3., 4.], [7., 8.]])
+        assert np.array_equal(cellids, [1, 1, 2])
+        self.assertEqual(c.get_manifest()[(0, 2)], (2, 2))
+        self.assertEqual(c.get_cell_counts()[(0, 2)], 2)
+
+        # Each update runs on its own view, so that a resuming backend
+        # does not return the results of the previous update.
+        from cpa.profiling.parallel import Uniprocessing
+        parallel = Mock()
+        parallel.view.side_effect = lambda name: Uniprocessing().view(name)
+        c._query_manifest.return_value = np.array([[0, 1, 1, 1], [0, 2, 2, 2],
+                                                   [0, 3, 2, 2]])
+        query_objects.return_value = ([np.array([[5., 6.], [9., 10.]])],
+                                      [np.array([1, 2])])
+        self.assertEqual(c._update_cache(parallel), ['p2'])
+        c._query_manifest.return_value = np.array([[0, 1, 1, 1], [0, 2, 2, 2],
+                                                   [0, 3, 3, 3]])
+        self.assertEqual(c._update_cache(parallel), ['p2'])
+        first, second = [call[0][0] for call in parallel.view.call_args_list]
+        assert first.startswith('cache.update.') and first != second
+
+    def test_convert_and_load(self):
+        c = make_image_file_cache()
+        unconverted = c.load([(0, 1), (0, 2), (0, 3)])
+        c.convert()
+        assert cache.PlateStore.exists(c._plate_dir('p1'))
+        converted = c.load([(0, 1), (0, 2), (0, 3)])
+        assert np.array_equal(converted[0], unconverted[0])
+        assert np.array_equal(converted[2], unconverted[2])
+        assert converted[1] == unconverted[1]
+
+    def test_convert_remove_image_files(self):
+        c = make_image_file_cache()
+        c.convert(remove_image_files=True)
+        assert not os.path.exists(c._image_filename('p1', (0, 1)))
+        features, colnames, cellids = c.load([(0, 3)])
+        assert np.array_equal(features, [[5., 6.]])
+        assert np.array_equal(cellids, [1])
+
+    def test_load_objects(self):
+        c = make_image_file_cache()
+        c.convert()
+        features = c.load_objects([(0, 4, 5), (0, 1, 2), (0, 3, 1), (0, 1, 1)])
+        assert np.array_equal(features, [[8., 9.], [3., 4.], [5., 6.], [1., 2.]])
+
+    def test_load_objects_missing(self):
+        c = make_image_file_cache()
+        self.assertRaises(ValueError, lambda: c.load_objects([(0, 1, 3)]))
+        # Object (0, 3, 2) has a NaN feature.
+        self.assertRaises(ValueError, lambda: c.load_objects([(0, 3, 2)]))
+        self.assertEqual(len(c.load_objects([(0, 3, 2)], removeRowsWithNaN=False)), 1)
+
+    def test_iter_batches(self):
+        c = make_image_file_cache()
+        c.convert()
+        image_keys = [(0, 1), (0, 2), (0, 3), (0, 4)]
+        for readahead in [0, 2]:
+            batches = list(c.iter_batches(image_keys, batch_rows=2, 
+                                          readahead=readahead))
+            self.assertEqual([len(f) for f, k in batches], [2, 2])
+            features = np.vstack([f for f, k in batches])
+            object_keys = np.vstack([k for f, k in batches])
+            assert np.array_equal(features, [[1., 2.], [3., 4.], [5., 6.], [8., 9.]])
+            assert np.array_equal(object_keys, [[0, 1, 1], [0, 1, 2], [0, 3, 1], [0, 4, 5]])
+        # The images are read in storage order, whatever their order.
+        batches = list(c.iter_batches(image_keys[::-1], batch_rows=2))
+        assert np.array_equal(np.vstack([k for f, k in batches]),
+                              [[0, 1, 1], [0, 1, 2], [0, 3, 1], [0, 4, 5]])
+
+    def test_storage_order(self):
+        c = make_image_file_cache()
+        c.convert()
+        order = c.storage_order([(0, 4), (0, 3), (0, 1), (0, 2)])
+        offsets = c._plate_store('p1').offsets
+        self.assertEqual(order[-1], (0, 4))
+        self.assertEqual(order[:3], sorted(order[:3], key=lambda k: offsets[k]))
+
+    def test_iter_batches_readahead_error(self):
+        c = make_image_file_cache()
+        os.unlink(c._image_filename('p1', (0, 3)))
+        batches = c.iter_batches([(0, 1), (0, 3)], readahead=1)
+        self.assertRaises(IOError, lambda: list(batches))
+
+    def test_load_stats(self):
+        c = make_image_file_cache()
+        self.assertEqual(c.load_stats([(0, 1)]), None)
+        c.convert()
+        image_keys = [(0, 1), (0, 2), (0, 3), (0, 4)]
+        stats = c.load_stats(image_keys)
+        data = c.load(image_keys)[0]
+        self.assertEqual(stats.count, len(data))
+        assert np.allclose(stats.mean(), data.mean(axis=0))
+        assert np.allclose(stats.std(), data.std(axis=0))
+        assert np.array_equal(stats.min, data.min(axis=0))
+        assert np.array_equal(stats.max, data.max(axis=0))
+
+    def test_load_sketch(self):
+        c = make_image_file_cache()
+        c.convert()
+        self.assertEqual(c.load_sketch([(0, 1)]), None)
+        c = make_image_file_cache()
+        c._create_cache_settings(False, sketch_error=0.5)
+        c.convert()
+        image_keys = [(0, 1), (0, 2), (0, 3), (0, 4)]
+        sketch = c.load_sketch(image_keys)
+        self.assertEqual(sketch.count, 4)
+        assert np.array_equal(sketch.median(), [3., 4.])
+
+    def test_float32_compressed(self):
+        c = make_image_file_cache()
+        unconverted = c.load([(0, 1), (0, 3)])[0]
+        c._create_cache_settings(False, dtype='float32', compress=True)
+        c.convert()
+        assert os.path.exists(os.path.join(c._plate_dir('p1'), 'features.npz'))
+        assert not os.path.exists(os.path.join(c._plate_dir('p1'), 'features.npy'))
+        features = c.load([(0, 1), (0, 3)])[0]
+        self.assertEqual(features.dtype, np.float64)
+        assert np.array_equal(features, unconverted)
+        features = c.load([(0, 1), (0, 3)], dtype=None)[0]
+        self.assertEqual(features.dtype, np.float32)
+        assert np.array_equal(features, unconverted)
+
+    def test_max_cached_plates(self):
+        c = make_image_file_cache()
+        c.convert()
+        c.max_cached_plates = 1
+        store = c._plate_store('p1')
+        c._plate_store('p2')
+        self.assertEqual(c._plate_stores.keys(), ['p2'])
+        assert c._plate_store('p1') is not store
+
+
+def test_quantile_sketch():
+    data = np.random.RandomState(0).normal(size=(1000, 3))
+    data[0, 1] = np.nan
+    sketch = cache.QuantileSketch.from_data(data[:300], 100).merge(
+        cache.QuantileSketch.from_data(data[300:350], 100)).merge(
+        cache.QuantileSketch.from_data(data[350:], 100))
+    data = data[1:]
+    assert np.allclose(sketch.count, len(data))
+    qs = [0.01, 0.1, 0.5, 0.9, 0.99]
+    approx = sketch.quantiles(qs)
+    for i, q in enumerate(qs):
+        ranks = (data < approx[i]).mean(axis=0)
+        assert np.all(np.fabs(ranks - q) <= 0.01 + 1. / len(data))
+    shift = np.array([1., -2., 3.])
+    scale = np.array([2., 0.5, 4.])
+    assert np.allclose(sketch.affine(shift, scale).median(),
+                       (sketch.median() - shift) / scale)
+    median = np.median(data, axis=0)
+    mad = np.median(np.fabs(data - median), axis=0)
+    assert np.allclose(sketch.mad(median), mad, atol=0.05)
+
+
+def test_quantile_sketch_compaction():
+    data = np.random.RandomState(0).normal(size=(20000, 2))
+    sketches = [cache.QuantileSketch.from_data(data[i:i + 100], 50)
+                for i in range(0, len(data), 100)]
+    merged = cache.QuantileSketch.merge_all(sketches)
+    assert len(merged.values) <= 100
+    assert np.allclose(merged.count, len(data))
+    ranks = (data < merged.median()).mean(axis=0)
+    assert np.all(np.fabs(ranks - 0.5) <= 0.02)
+    sequential = reduce(lambda a, b: a.merge(b), sketches)
+    assert len(sequential.values) <= 100
+    assert np.allclose(sequential.count, len(data))
+    empty = cache.QuantileSketch.from_data(np.zeros((0, 2)), 50)
+    assert empty.merge(empty).merge(empty).count == 0
+
+
+def test_summary_statistics_affine():
+    data = np.random.RandomState(0).normal(size=(50, 3))
+    shift = np.array([1., -2., 3.])
+    scale = np.array([2., 0.5, 4.])
+    stats = cache.SummaryStatistics.from_data(data[:20]).merge(
+        cache.SummaryStatistics.from_data(data[20:])).affine(shift, scale)
+    normalized = (data - shift) / scale
+    assert np.allclose(stats.mean(), normalized.mean(axis=0))
+    assert np.allclose(stats.std(), normalized.std(axis=0))
+    assert np.allclose(stats.min, normalized.min(axis=0))
+    assert np.allclose(stats.max, normalized.max(axis=0))
+
+
+def test_summary_statistics_precision():
+    # A large mean and a small spread, as for intensity features.
+    data = 1e8 + np.random.RandomState(0).normal(size=(3000, 2))
+    stats = cache.SummaryStatistics.from_data(data[:1000]).merge(
+        cache.SummaryStatistics.from_data(data[1000:]))
+    assert np.allclose(stats.std(), data.std(axis=0), rtol=1e-6)
+    plate_dir = tempfile.mkdtemp()
+    cache.PlateStore.write(plate_dir, [(0, 1), (0, 2), (0, 3)],
+                           [data[:1000], data[1000:2500], data[2500:]], None)
+    stats = cache.PlateStore.open(plate_dir).stats([(0, 1), (0, 2), (0, 3)])
+    assert stats.count == 3000
+    assert np.allclose(stats.mean(), data.mean(axis=0), rtol=1e-12)
+    assert np.allclose(stats.std(), data.std(axis=0), rtol=1e-6)
+
+
+def test_summary_statistics_old_format():
+    data = np.random.RandomState(0).normal(size=(30, 2))
+    plate_dir = tempfile.mkdtemp()
+    cache.PlateStore.write(plate_dir, [(0, 1), (0, 2)], [data[:10], data[10:]], None)
+    with open(os.path.join(plate_dir, 'stats.npz'), 'wb') as f:
+        np.savez(f, count=np.array([10, 20]),
+                 sum=np.array([data[:10].sum(0), data[10:].sum(0)]),
+                 sumsq=np.array([(data[:10] ** 2).sum(0), (data[10:] ** 2).sum(0)]),
+                 min=np.array([data[:10].min(0), data[10:].min(0)]),
+                 max=np.array([data[:10].max(0), data[10:].max(0)]))
+    stats = cache.PlateStore.open(plate_dir).stats([(0, 1), (0, 2)])
+    assert np.allclose(stats.mean(), data.mean(axis=0))
+    assert np.allclose(stats.std(), data.std(axis=0))
+
+
+def make_image_file_cache():
+    """Make a cache directory with one feature file per image: two
+    plates, one image without objects and one row with a NaN."""
+    cache_dir = tempfile.mkdtemp()
+    with open(os.path.join(cache_dir, 'colnames.txt'), 'w') as f:
+        print >>f, 'foo'
+        print >>f, 'bar'
+    plate_map = {(0, 1): 'p1', (0, 2): 'p1', (0, 3): 'p1', (0, 4): 'p2'}
+    cpa.util.pickle(os.path.join(cache_dir, 'image_to_plate.pickle'), plate_map)
+    c = cache.Cache(cache_dir)
+    images = {(0, 1): ([[1., 2.], [3., 4.]], [1, 2]),
+              (0, 2): (np.zeros((0, 2)), []),
+              (0, 3): ([[5., 6.], [np.nan, 7.]], [1, 2]),
+              (0, 4): ([[8., 9.]], [5])}
+    for image_key, (features, cellids) in images.items():
+        plate_dir = c._plate_dir(plate_map[image_key])
+        if not os.path.exists(plate_dir):
+            os.mkdir(plate_dir)
+        np.savez(c._image_filename(plate_map[image_key], image_key),
+                 features=np.array(features, dtype=float),
+                 cellids=np.array(cellids))
+    return c
+
+
+class PlateStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.plate_dir = tempfile.mkdtemp()
+        cache.PlateStore.write(self.plate_dir, [(0, 1), (0, 2), (0, 3)],
+                               [np.array([[1., 2.], [3., 4.]]),
+                                np.array([]),
+                                np.array([[5., 6.]])],
+                               [np.array([7, 8]), np.array([]), np.array(9)])
+        self.store = cache.PlateStore.open(self.plate_dir)
+
+    def test_exists(self):
+        assert cache.PlateStore.exists(self.plate_dir)
+        assert not cache.PlateStore.exists(tempfile.mkdtemp())
+
+    def test_offsets(self):
+        self.assertEqual(self.store.offsets, {(0, 1): (0, 2), (0, 2): (2, 2),
+                                              (0, 3): (2, 3)})
+
+    def test_rows_contiguous(self):
+        features, cellids = self.store.rows([(0, 3), (0, 1)])
+        assert isinstance(features, np.memmap)
+        assert np.array_equal(features, [[1., 2.], [3., 4.], [5., 6.]])
+        assert np.array_equal(cellids, [7, 8, 9])
+
+    def test_rows_gathered(self):
+        cache.PlateStore.write(self.plate_dir, [(0, 1), (0, 2), (0, 3)],
+                               [np.array([[1., 2.]]), np.array([[3., 4.]]),
+                                np.array([[5., 6.]])], None)
+        store = cache.PlateStore.open(self.plate_dir)
+        features, cellids = store.rows([(0, 3), (0, 1)])
+        assert not isinstance(features, np.memmap)
+        assert np.array_equal(features, [[1., 2.], [5., 6.]])
+        assert cellids is None
+
+    def test_compressed_chunks(self):
+        features = np.arange(20.).reshape((10, 2))
+        with patch.object(cache.PlateStore, 'chunk_rows', 3):
+            cache.PlateStore.write(self.plate_dir, [(0, 1), (0, 2)],
+                                   [features[:4], features[4:]], None, compress=True)
+        store = cache.PlateStore.open(self.plate_dir)
+        store.features.max_cached_chunks = 2
+        assert isinstance(store.features, cache.CompressedFeatures)
+        self.assertEqual(store.features.shape, (10, 2))
+        assert np.array_equal(store.features[2:8], features[2:8])
+        assert np.array_equal(store.features[4:6], features[4:6])
+        self.assertEqual(store.features._cached_chunks.keys(), [2, 1])
+        assert np.array_equal(store.features[np.array([9, 0, 5])], features[[9, 0, 5]])
+        assert np.array_equal(store.rows([(0, 2)])[0], features[4:])
+        self.assertEqual(store.features[3:3].shape, (0, 2))
+
+    def test_compressed_unchunked(self):
+        features = np.arange(6.).reshape((3, 2))
+        with open(os.path.join(self.plate_dir, 'features.npz'), 'wb') as f:
+            np.savez_compressed(f, features=features)
+        assert np.array_equal(cache.CompressedFeatures(
+                os.path.join(self.plate_dir, 'features.npz'))[1:3], features[1:3])
+
     # TODO: test_check_directory
@@ -0,0 +1,86 @@
+import numpy as np
+from scipy.spatial.distance import cdist
+import cpa.util
+from cpa.profiling.distances import DistanceEngine, tile_distances, histogram_auc
+
+
+def make_data():
+    data = np.random.RandomState(0).normal(size=(23, 4))
+    labels = np.arange(23) % 3
+    return data, labels
+
+
+def test_tile_distances():
+    data, _ = make_data()
+    for metric in ['cosine', 'euclidean', 'cityblock']:
+        assert np.allclose(tile_distances(data[:5], data, metric), cdist(data[:5], data, metric))
+
+
+def test_tiles():
+    data, _ = make_data()
+    for nthreads in [1, 3]:
+        engine = DistanceEngine(data, block_size=4, nthreads=nthreads)
+        tiles = list(engine.tiles())
+        assert [(start, stop) for start, stop, _ in tiles] == \
+            [(0, 4), (4, 8), (8, 12), (12, 16), (16, 20), (20, 23)]
+        full = np.vstack([dist for _, _, dist in tiles])
+        expected = cdist(data, data, 'cosine')
+        np.fill_diagonal(expected, np.nan)
+        assert np.allclose(full, expected, equal_nan=True)
+
+
+def test_nearest_neighbors():
+    data, _ = make_data()
+    dist = cdist(data, data, 'euclidean')
+    np.fill_diagonal(dist, np.inf)
+    engine = DistanceEngine(data, metric='euclidean', block_size=5, nthreads=2)
+    assert np.array_equal(engine.nearest_neighbors(3), np.argsort(dist, axis=1)[:, :3])
+    # Excluding everything but one neighbor leaves -1 for the others.
+    exclude = lambda start, stop: np.tile(np.arange(23) != 0, (stop - start, 1))
+    neighbors = engine.nearest_neighbors(2, exclude=exclude)
+    assert np.all(neighbors[1:, 0] == 0)
+    assert np.all(neighbors[1:, 1] == -1)
+    assert np.all(neighbors[0] == -1)
+
+
+def test_group_means():
+    data, labels = make_data()
+    dist = cdist(data, data, 'cityblock')
+    means = DistanceEngine(data, metric='cityblock', block_size=7).group_means(labels)
+    for g in range(3):
+        for h in range(3):
+            block = dist[labels == g][:, labels == h]
+            if g == h:
+                expected = block.sum() / (block.size - len(block))
+            else:
+                expected = block.mean()
+            assert np.allclose(means[g, h], expected)
+
+
+def test_histograms():
+    data, labels = make_data()
+    dist = cdist(data, data, 'cosine')
+    upper = np.triu(np.ones((23, 23), dtype=bool), 1)
+    same = labels[:, np.newaxis] == labels
+    edges = np.linspace(0, 2, 11)
+    engine = DistanceEngine(data, block_size=6)
+    h_same, h_all = engine.histograms(edges, [lambda start, stop: same[start:stop],
+                                              lambda start, stop: upper[start:stop]])
+    off_diagonal = ~np.eye(23, dtype=bool)
+    assert np.array_equal(h_same, np.histogram(dist[same & off_diagonal], edges)[0])
+    assert np.array_equal(h_all, np.histogram(dist[upper], edges)[0])
+    inter = np.histogram(dist[upper & ~same], np.linspace(0, 2, 2001))[0]
+    intra = np.histogram(dist[upper & same], np.linspace(0, 2, 2001))[0]
+    assert np.allclose(histogram_auc(inter, intra),
+                       cpa.util.auc(dist[upper & ~same], dist[upper & same]), atol=1e-3)
+
+
+def test_rank_histogram():
+    data, labels = make_data()
+    dist = cdist(data, data, 'euclidean')
+    np.fill_diagonal(dist, np.inf)
+    ranks = np.argsort(np.argsort(dist, axis=1), axis=1)
+    same = (labels[:, np.newaxis] == labels) & ~np.eye(23, dtype=bool)
+    engine = DistanceEngine(data, metric='euclidean', block_size=4)
+    assert np.array_equal(engine.rank_histogram(labels),
+                          np.bincount(ranks[same], minlength=23))
@@ -88,3 +88,30 @@ def test_main(pclass, unpickle, pickle):
     factor_analysis._main(['foo.subsample', '5', 'foo.famodel'])
     pclass.assert_called_once()
 
+
+
+def test_independent_columns():
+    from cpa.profiling.preprocessing import ScatterMatrix
+    d = factor_analysis.standardize(np.random.RandomState(0).normal(size=(100, 4)))
+    d = np.column_stack((d[:, :2], d[:, 0] + d[:, 1], d[:, 2:]))
+    _, R = np.linalg.qr(d)
+    expected = np.where(np.abs(R.diagonal()) > 1e-5)[0]
+    selected = factor_analysis._independent_columns(ScatterMatrix.from_data(d).scatter, 1e-5)
+    assert np.array_equal(selected, expected)
+    assert np.array_equal(selected, [0, 1, 3, 4])
+
+
+def test_incremental_factor_analysis():
+    from cpa.profiling.preprocessing import ScatterMatrix
+    d = np.random.RandomState(0).normal(size=(500, 3))
+    d = np.column_stack((d, d[:, :2].sum(axis=1) + 0.1 * d[:, 2]))
+    d = factor_analysis.standardize(d)
+    variables = ['f%d' % (i + 1) for i in xrange(4)]
+    np.random.seed(1)
+    exact = factor_analysis.FactorAnalysisPreprocessor(d, variables, 2)
+    np.random.seed(1)
+    incremental = factor_analysis.IncrementalFactorAnalysisPreprocessor(
+        ScatterMatrix.from_data(d), variables, 2)
+    assert np.array_equal(incremental.selected_variables, exact.selected_variables)
+    assert np.allclose(incremental.fa_node.E_y_mtx, exact.fa_node.E_y_mtx, atol=1e-6)
+    assert np.allclose(incremental(d), exact(d), atol=1e-6)
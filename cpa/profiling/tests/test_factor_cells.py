@@ -0,0 +1,70 @@
+import numpy as np
+from mock import Mock, patch
+from cpa.profiling import factor_cells, parallel
+from cpa.profiling.parallel import Uniprocessing
+
+
+def test_reduce_candidates():
+    values = np.random.RandomState(0).normal(size=1000)
+    keys = np.arange(1000)[:, np.newaxis]
+    reduced, reduced_keys = factor_cells.reduce_candidates((values, keys), 10)
+    assert len(reduced) <= 20
+    assert np.array_equal(values[reduced_keys[:, 0]], reduced)
+    assert reduced.min() == values.min() and reduced.max() == values.max()
+    # Every value is within one bin width of a candidate.
+    width = (values.max() - values.min()) / 10
+    assert np.abs(values[:, np.newaxis] - reduced).min(axis=1).max() <= width
+
+
+def test_factor_cells():
+    parallel.clear_worker_memo()
+    data = np.random.RandomState(1).normal(size=(60, 2))
+    images = [(1, i) for i in range(6)]
+    cache = Mock()
+    cache._plate_map = dict((image, 'p%d' % (image[1] % 2)) for image in images)
+    cache.storage_order.side_effect = sorted
+    cache.load.side_effect = lambda (image,), normalization: \
+        (data[image[1] * 10:image[1] * 10 + 10], None, range(10))
+    with patch('cpa.profiling.factor_cells.Cache', return_value=cache):
+        with patch('cpa.profiling.cache.Cache', return_value=cache):
+            ranges, neighbors = factor_cells.factor_cells(
+                'cache', images, nsteps=5, parallel=Uniprocessing(), nbins=100,
+                show_progress=False)
+    assert np.array_equal(ranges, np.vstack([data.min(0), data.max(0)]).T)
+    # With more bins than cells per image, the result is exact.
+    for factor in range(2):
+        for step, value in enumerate(np.linspace(ranges[factor, 0], ranges[factor, 1], 5)):
+            i = np.argmin(np.abs(data[:, factor] - value))
+            assert tuple(neighbors[factor * 5 + step]) == (1, i // 10, i % 10)
+    parallel.clear_worker_memo()
+
+
+def test_factor_cells_bounded():
+    parallel.clear_worker_memo()
+    data = np.random.RandomState(2).normal(size=(200, 2))
+    images = [(1, i) for i in range(20)]
+    cache = Mock()
+    cache._plate_map = dict((image, 'p%d' % (image[1] % 5)) for image in images)
+    cache.storage_order.side_effect = sorted
+    cache.load.side_effect = lambda (image,), normalization: \
+        (data[image[1] * 10:image[1] * 10 + 10], None, range(10))
+    sizes = []
+    merge_candidates = factor_cells.merge_candidates
+    def merge(a, b, nbins):
+        sizes.append(max(len(values) for values, keys in a + b))
+        return merge_candidates(a, b, nbins)
+    with patch('cpa.profiling.factor_cells.Cache', return_value=cache):
+        with patch('cpa.profiling.cache.Cache', return_value=cache):
+            with patch('cpa.profiling.factor_cells.merge_candidates', side_effect=merge):
+                ranges, neighbors = factor_cells.factor_cells(
+                    'cache', images, nsteps=3, parallel=Uniprocessing(), nbins=3,
+                    show_progress=False)
+    parallel.clear_worker_memo()
+    # Every merge, within and across plates, has bounded inputs.
+    assert len(sizes) == 19
+    assert max(sizes) <= 6
+    assert np.array_equal(ranges, np.vstack([data.min(0), data.max(0)]).T)
+    assert neighbors.shape == (6, 3)
+    # The extremes are always kept.
+    i = np.argmin(data[:, 0])
+    assert tuple(neighbors[0]) == (1, i // 10, i % 10)
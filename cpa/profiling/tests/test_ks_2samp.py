@@ -0,0 +1,24 @@
+import numpy as np
+from cpa.profiling.ks_2samp import ks_2samp, ks_2samp_columns, SortedColumns
+
+
+def test_ks_2samp_columns():
+    random = np.random.RandomState(0)
+    for n1, n2 in [(100, 30), (20, 20), (5, 50), (1, 1)]:
+        control = random.normal(size=(n1, 4))
+        data = random.normal(loc=[0, 0.5, -0.5, 2], size=(n2, 4))
+        expected = [ks_2samp(control[:, j], data[:, j], signed=True)[0]
+                    for j in range(4)]
+        assert np.allclose(ks_2samp_columns(SortedColumns(control), data), expected)
+
+
+def test_ks_2samp_columns_ties():
+    control = np.array([[0.], [1.], [1.], [2.]])
+    data = np.array([[1.], [1.], [3.]])
+    expected = ks_2samp(control[:, 0], data[:, 0], signed=True)[0]
+    assert np.allclose(ks_2samp_columns(SortedColumns(control), data), [expected])
+
+
+def test_ks_2samp_columns_empty():
+    control = SortedColumns(np.zeros((3, 2)))
+    assert np.all(np.isnan(ks_2samp_columns(control, np.zeros((0, 2)))))
@@ -0,0 +1,40 @@
+import numpy as np
+from mock import Mock
+from cpa.profiling import leave_one_out
+from cpa.profiling.profiles import Profiles
+
+
+def make_profiles(data):
+    keys = [(str(i),) for i in range(len(data))]
+    profiles = Profiles(keys, data, ['v%d' % j for j in range(data.shape[1])])
+    moa = dict((k, 'moa%d' % (i % 3)) for i, k in enumerate(keys))
+    plate = dict((k, ('plate%d' % (i % 4),)) for i, k in enumerate(keys))
+    profiles.regroup = Mock(side_effect=lambda name: {'moa': moa, 'plate': plate}[name])
+    return profiles
+
+
+def test_crossvalidate_vectorized():
+    for holdout in [None, 'plate']:
+        for distance in ['cosine', 'euclidean', 'cityblock']:
+            data = np.random.RandomState(0).normal(size=(30, 5))
+            if distance != 'cosine':
+                # The cosine distance to an all-zero profile is undefined.
+                data[3] = 0
+            expected = leave_one_out.crossvalidate(make_profiles(data), 'moa', holdout,
+                                                   distance=distance)
+            confusion = leave_one_out.crossvalidate_vectorized(
+                make_profiles(data), 'moa', holdout, distance=distance, block_size=7)
+            assert confusion == expected
+
+
+def test_nearest_neighbors():
+    training = np.array([[0.], [1.], [3.], [6.]])
+    test = np.array([[2.9], [0.2]])
+    exclude = lambda start, stop: np.array([[False, False, True, False],
+                                            [False, True, True, True]])[start:stop]
+    neighbors = leave_one_out.nearest_neighbors(test, training, k=3, distance='euclidean',
+                                                exclude=exclude, block_size=1)
+    assert np.array_equal(neighbors, [[1, 3, -1], [-1, -1, -1]])
+    # The all-zero training profile is never a neighbor.
+    neighbors = leave_one_out.nearest_neighbors(test, training, k=2, distance='euclidean')
+    assert np.array_equal(neighbors, [[2, 1], [1, 2]])
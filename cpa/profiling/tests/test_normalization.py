@@ -0,0 +1,155 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from mock import Mock, patch
+from cpa.profiling import normalization
+
+
+class RobustLinearNormalizationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.c = Mock()
+        self.c.cache_dir = tempfile.mkdtemp()
+        self.n = normalization.RobustLinearNormalization(self.c)
+        os.makedirs(os.path.join(self.n.dir, 'params'))
+        v = np.linspace(1, 9, 101)
+        self.data = np.vstack([v, v * 2, v * 10]).T
+        np.save(self.n._params_filename('p1'),
+                np.vstack([self.data[1, :], self.data[-2, :]]))
+        self.n._cached_colmask = np.array([True, False, True])
+
+    def test_normalize(self):
+        original = self.data.copy()
+        normalized = self.n.normalize('p1', self.data)
+        assert np.array_equal(self.data, original)
+        self.assertEqual(normalized.shape, (101, 2))
+        self.assertAlmostEqual(normalized[1, 0], 0)
+        self.assertAlmostEqual(normalized[1, 1], 0)
+        self.assertAlmostEqual(normalized[-2, 0], 1)
+        self.assertAlmostEqual(normalized[-2, 1], 1)
+        self.assertAlmostEqual(normalized[50, 0], 0.5)
+
+    def test_params_read_once(self):
+        with patch('cpa.profiling.normalization.np_load',
+                   side_effect=normalization.np_load) as np_load:
+            first = self.n.normalize('p1', self.data)
+            second = self.n.normalize('p1', self.data)
+            self.assertEqual(np_load.call_count, 1)
+        assert np.array_equal(first, second)
+
+    def test_normalize_stats(self):
+        from cpa.profiling.cache import SummaryStatistics
+        stats = self.n.normalize_stats('p1', SummaryStatistics.from_data(self.data))
+        normalized = self.n.normalize('p1', self.data)
+        assert np.allclose(stats.mean(), normalized.mean(axis=0))
+        assert np.allclose(stats.std(), normalized.std(axis=0))
+
+    def test_normalize_sketch(self):
+        from cpa.profiling.cache import QuantileSketch
+        sketch = self.n.normalize_sketch('p1', QuantileSketch.from_data(self.data, 200))
+        normalized = self.n.normalize('p1', self.data)
+        assert np.allclose(sketch.median(), np.median(normalized, axis=0))
+
+    def test_max_cached_plates(self):
+        np.save(self.n._params_filename('p2'),
+                np.vstack([self.data[0, :], self.data[-1, :]]))
+        self.n.max_cached_plates = 1
+        self.n.normalize('p1', self.data)
+        self.n.normalize('p2', self.data)
+        self.assertEqual(self.n._cached_shift_scale.keys(), ['p2'])
+
+
+class StdNormalizationTestCase(unittest.TestCase):
+    def test_normalize(self):
+        c = Mock()
+        c.cache_dir = tempfile.mkdtemp()
+        n = normalization.StdNormalization(c)
+        n._cached_colmask = np.array([True, True])
+        data = np.array([[1., 2.], [3., 6.]])
+        n._plate_shift_and_scale = Mock(return_value=(np.array([2., 4.]),
+                                                      np.array([1., 2.])))
+        assert np.array_equal(n.normalize('p1', data), [[-1., -1.], [1., 1.]])
+
+
+def test_compute_params():
+    from scipy.stats.stats import scoreatpercentile
+    from scipy.stats import norm as Gaussian
+    features = np.random.RandomState(0).normal(size=(200, 4))
+    c = Mock()
+    c.cache_dir = 'foo'
+    params = normalization.RobustLinearNormalization(c)._compute_params(features)
+    for j in range(4):
+        np.testing.assert_almost_equal(params[0, j], scoreatpercentile(features[:, j], 1))
+        np.testing.assert_almost_equal(params[1, j], scoreatpercentile(features[:, j], 99))
+    params = normalization.RobustStdNormalization(c)._compute_params(features)
+    for j in range(4):
+        d = np.median(features[:, j])
+        np.testing.assert_almost_equal(params[0, j], d)
+        np.testing.assert_almost_equal(params[1, j], np.median(np.fabs(features[:, j] - d) / Gaussian.ppf(3/4.)))
+    params = normalization.StdNormalization(c)._compute_params(features)
+    np.testing.assert_almost_equal(params[1], features.std(axis=0))
+
+
+def test_compute_params_from_sketch():
+    from cpa.profiling.cache import QuantileSketch
+    features = np.random.RandomState(0).normal(size=(2000, 4))
+    sketch = QuantileSketch.from_data(features, 500)
+    c = Mock()
+    c.cache_dir = 'foo'
+    for Normalization in [normalization.RobustLinearNormalization,
+                          normalization.RobustStdNormalization]:
+        n = Normalization(c)
+        exact = n._compute_params(features)
+        approximate = n._compute_params_from_sketch(sketch)
+        assert np.allclose(approximate, exact, atol=0.1)
+    n = normalization.StdNormalization(c)
+    np.testing.assert_raises(NotImplementedError, n._compute_params_from_sketch, sketch)
+
+
+@patch('cpa.profiling.normalization.make_progress_bar')
+def test_create_cache_params(make_progress_bar):
+    make_progress_bar.return_value = lambda x: x
+    c = Mock()
+    c.cache_dir = tempfile.mkdtemp()
+    c.get_manifest.return_value = None
+    n = normalization.StdNormalization(c)
+    n._get_controls = Mock(return_value={'p1': [(0, 1)], 'p2': [(0, 2)]})
+    with patch.object(normalization.StdNormalization, '_create_cache_params_1') as create:
+        with patch('cpa.profiling.cache.Cache'):
+            n._create_cache_params('predicate')
+    assert sorted(call[0][0] for call in create.call_args_list) == ['p1', 'p2']
+    assert os.path.isdir(os.path.join(n.dir, 'params'))
+
+
+def test_create_cache_params_lsf():
+    import pickle
+    from cpa.profiling import cache, lsf
+    cache_dir = tempfile.mkdtemp()
+    with open(os.path.join(cache_dir, 'colnames.txt'), 'w') as f:
+        f.write('a\nb\n')
+    image_keys = [(0, 1), (0, 2)]
+    with open(os.path.join(cache_dir, 'image_to_plate.pickle'), 'wb') as f:
+        pickle.dump(dict((image_key, 'p1') for image_key in image_keys), f)
+    os.makedirs(os.path.join(cache_dir, 'p1'))
+    features = np.random.RandomState(0).normal(size=(20, 2))
+    cache.PlateStore.write(os.path.join(cache_dir, 'p1'), image_keys,
+                           [features[:10], features[10:]], None)
+    c = cache.Cache(cache_dir)
+    # Both normalizations run on the same LSF processor, each with its
+    # own view, so the second does not receive the first's results.
+    parallel = lsf.LocalLSF(1, tempfile.mkdtemp())
+    for Normalization in [normalization.StdNormalization,
+                          normalization.RobustLinearNormalization]:
+        n = Normalization(c)
+        os.makedirs(os.path.join(n.dir, 'params'))
+        n._create_cache_params_plates([('p1', image_keys)], parallel)
+        expected = n._compute_params(features)
+        assert np.allclose(np.load(n._params_filename('p1')), expected)
+    # An update of the plate after its images changed is a new run.
+    c._write_manifest(np.array([[0, 1, 10, 10], [0, 2, 10, 10]]))
+    features[:10] += 1
+    cache.PlateStore.write(os.path.join(cache_dir, 'p1'), image_keys,
+                           [features[:10], features[10:]], None)
+    n = normalization.StdNormalization(cache.Cache(cache_dir))
+    n._create_cache_params_plates([('p1', image_keys)], parallel)
+    assert np.allclose(np.load(n._params_filename('p1')), n._compute_params(features))
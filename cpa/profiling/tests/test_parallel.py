@@ -0,0 +1,190 @@
+import os
+import marshal
+import pickle
+from mock import Mock, MagicMock
+from cpa.profiling import parallel, lsf
+
+
+def _square(x):
+    return x * x
+
+def _append(calls, value):
+    calls.append(value)
+
+def _count(name):
+    import os
+    os.environ[name] = str(int(os.environ.get(name, '0')) + 1)
+
+
+def test_worker_local():
+    parallel.clear_worker_memo()
+    factory = Mock(return_value='value')
+    assert parallel.worker_local('key', factory, 1, 2) == 'value'
+    assert parallel.worker_local('key', factory, 1, 2) == 'value'
+    factory.assert_called_once_with(1, 2)
+    parallel.clear_worker_memo()
+
+
+def test_uniprocessing_initializer():
+    calls = []
+    view = parallel.Uniprocessing().view('test')
+    results = view.imap(_square, [1, 2, 3], chunksize=2,
+                        initializer=_append, initargs=(calls, 'init'))
+    assert list(results) == [1, 4, 9]
+    assert calls == ['init']
+
+
+def test_initialized_function():
+    calls = []
+    function = parallel._InitializedFunction(_square, _append, (calls, 'init'))
+    assert [function(x) for x in [1, 2, 3]] == [1, 4, 9]
+    assert calls == ['init']
+    # The wrapper is sent to the workers by pickling.
+    assert pickle.loads(pickle.dumps(function))(4) == 16
+    parallel.clear_worker_memo()
+
+
+def test_lsf_worker_initialize():
+    name = 'CPA_TEST_LSF_INITIALIZE'
+    os.environ.pop(name, None)
+    worker = lsf.Worker('directory', 1, 1)
+    task = dict(initializer=marshal.dumps(_count.func_code), initargs=(name,))
+    worker.initialize(task)
+    worker.initialize(dict(task))
+    worker.initialize(dict(initializer=None))
+    assert os.environ.pop(name) == '1'
+
+
+def test_local_lsf():
+    import tempfile
+    directory = tempfile.mkdtemp()
+    view = lsf.LocalLSF(2, directory).view('test')
+    assert list(view.imap(_square, range(10), chunksize=3)) == [x * x for x in range(10)]
+    assert sorted(os.listdir(os.path.join(directory, 'test', 'done'))) == \
+        ['t0.pickle', 't1.pickle', 't2.pickle', 't3.pickle']
+    # Resuming returns the stored results without running tasks.
+    view = lsf.LocalLSF(1, directory).view('test')
+    assert list(view.imap(_square, range(10), chunksize=3)) == [x * x for x in range(10)]
+
+
+def test_lsf_adaptive_batches():
+    import tempfile
+    directory = tempfile.mkdtemp()
+    view = lsf.LocalLSF(1, directory).view('test')
+    view.poll_seconds = 0.1
+    view.task_seconds = 0
+    # After the first batch of 1 + 10 // 4000 items, every batch
+    # has the minimum size.
+    assert list(view.imap(_square, range(10))) == [x * x for x in range(10)]
+    assert len(view.read_batch_log()) == 10
+
+
+def test_lsf_throttled_start():
+    import tempfile
+    directory = tempfile.mkdtemp()
+    view = lsf.LocalLSF(3, directory).view('test')
+    view.poll_seconds = 0.1
+    view.start_batch = 1
+    view.start_seconds = 3600
+    # The other workers would only be started an hour later.
+    assert list(view.imap(_square, range(10), chunksize=2)) == [x * x for x in range(10)]
+    assert len(os.listdir(os.path.join(directory, 'test', 'out'))) == 1
+
+
+_calls = []
+
+def _square_or_fail(x):
+    _calls.append(x)
+    if x == 'fail':
+        raise ValueError
+    return x * x
+
+
+def test_checkpointing():
+    import tempfile
+    directory = tempfile.mkdtemp()
+    parallel_processor = parallel.Checkpointing(parallel.Uniprocessing(), directory)
+    results = parallel_processor.view('test').imap(_square_or_fail, [1, 2, 'fail', 4])
+    assert results.next() == 1
+    assert results.next() == 4
+    try:
+        results.next()
+        assert False
+    except ValueError:
+        pass
+    # A truncated record at the end is ignored.
+    filename, = os.listdir(os.path.join(directory, 'test'))
+    with open(os.path.join(directory, 'test', filename), 'ab') as f:
+        f.write('\x80\x02')
+    del _calls[:]
+    parallel_processor = parallel.Checkpointing(parallel.Uniprocessing(), directory)
+    results = parallel_processor.view('test').imap(_square_or_fail, [1, 2, 'fail', 4])
+    assert results.next() == 1
+    assert results.next() == 4
+    assert _calls == []
+    # Different parameters do not share the checkpoint.
+    results = parallel_processor.view('test').imap(_square_or_fail, [1, 3])
+    assert list(results) == [1, 9]
+    assert _calls == [1, 3]
+
+
+def test_broadcast():
+    import tempfile
+    import numpy as np
+    directory = tempfile.mkdtemp()
+    parallel.clear_worker_memo()
+    array = np.arange(6.).reshape((2, 3))
+    handle = parallel.broadcast(array, directory)
+    assert handle.filename.endswith('.npy')
+    loaded = pickle.loads(pickle.dumps(handle)).get()
+    assert isinstance(loaded, np.memmap)
+    assert np.array_equal(loaded, array)
+    # Publishing the same value again reuses the file.
+    assert parallel.broadcast(array, directory).filename == handle.filename
+    model = parallel.broadcast({'a': [1, 2]}, directory)
+    assert model.filename.endswith('.pickle')
+    assert model.get() == {'a': [1, 2]}
+    assert model.get() is model.get()
+    handle.remove()
+    model.remove()
+    assert os.listdir(directory) == []
+    parallel.clear_worker_memo()
+
+
+def test_lsf_broadcast():
+    import tempfile
+    directory = tempfile.mkdtemp()
+    handle = lsf.LSF(1, directory).broadcast([1, 2])
+    assert handle.filename.startswith(os.path.join(directory, 'broadcast'))
+    assert handle.get() == [1, 2]
+    parallel.clear_worker_memo()
+
+
+def test_ipython_broadcast():
+    parallel.clear_worker_memo()
+    client = MagicMock()
+    # The engines run the pushed function in their own process.
+    client.__getitem__.return_value.apply_sync.side_effect = \
+        lambda function, *args: function(*args)
+    handle = parallel.IPython(client).broadcast({'a': [1, 2]})
+    handle.remove()
+    assert handle.get() == {'a': [1, 2]}
+    parallel.clear_worker_memo()
+
+
+def test_local_lsf_crashing_worker():
+    import sys
+    import tempfile
+    import subprocess
+    view = lsf.LocalLSF(1, tempfile.mkdtemp()).view('test')
+    view.poll_seconds = 0.05
+    def start_worker(array_index):
+        view.workers[array_index] = subprocess.Popen(
+            [sys.executable, '-c', 'import sys; sys.exit(3)'])
+    view.start_worker = start_worker
+    try:
+        list(view.imap(_square, range(3)))
+        assert False
+    except RuntimeError, e:
+        assert 'status 3' in str(e)
+    assert view.restarts == {1: view.max_restarts + 1}
@@ -55,3 +55,17 @@ def test_main(pclass, unpickle, pickle):
     pca._main(['foo.subsample', '5', 'foo.famodel'])
     pclass.assert_called_once()
 
+
+
+def test_incremental_pca():
+    from cpa.profiling.preprocessing import ScatterMatrix
+    d = np.random.RandomState(0).normal(size=(500, 6)) * [1, 2, 3, 4, 5, 6]
+    variables = ['f%d' % (i + 1) for i in xrange(6)]
+    exact = pca.PCAPreprocessor(pca.standardize(d), variables, 3)
+    incremental = pca.IncrementalPCAPreprocessor(ScatterMatrix.from_data(d).standardized(),
+                                                 variables, 3)
+    assert incremental.variables == exact.variables
+    e = exact(d)
+    i = incremental(d)
+    # The components are determined up to their sign.
+    assert np.allclose(np.abs(e), np.abs(i))
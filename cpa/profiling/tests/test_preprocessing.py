@@ -1,4 +1,6 @@
 from unittest import TestCase
+import numpy as np
+from mock import Mock, patch
 from cpa.profiling import preprocessing
 
 class NullPreprocessorTestCase(TestCase):
@@ -12,3 +14,40 @@ class NullPreprocessorTestCase(TestCase):
         data = object()
         p = preprocessing.NullPreprocessor([])
         assert p(data) == data
+
+
+def test_scatter_matrix():
+    data = np.random.RandomState(0).normal(size=(50, 3)) * [1, 2, 3] + [4, 5, 6]
+    total = preprocessing.ScatterMatrix.from_data(data)
+    merged = reduce(lambda a, b: a.merge(b),
+                    [preprocessing.ScatterMatrix.from_data(data[i:i + 7])
+                     for i in range(0, 50, 7)] +
+                    [preprocessing.ScatterMatrix.from_data(np.zeros((0, 3)))])
+    assert merged.count == 50
+    assert np.allclose(merged.mean, data.mean(axis=0))
+    assert np.allclose(merged.scatter, total.scatter)
+    assert np.allclose(merged.covariance(ddof=1), np.cov(data.T))
+    standardized = (data - data.mean(axis=0)) / data.std(axis=0)
+    assert np.allclose(merged.standardized().scatter, np.dot(standardized.T, standardized))
+
+
+def test_compute_scatter():
+    from cpa.profiling import parallel
+    from cpa.profiling.normalization import DummyNormalization
+    data = np.random.RandomState(0).normal(size=(30, 2))
+    cache = Mock()
+    cache._plate_map = {(0, 1): 'p1', (0, 2): 'p2', (0, 3): 'p1'}
+    rows = {(0, 1): data[:10], (0, 2): data[10:20], (0, 3): data[20:]}
+    def iter_batches(image_keys, normalization, batch_rows):
+        for image_key in image_keys:
+            for i in range(0, 10, batch_rows):
+                yield rows[image_key][i:i + batch_rows], None
+    cache.iter_batches.side_effect = iter_batches
+    parallel.clear_worker_memo()
+    with patch('cpa.profiling.cache.Cache', return_value=cache):
+        scatter = preprocessing.compute_scatter('cache_dir', [(0, 1), (0, 2), (0, 3)],
+                                                DummyNormalization, parallel.Uniprocessing(),
+                                                batch_rows=4, show_progress=False)
+    parallel.clear_worker_memo()
+    assert scatter.count == 30
+    assert np.allclose(scatter.covariance(), np.cov(data.T, bias=True))
@@ -0,0 +1,74 @@
+import numpy as np
+from mock import Mock, patch
+from cpa.profiling import parallel, profile_gmm
+
+
+def make_clusters():
+    random_state = np.random.RandomState(0)
+    return np.vstack([random_state.normal(size=(300, 2)) * 0.5 + [5, 0],
+                      random_state.normal(size=(700, 2)) * 0.5 - [5, 0]])
+
+
+def test_online_gmm():
+    data = make_clusters()
+    gmm = profile_gmm.OnlineGMM(2, random_state=0).initialize(data[::50])
+    for epoch in range(3):
+        for start in range(0, len(data), 100):
+            gmm.partial_fit(data[np.random.RandomState(start).permutation(len(data))[:100]])
+    order = np.argsort(gmm.means_[:, 0])
+    assert np.allclose(gmm.means_[order], [[-5, 0], [5, 0]], atol=0.2)
+    assert np.allclose(gmm.weights_[order], [0.7, 0.3], atol=0.05)
+    assert np.allclose(gmm.covars_, 0.25, atol=0.1)
+    posteriors = gmm.predict_proba(data)
+    assert np.allclose(posteriors.sum(1), 1)
+    assert np.all(posteriors[:300, order[1]] > 0.99)
+
+
+def fit_plates(plates):
+    data = make_clusters()
+    images = dict(((0, i), data[i * 50:(i + 1) * 50]) for i in range(20))
+    def iter_batches(image_keys, normalization, batch_rows, readahead, in_storage_order):
+        if in_storage_order:
+            image_keys = sorted(image_keys, key=lambda image: (plates[image], image))
+        for image in image_keys:
+            yield images[image], None
+    cache = Mock()
+    cache.iter_batches.side_effect = iter_batches
+    gmm = profile_gmm.OnlineGMM(2, random_state=0).initialize(data[::50])
+    return profile_gmm.fit_online(gmm, cache, images.keys(), None, None, np.zeros(2),
+                                  np.eye(2), epochs=3, batch_rows=100, seed=0)
+
+
+def test_fit_online_plate_order():
+    # The first six images, all in the first cluster, are stored
+    # either on the first or on the last plate.
+    first = fit_plates(dict(((0, i), int(i >= 6)) for i in range(20)))
+    last = fit_plates(dict(((0, i), int(i < 6)) for i in range(20)))
+    assert np.array_equal(first.means_, last.means_)
+    assert np.array_equal(first.weights_, last.weights_)
+    order = np.argsort(first.means_[:, 0])
+    assert np.allclose(first.means_[order], [[-5, 0], [5, 0]], atol=0.2)
+    assert np.allclose(first.weights_[order], [0.7, 0.3], atol=0.05)
+
+
+def test_compute_plate_posteriors():
+    data = {(0, 1): np.array([[5., 0.], [-5., 0.]]), (0, 2): np.zeros((0, 2))}
+    gmm = profile_gmm.OnlineGMM(2)
+    gmm.means_ = np.array([[-5., 0.], [5., 0.]])
+    gmm.covars_ = np.ones((2, 2))
+    gmm.weights_ = np.array([0.5, 0.5])
+    model = Mock()
+    model.get.return_value = (gmm, np.zeros(2), np.eye(2))
+    cache = Mock()
+    cache.storage_order.side_effect = sorted
+    cache.load.side_effect = lambda images, normalization: (data[images[0]], ['a', 'b'], None)
+    parallel.clear_worker_memo()
+    with patch('cpa.profiling.cache.Cache', return_value=cache):
+        results = profile_gmm._compute_plate_posteriors(
+            ('cache_dir', 'DummyNormalization', None, [(0, 2), (0, 1)], model))
+    parallel.clear_worker_memo()
+    assert [image for image, _ in results] == [(0, 1), (0, 2)]
+    (sums, n), (empty_sums, empty_n) = [partial for _, partial in results]
+    assert n == 2 and empty_n == 0
+    assert np.allclose(sums, [1, 1])
+    assert np.array_equal(empty_sums, [0, 0])
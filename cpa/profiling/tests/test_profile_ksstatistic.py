@@ -0,0 +1,39 @@
+import numpy as np
+from mock import Mock, patch
+from cpa.profiling import parallel, profile_ksstatistic
+from cpa.profiling.ks_2samp import ks_2samp
+
+
+def test_compute_ksstatistic_reuses_controls():
+    random = np.random.RandomState(0)
+    features = {(0, 1): random.normal(size=(50, 2)),
+                (0, 2): random.normal(size=(10, 2)),
+                (0, 3): random.normal(size=(10, 2)) + 1}
+    cache = Mock()
+    cache.load.side_effect = lambda images, normalization: (
+        np.vstack([features[image] for image in images]), ['a', 'b'], None)
+    control_images = parallel.Broadcast('unused')
+    control_images.get = Mock(return_value={'p1': [(0, 1)]})
+    parallel.clear_worker_memo()
+    with patch('cpa.profiling.cache.Cache', return_value=cache):
+        for image in [(0, 2), (0, 3)]:
+            profile = profile_ksstatistic._compute_ksstatistic(
+                ('cache_dir', [image], (control_images, ['p1']),
+                 'DummyNormalization', None))
+            expected = [ks_2samp(features[(0, 1)][:, j], features[image][:, j],
+                                 signed=True)[0] for j in range(2)]
+            assert np.allclose(profile, expected)
+    # The controls were loaded once, then each group.
+    assert [call[0][0] for call in cache.load.call_args_list] == \
+        [[(0, 1)], [(0, 2)], [(0, 3)]]
+    # A different control map is not served from the memo.
+    other_controls = parallel.Broadcast('other')
+    other_controls.get = Mock(return_value={'p1': [(0, 3)]})
+    with patch('cpa.profiling.cache.Cache', return_value=cache):
+        profile = profile_ksstatistic._compute_ksstatistic(
+            ('cache_dir', [(0, 2)], (other_controls, ['p1']),
+             'DummyNormalization', None))
+    expected = [ks_2samp(features[(0, 3)][:, j], features[(0, 2)][:, j],
+                         signed=True)[0] for j in range(2)]
+    assert np.allclose(profile, expected)
+    parallel.clear_worker_memo()
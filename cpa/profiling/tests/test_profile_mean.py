@@ -0,0 +1,85 @@
+import numpy as np
+from mock import Mock, patch
+from cpa.profiling import parallel, profile_mean
+from cpa.profiling.cache import SummaryStatistics
+
+
+def test_compute_group_mean_methods():
+    data = np.array([[1., 10.], [2., 20.], [6., 60.], [np.nan, 1.]])
+    cache = Mock()
+    cache.load_stats.return_value = None
+    cache.load_sketch.return_value = None
+    cache.load.return_value = (data, ['a', 'b'], None)
+    parallel.clear_worker_memo()
+    with patch('cpa.profiling.cache.Cache', return_value=cache):
+        profile = profile_mean._compute_group_mean(
+            ('cache_dir', [(0, 1)], 'DummyNormalization', None,
+             ['mean', 'median', 'cellcount'], False))
+    parallel.clear_worker_memo()
+    assert np.allclose(profile, [3., 30., 2., 20., 4.])
+    assert cache.load.call_count == 1
+
+
+def test_compute_group_mean_empty():
+    cache = Mock()
+    cache.load_stats.return_value = None
+    cache.load.return_value = (np.array([]), ['a', 'b'], None)
+    parallel.clear_worker_memo()
+    with patch('cpa.profiling.cache.Cache', return_value=cache):
+        profile = profile_mean._compute_group_mean(
+            ('cache_dir', [(0, 1)], 'DummyNormalization', None,
+             ['mean+std', 'cellcount'], False))
+    parallel.clear_worker_memo()
+    assert len(profile) == 5
+    assert np.all(np.isnan(profile[:4]))
+    assert profile[4] == 0
+
+
+def test_method_variables():
+    assert profile_mean.method_variables('median+mad', ['a']) == ['a', 'mad_a']
+    assert profile_mean.method_variables('cellcount', ['a']) == ['Cells_Count']
+    assert len(profile_mean.method_variables('deciles', ['a', 'b'])) == 18
+
+
+def test_compute_plate_major():
+    data = {(0, 1): np.array([[1., 10.], [3., 30.]]),
+            (0, 2): np.array([[5., 50.]]),
+            (0, 3): np.array([[7., 70.], [np.nan, 1.]])}
+    cache = Mock()
+    cache._plate_map = {(0, 1): 'p1', (0, 2): 'p1', (0, 3): 'p2'}
+    cache.storage_order.side_effect = sorted
+    cache._sketch_size = None
+    cache.load.side_effect = lambda images, normalization: (data[images[0]], ['a', 'b'], None)
+    # The cache has no per-image summaries.
+    cache.load_stats.return_value = None
+    cache.load_sketch.return_value = None
+    parallel.clear_worker_memo()
+    with patch('cpa.profiling.cache.Cache', return_value=cache):
+        with patch('cpa.profiling.profile_mean.Cache', return_value=cache):
+            result = profile_mean._compute_plate_major(
+                'cache_dir', [[(0, 1), (0, 2)], [(0, 2), (0, 3)], []],
+                profile_mean.DummyNormalization, None, ['mean', 'median', 'cellcount'],
+                parallel.Uniprocessing(), show_progress=False)
+    parallel.clear_worker_memo()
+    # Every image is loaded once, although (0, 2) is in two groups.
+    assert cache.load.call_count == 3
+    assert np.allclose(result[0], [3., 30., 3., 30., 3.])
+    assert np.allclose(result[1], [6., 60., 5., 50., 2.])
+    assert result[2] is None
+    # Stats-only methods use the per-image statistics of the cache.
+    cache.load.reset_mock()
+    cache.load_stats.side_effect = lambda images, normalization: \
+        SummaryStatistics.from_data(np.vstack([data[image] for image in images]))
+    with patch('cpa.profiling.cache.Cache', return_value=cache):
+        with patch('cpa.profiling.profile_mean.Cache', return_value=cache):
+            result = profile_mean._compute_plate_major(
+                'cache_dir', [[(0, 1), (0, 2)], [(0, 2), (0, 3)]],
+                profile_mean.DummyNormalization, None, ['mean', 'cellcount'],
+                parallel.Uniprocessing(), show_progress=False)
+    parallel.clear_worker_memo()
+    assert cache.load.call_count == 0
+    assert np.allclose(result[0], [3., 30., 3.])
+    assert np.allclose(result[1], [6., 60., 2.])
+    np.testing.assert_raises(ValueError, profile_mean._compute_plate_major,
+                             'cache_dir', [], profile_mean.DummyNormalization, None,
+                             ['mode'], parallel.Uniprocessing())
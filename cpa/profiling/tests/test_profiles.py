@@ -0,0 +1,61 @@
+import os
+import tempfile
+import numpy as np
+from mock import patch
+from cpa.profiling.profiles import Profiles
+
+
+def make_profiles():
+    data = np.random.RandomState(0).normal(size=(3, 2))
+    data[0, 0] = 1 / 3.
+    return Profiles([('a', '1'), ('b', '2'), ('c', '3')], data, ['x', 'y'],
+                    group_name='Well')
+
+
+def test_save_load_text():
+    profiles = make_profiles()
+    filename = os.path.join(tempfile.mkdtemp(), 'profiles.txt')
+    profiles.save(filename)
+    lines = open(filename).readlines()
+    assert lines[0] == 'Well\t\tx\ty\n'
+    assert lines[1].startswith('a\t1\t')
+    loaded = Profiles.load(filename)
+    assert loaded.keys() == profiles.keys()
+    assert loaded.variables == profiles.variables
+    assert loaded.group_name == 'Well'
+    assert loaded.key_size == 2
+    # The values survive the round trip exactly.
+    assert np.array_equal(loaded.data, profiles.data)
+
+
+def test_save_load_binary():
+    profiles = make_profiles()
+    filename = os.path.join(tempfile.mkdtemp(), 'profiles.bin')
+    profiles.save_binary(filename)
+    loaded = Profiles.load(filename)
+    assert loaded.keys() == profiles.keys()
+    assert all(isinstance(k, str) for key in loaded.keys() for k in key)
+    assert loaded.variables == profiles.variables
+    assert loaded.group_name == 'Well'
+    assert loaded.key_size == 2
+    assert np.array_equal(loaded.data, profiles.data)
+    assert isinstance(loaded.data.base, np.memmap) or isinstance(loaded.data, np.memmap)
+    # Loading does not scan the mapped data.
+    with patch('numpy.isnan', side_effect=AssertionError):
+        Profiles.load(filename)
+
+
+def test_save_binary_empty():
+    profiles = Profiles([('a',)], np.zeros((1, 0)), [], group_name='Well')
+    filename = os.path.join(tempfile.mkdtemp(), 'profiles.bin')
+    profiles.save_binary(filename)
+    assert Profiles.load(filename).data.shape == (1, 0)
+
+
+def test_scatter_to_groups():
+    from cpa.profiling.profiles import scatter_to_groups
+    groups = [[(1,), (2,)], [(2,), (3,)], []]
+    results = iter([((2,), 20), ((1,), 10), ((3,), 30)])
+    finished = list(scatter_to_groups(results, groups, sum))
+    # Each group is finalized as soon as its last image arrives.
+    assert finished == [(2, 0), (0, 30), (1, 50)]
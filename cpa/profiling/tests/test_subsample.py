@@ -1,3 +1,4 @@
+import os
 import numpy as np
 from mock import Mock, patch, call
 from cpa.profiling import subsample
@@ -35,6 +36,74 @@ def test_combine_subsample():
     r = subsample._combine_subsample(generator)
     assert np.array_equal(r, np.array([[1, 2, 3], [4, 5, 6], [7, 8, 9]]))
 
+def test_merge_reservoirs():
+    a = (np.array([0.5, 0.1, 0.9]), np.array([[5.], [1.], [9.]]), np.array([[0, 5], [0, 1], [0, 9]]))
+    b = (np.array([0.3, 0.7]), np.array([[3.], [7.]]), np.array([[1, 3], [1, 7]]))
+    merged = subsample._merge_reservoirs(a, b, 3)
+    assert sorted(merged[0]) == [0.1, 0.3, 0.5]
+    assert sorted(merged[1].ravel()) == [1., 3., 5.]
+    assert sorted(merged[2][:, 1]) == [1, 3, 5]
+    assert subsample._merge_reservoirs(None, b, 1)[0].tolist() == [0.3]
+    assert subsample._merge_reservoirs(None, None, 1) is None
+
+
+def make_streaming_cache():
+    image_keys = [(0, i) for i in range(6)]
+    data = dict((k, np.arange(10 * k[1], 10 * k[1] + 4, dtype=float)[:, np.newaxis] * [1, -1])
+                for k in image_keys)
+    cache = Mock()
+    cache._plate_map = dict((k, 'plate%d' % (k[1] % 2)) for k in image_keys)
+    cache.get_cell_counts.return_value = dict((k, 4) for k in image_keys)
+    cache.cache_dir = 'cache_dir'
+    cache.colnames = ['f1', 'f2']
+    cache.storage_order.side_effect = sorted
+    cache.load.side_effect = lambda keys, normalization, removeRowsWithNaN: \
+        (data[keys[0]], ['f1', 'f2'], np.arange(4))
+    return image_keys, cache
+
+
+def test_streaming_subsample():
+    from cpa.profiling import parallel
+    from cpa.profiling.normalization import DummyNormalization
+    image_keys, cache = make_streaming_cache()
+    samples = []
+    for seed in [1, 1, 2]:
+        parallel.clear_worker_memo()
+        with patch('cpa.profiling.cache.Cache', return_value=cache):
+            with patch('cpa.profiling.subsample.Cache', return_value=cache):
+                with patch('cpa.db.GetAllImageKeys', return_value=image_keys):
+                    samples.append(subsample.Subsample('cache_dir', 10, normalization=DummyNormalization,
+                                                       show_progress=False, verbose=False,
+                                                       streaming=True, seed=seed))
+    parallel.clear_worker_memo()
+    s = samples[0]
+    assert s.data.shape == (10, 2)
+    assert s.objkeys.shape == (10, 3)
+    # Each cell is sampled at most once, with its object key.
+    assert len(set(s.data[:, 0])) == 10
+    assert np.array_equal(s.data[:, 0], 10 * s.objkeys[:, 1] + s.objkeys[:, 2])
+    assert np.array_equal(s.data, samples[1].data)
+    assert not np.array_equal(s.data, samples[2].data)
+    # The images of each plate are read in storage order.
+    loaded = [call[0][0][0] for call in cache.load.call_args_list[:6]]
+    assert loaded == sorted(loaded, key=lambda k: (cache._plate_map[k], k))
+
+
+def test_save_memmap():
+    import tempfile
+    import cpa.util
+    s = subsample.Subsample.__new__(subsample.Subsample)
+    s.variables = ['f1', 'f2']
+    s.data = np.arange(6.).reshape((3, 2))
+    s.objkeys = np.array([[0, 1, 1], [0, 1, 2], [0, 2, 1]])
+    filename = os.path.join(tempfile.mkdtemp(), 'subsample')
+    s.save(filename, memmap=True)
+    loaded = cpa.util.unpickle1(filename)
+    assert isinstance(loaded.data, np.memmap)
+    assert np.array_equal(loaded.data, s.data)
+    assert np.array_equal(loaded.objkeys, s.objkeys)
+    assert loaded.variables == s.variables
+
 # TODO: SubsampleTestCase
 # TODO: test_init
 # TODO: test_compute